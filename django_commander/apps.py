@@ -17,6 +17,34 @@ class DjangoCommanderConfig(AppConfig):
             ("S3_BUCKET", None),
             ("DJANGO_COMMANDER_CACHE_PATH", "cache"),
             ("DJANGO_COMMANDER_USE_S3", False),
+            ("DJANGO_COMMANDER_UPDATE_STATS", True),
+            ("DJANGO_COMMANDER_STATS_WINDOW", 1000),
+            ("DJANGO_COMMANDER_LOG_RETENTION", {}),
+            ("DJANGO_COMMANDER_ARCHIVE_PATH", "archive"),
+            ("DJANGO_COMMANDER_METRICS_FLUSH_INTERVAL", 30),
+            ("DJANGO_COMMANDER_SPOOL_THRESHOLD", 1024 * 1024),
+            ("DJANGO_COMMANDER_SPOOL_PATH", None),
+            ("DJANGO_COMMANDER_WORKER_CONN_MAX_AGE", None),
+            ("DJANGO_COMMANDER_WORKER_MEMORY", None),
+            ("DJANGO_COMMANDER_MAX_DB_CONNECTIONS", None),
+            ("DJANGO_COMMANDER_TASKS_PER_WORKER", 2),
+            ("DJANGO_COMMANDER_MAX_ITEM_ERRORS", 100),
+            ("DJANGO_COMMANDER_RATE_LIMIT_PATH", None),
+            ("DJANGO_COMMANDER_CACHE_INDEX_PATH", None),
+            ("DJANGO_COMMANDER_CACHE_POLICIES", {}),
+            ("DJANGO_COMMANDER_S3_CONCURRENCY", 10),
+            ("DJANGO_COMMANDER_S3_PREFETCH", 32),
+            ("DJANGO_COMMANDER_S3_WRITE_BEHIND", False),
+            ("DJANGO_COMMANDER_S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024),
+            ("DJANGO_COMMANDER_S3_MULTIPART_CHUNKSIZE", 8 * 1024 * 1024),
+            ("DJANGO_COMMANDER_S3_LOCAL_TIER_MAX_BYTES", None),
+            ("DJANGO_COMMANDER_COUNT_QUERIES", False),
+            ("DJANGO_COMMANDER_METRICS_TEXTFILE", None),
+            ("DJANGO_COMMANDER_TRACING", None),
+            ("DJANGO_COMMANDER_TRACE_PATH", None),
+            ("DJANGO_COMMANDER_MEMORY_CEILING", None),
+            ("DJANGO_COMMANDER_WORKER_MAX_TASKS", "auto"),
+            ("DJANGO_COMMANDER_RUN_GROUP_TIMEOUT", 24 * 60 * 60),
         ]:
             if not hasattr(settings, setting):
                 setattr(settings, setting, default)
@@ -0,0 +1,1219 @@
+import collections
+import datetime
+import json
+import multiprocessing.util
+import os
+import pickle
+import sqlite3
+import time
+
+from django.conf import settings
+
+from django_pewtils import CacheHandler
+from pewtils.io import FileHandler
+
+from django_commander.s3 import S3Store, get_etag
+
+
+def get_cache_index_path():
+
+    """
+    :return: The SQLite file that the cache index is stored in; defaults to `index.sqlite3` in \
+    `DJANGO_COMMANDER_CACHE_PATH`. The index is always local, even when the cache itself is in S3.
+    """
+
+    return settings.DJANGO_COMMANDER_CACHE_INDEX_PATH or os.path.join(
+        settings.DJANGO_COMMANDER_CACHE_PATH, "index.sqlite3"
+    )
+
+
+def get_cache_policy(command_name):
+
+    """
+    Looks up the cache policy for a command. Policies are dictionaries with any of the following keys:
+
+    * `max_bytes`: The maximum total size of the command's cached files; the least recently used files are evicted \
+    once it's exceeded
+    * `max_age_days`: The number of days after which a cached file expires
+
+    Policies defined in the `DJANGO_COMMANDER_CACHE_POLICIES` setting (keyed by command name) take precedence over a
+    `cache_policy` attribute on the command class, and commands without either fall back to the "default" policy in
+    the setting, if there is one.
+
+    :param command_name: The name of the command
+    :return: The cache policy dictionary, or None if the command's cache should be kept indefinitely
+    """
+
+    from django_commander.commands import commands
+
+    policies = settings.DJANGO_COMMANDER_CACHE_POLICIES
+    if command_name in policies:
+        return policies[command_name]
+    if getattr(commands.get(command_name), "cache_policy", None) is not None:
+        return commands[command_name].cache_policy
+    return policies.get("default", None)
+
+
+def _new_reads():
+
+    return {"count": 0, "totals": {}, "accessed": {}, "local_accessed": {}}
+
+
+class CacheIndex(object):
+
+    """
+    A small SQLite index of the files in the command caches, recording the size of each file and when it was created
+    and last read, along with hit and miss counts for each command. Garbage collection works from the index, so it
+    doesn't need to walk the cache folders (or list S3 prefixes).
+
+    Reads are counted in memory and written to the index in batches (see `flush_reads`), so that reading from the
+    cache doesn't take the index's write lock for every key.
+
+    :param path: (Optional) the SQLite file to use; defaults to `get_cache_index_path()`
+    :param read_batch_size: The number of reads to buffer before they're written to the index
+    """
+
+    def __init__(self, path=None, read_batch_size=100):
+
+        self.path = path or get_cache_index_path()
+        self.read_batch_size = read_batch_size
+        self._connection = None
+        self._pid = None
+        self._reads = None
+        self._reads_pid = None
+
+    @property
+    def connection(self):
+
+        # Connections can't be shared with forked processes, and the file may have been deleted along with the cache
+        if (
+            self._connection is None
+            or self._pid != os.getpid()
+            or not os.path.exists(self.path)
+        ):
+            if self._pid == os.getpid() and self._reads_pid == os.getpid():
+                # Reads buffered for an index that has since been deleted don't belong in its replacement
+                self._reads = _new_reads()
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            self._connection = sqlite3.connect(
+                self.path, timeout=60, isolation_level=None
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    folder TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    command TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    fingerprint TEXT,
+                    format TEXT NOT NULL DEFAULT 'pkl',
+                    parameters TEXT,
+                    PRIMARY KEY (folder, key)
+                );
+                CREATE INDEX IF NOT EXISTS entries_accessed_at
+                    ON entries (command, accessed_at);
+                CREATE INDEX IF NOT EXISTS entries_created_at
+                    ON entries (command, created_at);
+                CREATE TABLE IF NOT EXISTS totals (
+                    command TEXT PRIMARY KEY,
+                    entries INTEGER NOT NULL DEFAULT 0,
+                    bytes INTEGER NOT NULL DEFAULT 0,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    misses INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS folders (
+                    folder TEXT PRIMARY KEY,
+                    complete INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS local_copies (
+                    folder TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    etag TEXT,
+                    size INTEGER NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    PRIMARY KEY (folder, key)
+                );
+                CREATE INDEX IF NOT EXISTS local_copies_accessed_at
+                    ON local_copies (accessed_at);
+                CREATE TABLE IF NOT EXISTS local_copy_totals (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    bytes INTEGER NOT NULL DEFAULT 0
+                );
+                """
+            )
+            # Indexes created before the local disk tier's size was tracked need it added up once
+            self._connection.execute(
+                "INSERT OR IGNORE INTO local_copy_totals (id, bytes) "
+                "SELECT 0, COALESCE(SUM(size), 0) FROM local_copies "
+                "WHERE NOT EXISTS (SELECT 1 FROM local_copy_totals)"
+            )
+            # Indexes created before fingerprints were tracked need the newer columns added
+            columns = [
+                row[1]
+                for row in self._connection.execute("PRAGMA table_info(entries)")
+            ]
+            for column, definition in [
+                ("fingerprint", "TEXT"),
+                ("format", "TEXT NOT NULL DEFAULT 'pkl'"),
+                ("parameters", "TEXT"),
+            ]:
+                if column not in columns:
+                    self._connection.execute(
+                        "ALTER TABLE entries ADD COLUMN {} {}".format(
+                            column, definition
+                        )
+                    )
+            self._pid = os.getpid()
+        return self._connection
+
+    def _update_totals(self, command, entries=0, size=0, hits=0, misses=0):
+
+        self.connection.execute(
+            "INSERT OR IGNORE INTO totals (command) VALUES (?)", (command,)
+        )
+        self.connection.execute(
+            "UPDATE totals SET entries = entries + ?, bytes = bytes + ?, "
+            "hits = hits + ?, misses = misses + ? WHERE command = ?",
+            (entries, size, hits, misses, command),
+        )
+
+    def record_read(self, command, folder, key, hit):
+
+        """
+        Records a cache hit (updating the entry's access time) or a miss. Reads are buffered in memory, and are written
+        to the index once `read_batch_size` of them have accumulated (or when `flush_reads` is called).
+
+        :param command: The name of the command
+        :param folder: The cache folder that was read from
+        :param key: The cache key
+        :param hit: Whether the key was found
+        """
+
+        reads = self._get_reads()
+        totals = reads["totals"].setdefault(command, [0, 0])
+        totals[0 if hit else 1] += 1
+        if hit:
+            reads["accessed"][(folder, key)] = time.time()
+        self._count_read(reads)
+
+    def record_local_read(self, folder, key):
+
+        """
+        Records a read of an object's copy in the local disk tier, so that it's evicted after copies that haven't been
+        read as recently. Like `record_read`, local reads are buffered and written in batches.
+
+        :param folder: The S3 cache folder
+        :param key: The cache key
+        """
+
+        reads = self._get_reads()
+        reads["local_accessed"][(folder, key)] = time.time()
+        self._count_read(reads)
+
+    def _get_reads(self):
+
+        if self._reads_pid != os.getpid():
+            # Reads buffered by the parent of a forked process are the parent's to write
+            self._reads = _new_reads()
+            self._reads_pid = os.getpid()
+            # Makes sure the last batch is written when the process exits, including multiprocessing workers
+            multiprocessing.util.Finalize(
+                self, self.flush_reads, kwargs={"wait": True}, exitpriority=10
+            )
+        return self._reads
+
+    def _count_read(self, reads):
+
+        reads["count"] += 1
+        if reads["count"] >= self.read_batch_size:
+            self.flush_reads()
+
+    def flush_reads(self, wait=False):
+
+        """
+        Writes the buffered hit and miss counts and access times (including those of local copies) to the index. This
+        is best-effort: unless `wait` is set, it gives up straight away if another process is writing to the index, and
+        the reads stay buffered until the next attempt.
+
+        :param wait: If True, waits for the index's write lock (up to the connection's timeout) rather than giving up
+        :return: True if the buffered reads were written (or there weren't any)
+        """
+
+        reads = self._reads
+        if not reads or not reads["count"] or self._reads_pid != os.getpid():
+            return True
+        if not os.path.exists(self.path):
+            # The index was deleted along with the cache, so there's nothing left to update
+            self._reads = _new_reads()
+            return True
+        connection = self.connection
+        if not wait:
+            connection.execute("PRAGMA busy_timeout = 0")
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            return False
+        finally:
+            if not wait:
+                connection.execute("PRAGMA busy_timeout = 60000")
+        try:
+            connection.executemany(
+                "UPDATE entries SET accessed_at = MAX(accessed_at, ?) "
+                "WHERE folder = ? AND key = ?",
+                [
+                    (accessed_at, folder, key)
+                    for (folder, key), accessed_at in reads["accessed"].items()
+                ],
+            )
+            connection.executemany(
+                "UPDATE local_copies SET accessed_at = MAX(accessed_at, ?) "
+                "WHERE folder = ? AND key = ?",
+                [
+                    (accessed_at, folder, key)
+                    for (folder, key), accessed_at in reads["local_accessed"].items()
+                ],
+            )
+            for command, (hits, misses) in reads["totals"].items():
+                self._update_totals(command, hits=hits, misses=misses)
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            return False
+        self._reads = _new_reads()
+        return True
+
+    def record_write(
+        self,
+        command,
+        folder,
+        key,
+        size,
+        fingerprint=None,
+        format="pkl",
+        parameters=None,
+        created_at=None,
+    ):
+
+        """
+        Adds or replaces an entry in the index.
+
+        :param command: The name of the command
+        :param folder: The cache folder that was written to
+        :param key: The cache key
+        :param size: The size of the cached file, in bytes
+        :param fingerprint: (Optional) a string identifying the source of the cached data (see \
+        `BasicCommand.get_cache_fingerprint`)
+        :param format: The format the file was saved in
+        :param parameters: (Optional) a dictionary of the command parameters that the data was cached for
+        :param created_at: (Optional) the time the file was created; defaults to now
+        :return: The command's new total cache size, in bytes
+        """
+
+        connection = self.connection
+        now = time.time()
+        if created_at is None:
+            created_at = now
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            existing = connection.execute(
+                "SELECT size FROM entries WHERE folder = ? AND key = ?", (folder, key)
+            ).fetchone()
+            connection.execute(
+                "INSERT OR REPLACE INTO entries (folder, key, command, size, "
+                "created_at, accessed_at, fingerprint, format, parameters) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    folder,
+                    key,
+                    command,
+                    size,
+                    created_at,
+                    now,
+                    fingerprint,
+                    format,
+                    json.dumps(parameters, sort_keys=True) if parameters else None,
+                ),
+            )
+            if existing:
+                self._update_totals(command, size=size - existing[0])
+            else:
+                self._update_totals(command, entries=1, size=size)
+            total = connection.execute(
+                "SELECT bytes FROM totals WHERE command = ?", (command,)
+            ).fetchone()[0]
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        return total
+
+    def _remove(self, command, entries):
+
+        removed = 0
+        size = 0
+        for folder, key in entries:
+            row = self.connection.execute(
+                "SELECT size FROM entries WHERE folder = ? AND key = ?", (folder, key)
+            ).fetchone()
+            if row:
+                self.connection.execute(
+                    "DELETE FROM entries WHERE folder = ? AND key = ?", (folder, key)
+                )
+                removed += 1
+                size += row[0]
+        if removed:
+            self._update_totals(command, entries=-removed, size=-size)
+
+    def remove(self, command, entries):
+
+        """
+        Removes entries from the index.
+
+        :param command: The name of the command
+        :param entries: A list of `(folder, key, ...)` tuples
+        """
+
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._remove(command, [(e[0], e[1]) for e in entries])
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def get_entry(self, folder, key):
+
+        """
+        :param folder: The cache folder
+        :param key: The cache key
+        :return: A dictionary describing the entry (see `find_entries`), or None if it isn't in the index
+        """
+
+        rows = self._select("WHERE folder = ? AND key = ?", [folder, key])
+        return rows[0] if rows else None
+
+    def find_keys(self, folder, keys, chunk_size=500):
+
+        """
+        Looks up which of a list of keys are in the index, with one query per `chunk_size` keys.
+
+        :param folder: The cache folder
+        :param keys: A list of cache keys
+        :param chunk_size: The number of keys to look up in each query
+        :return: A set of the keys that are in the index
+        """
+
+        found = set()
+        keys = list(keys)
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i : i + chunk_size]
+            query = "SELECT key FROM entries WHERE folder = ? AND key IN ({})".format(
+                ", ".join(["?"] * len(chunk))
+            )
+            found.update(
+                [row[0] for row in self.connection.execute(query, [folder] + chunk)]
+            )
+        return found
+
+    def is_complete(self, folder):
+
+        """
+        :param folder: The cache folder
+        :return: Whether every file in the folder is known to be in the index, in which case a key that isn't in the \
+        index doesn't need to be looked for in the folder
+        """
+
+        row = self.connection.execute(
+            "SELECT complete FROM folders WHERE folder = ?", (folder,)
+        ).fetchone()
+        return bool(row and row[0])
+
+    def mark_complete(self, folder):
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO folders (folder, complete) VALUES (?, 1)", (folder,)
+        )
+
+    def _select(self, where, params, order_by=None, limit=None):
+
+        query = (
+            "SELECT folder, key, size, created_at, accessed_at, fingerprint, format, "
+            "parameters FROM entries "
+        ) + where
+        params = list(params)
+        if order_by:
+            query += " ORDER BY {}".format(order_by)
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        entries = []
+        for row in self.connection.execute(query, params):
+            entries.append(
+                {
+                    "folder": row[0],
+                    "key": row[1],
+                    "size": row[2],
+                    "created_at": row[3],
+                    "accessed_at": row[4],
+                    "fingerprint": row[5],
+                    "format": row[6],
+                    "parameters": json.loads(row[7]) if row[7] else {},
+                }
+            )
+        return entries
+
+    def find_entries(
+        self,
+        command,
+        prefix=None,
+        before=None,
+        parameters=None,
+        order_by="accessed_at",
+        limit=None,
+    ):
+
+        """
+        Looks up a command's cache entries.
+
+        :param command: The name of the command
+        :param prefix: (Optional) only return entries whose keys start with this string
+        :param before: (Optional) only return entries where `order_by` is earlier than this timestamp
+        :param parameters: (Optional) a dictionary of parameter values that the entries must have been cached for
+        :param order_by: The column to sort entries by, oldest first ("accessed_at" or "created_at")
+        :param limit: (Optional) the maximum number of entries to return
+        :return: A list of dictionaries with each entry's `folder`, `key`, `size`, `created_at`, `accessed_at`, \
+        `fingerprint`, `format` and `parameters`
+        """
+
+        if order_by not in ["accessed_at", "created_at"]:
+            raise ValueError("Entries can only be ordered by accessed_at or created_at")
+        where = "WHERE command = ?"
+        params = [command]
+        if prefix:
+            where += " AND substr(key, 1, ?) = ?"
+            params.extend([len(prefix), prefix])
+        if before is not None:
+            where += " AND {} < ?".format(order_by)
+            params.append(before)
+        for name, value in (parameters or {}).items():
+            where += " AND json_extract(parameters, ?) = ?"
+            params.extend(['$."{}"'.format(name), value])
+
+        return self._select(where, params, order_by=order_by, limit=limit)
+
+    def get_local_copy(self, folder, key):
+
+        """
+        :param folder: The S3 cache folder
+        :param key: The cache key
+        :return: The `(etag, size)` of the object's copy in the local disk tier, or None if there isn't one
+        """
+
+        row = self.connection.execute(
+            "SELECT etag, size FROM local_copies WHERE folder = ? AND key = ?",
+            (folder, key),
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def get_local_copies(self, folder, keys, chunk_size=500):
+
+        """
+        :param folder: The S3 cache folder
+        :param keys: A list of cache keys
+        :param chunk_size: The number of keys to look up in each query
+        :return: A dictionary mapping the keys that have a copy in the local disk tier to their `(etag, size)`
+        """
+
+        copies = {}
+        keys = list(keys)
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i : i + chunk_size]
+            query = (
+                "SELECT key, etag, size FROM local_copies "
+                "WHERE folder = ? AND key IN ({})".format(", ".join(["?"] * len(chunk)))
+            )
+            for key, etag, size in self.connection.execute(query, [folder] + chunk):
+                copies[key] = (etag, size)
+        return copies
+
+    def record_local_copy(self, folder, key, etag, size):
+
+        """
+        Adds or refreshes an object's copy in the local disk tier.
+
+        :param folder: The S3 cache folder
+        :param key: The cache key
+        :param etag: The object's ETag in S3
+        :param size: The object's size, in bytes
+        :return: The total size of the local disk tier, in bytes
+        """
+
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            existing = connection.execute(
+                "SELECT size FROM local_copies WHERE folder = ? AND key = ?",
+                (folder, key),
+            ).fetchone()
+            connection.execute(
+                "INSERT OR REPLACE INTO local_copies "
+                "(folder, key, etag, size, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (folder, key, etag, size, time.time()),
+            )
+            connection.execute(
+                "UPDATE local_copy_totals SET bytes = bytes + ?",
+                (size - existing[0] if existing else size,),
+            )
+            total = self.get_local_copy_total()
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        return total
+
+    def get_local_copy_total(self):
+
+        """
+        :return: The total size of the local disk tier, in bytes
+        """
+
+        return self.connection.execute(
+            "SELECT bytes FROM local_copy_totals"
+        ).fetchone()[0]
+
+    def remove_local_copies(self, entries):
+
+        """
+        :param entries: A list of `(folder, key)` tuples to remove from the local disk tier
+        """
+
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for folder, key in entries:
+                row = connection.execute(
+                    "SELECT size FROM local_copies WHERE folder = ? AND key = ?",
+                    (folder, key),
+                ).fetchone()
+                if row:
+                    connection.execute(
+                        "DELETE FROM local_copies WHERE folder = ? AND key = ?",
+                        (folder, key),
+                    )
+                    connection.execute(
+                        "UPDATE local_copy_totals SET bytes = bytes - ?", (row[0],)
+                    )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def find_local_copies(self, limit=None):
+
+        """
+        :param limit: (Optional) the maximum number of copies to return
+        :return: A list of `(folder, key, size)` tuples for the copies in the local disk tier, least recently used first
+        """
+
+        query = "SELECT folder, key, size FROM local_copies ORDER BY accessed_at"
+        params = []
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return [tuple(row) for row in self.connection.execute(query, params)]
+
+    def get_totals(self, command=None):
+
+        """
+        :param command: (Optional) a command name; defaults to all of the commands in the index
+        :return: A dictionary mapping command names to dictionaries with `entries`, `bytes`, `hits` and `misses`
+        """
+
+        query = "SELECT command, entries, bytes, hits, misses FROM totals"
+        params = []
+        if command:
+            query += " WHERE command = ?"
+            params.append(command)
+        totals = {}
+        for row in self.connection.execute(query + " ORDER BY command", params):
+            totals[row[0]] = {
+                "entries": row[1],
+                "bytes": row[2],
+                "hits": row[3],
+                "misses": row[4],
+            }
+        return totals
+
+
+def get_cache_index():
+
+    """
+    :return: The `CacheIndex` for the current index path, shared by everything in this process
+    """
+
+    global _cache_index
+    path = get_cache_index_path()
+    if _cache_index is None or _cache_index.path != path:
+        _cache_index = CacheIndex(path)
+    return _cache_index
+
+
+_cache_index = None
+
+
+def get_local_tier_path(folder):
+
+    """
+    :param folder: An S3 cache folder
+    :return: The local folder that copies of the S3 folder's objects are kept in (see `CommandCache`)
+    """
+
+    return os.path.join(
+        settings.DJANGO_COMMANDER_CACHE_PATH,
+        "local_tier",
+        os.path.relpath(folder, settings.DJANGO_COMMANDER_CACHE_PATH),
+    )
+
+
+class CommandCache(object):
+
+    """
+    The cache that `cache_results` reads from and writes to. Wraps a `CacheHandler` for the command's cache folder,
+    records every read and write in the `CacheIndex`, and enforces the command's `max_bytes` policy (see
+    `get_cache_policy`) by evicting the least recently used files whenever a write pushes the cache over its limit.
+    Any other attributes are passed through to the underlying `CacheHandler`.
+
+    Local cache folders are indexed in full the first time they're used, after which existence checks (`contains`) are
+    answered from the index without touching the filesystem, and reads of keys that aren't in the index are skipped.
+    S3 folders can't be listed cheaply, so keys that aren't in their index are always looked up in the bucket.
+
+    S3 caches are read and written through an `S3Store`, so that upcoming keys can be fetched in the background with
+    `prefetch` and, if `write_behind` is set, writes are uploaded in the background until `flush` is called (this is
+    off by default, since uploads that are still queued when a run fails are lost). If
+    `DJANGO_COMMANDER_S3_LOCAL_TIER_MAX_BYTES` is set, S3 remains the source of truth but copies of the objects that
+    are read and written are also kept on local disk (see `get_local_tier_path`), up to that many bytes in total. Reads
+    check a local copy's ETag against S3 and only download the object if the copy is stale. Hits and misses for each
+    tier are counted in `stats`.
+
+    :param command_name: The name of the command
+    :param path: The command's cache folder
+    :param use_s3: Whether the cache is stored in S3
+    :param bucket: The S3 bucket
+    :param write_behind: Whether to upload writes to S3 in the background
+    """
+
+    def __init__(
+        self, command_name, path, use_s3=False, bucket=None, write_behind=False
+    ):
+
+        self.command_name = command_name
+        self.path = path
+        self.use_s3 = use_s3
+        self.bucket = bucket
+        self.write_behind = write_behind
+        self.handler = CacheHandler(path, hash=False, use_s3=use_s3, bucket=bucket)
+        self.store = S3Store(bucket) if use_s3 else None
+        if use_s3:
+            self.local_tier_max_bytes = (
+                settings.DJANGO_COMMANDER_S3_LOCAL_TIER_MAX_BYTES
+            )
+            self.local_path = get_local_tier_path(path)
+        else:
+            self.local_tier_max_bytes = None
+            self.local_path = None
+        self.stats = collections.Counter()
+        self._file_handler = None
+        self._complete = None
+        self.index = get_cache_index()
+
+    def __getattr__(self, attr):
+
+        if attr == "handler":
+            raise AttributeError(attr)
+        return getattr(self.handler, attr)
+
+    @property
+    def file_handler(self):
+
+        if not self._file_handler:
+            self._file_handler = FileHandler(
+                self.path, use_s3=self.use_s3, bucket=self.bucket
+            )
+        return self._file_handler
+
+    @property
+    def is_complete(self):
+
+        """
+        :return: Whether every file in the cache folder is in the index; local folders that haven't been indexed yet \
+        are indexed on first use
+        """
+
+        if self._complete is None:
+            self._complete = self.index.is_complete(self.path)
+            if not self._complete and not self.use_s3:
+                index_existing_files(self.command_name, self.path)
+                self._complete = True
+        return self._complete
+
+    def contains(self, key):
+
+        """
+        Checks whether a key is cached, using the index rather than the filesystem or S3.
+
+        :param key: The cache key
+        :return: True or False, or None if the folder isn't fully indexed and the key isn't in the index (in which \
+        case it may still exist)
+        """
+
+        # Local folders that weren't indexed yet are indexed first (see `is_complete`)
+        complete = self.is_complete
+        if self.index.find_keys(self.path, [key]):
+            return True
+        return False if complete else None
+
+    def get_s3_key(self, key):
+
+        return "/".join([self.path, "{}.pkl".format(key)])
+
+    def prefetch(self, keys):
+
+        """
+        Starts fetching keys from S3 in the background, so that reading them later doesn't have to wait on a round
+        trip. Keys that are known not to be cached are skipped. Does nothing for local caches.
+
+        :param keys: A list of cache keys
+        """
+
+        if self.use_s3:
+            # Keys can only be ruled out in fully indexed folders (see `contains`), and they're looked up all at once
+            if self.is_complete:
+                found = self.index.find_keys(self.path, keys)
+                keys = [key for key in keys if key in found]
+            if self.local_tier_max_bytes:
+                copies = self.index.get_local_copies(self.path, keys)
+                # Copies whose files were evicted by another process are forgotten, as in `_get_local_copy`
+                evicted = [
+                    key
+                    for key in copies
+                    if not os.path.exists(self._get_local_filepath(key))
+                ]
+                if evicted:
+                    self.index.remove_local_copies(
+                        [(self.path, key) for key in evicted]
+                    )
+                    for key in evicted:
+                        del copies[key]
+                local_copies = dict(
+                    [(self.get_s3_key(key), copies.get(key)) for key in keys]
+                )
+                self.store.prefetch(
+                    list(local_copies.keys()), local_copies=local_copies
+                )
+            else:
+                self.store.prefetch([self.get_s3_key(key) for key in keys])
+
+    def flush(self):
+
+        """
+        Waits for any background uploads to S3 to finish, and writes the reads that are buffered in the index (see
+        `CacheIndex.flush_reads`).
+        """
+
+        if self.use_s3:
+            self.store.flush()
+        self.index.flush_reads(wait=True)
+
+    def _get_local_filepath(self, key):
+
+        return os.path.join(self.local_path, "{}.pkl".format(key))
+
+    def _get_local_copy(self, key):
+
+        local_copy = self.index.get_local_copy(self.path, key)
+        if local_copy and not os.path.exists(self._get_local_filepath(key)):
+            self.index.remove_local_copies([(self.path, key)])
+            local_copy = None
+        return local_copy
+
+    def _save_local_copy(self, key, serialized, etag):
+
+        if len(serialized) > self.local_tier_max_bytes:
+            # Saving it would only evict the whole tier, including the object itself, so it's read from S3 instead
+            if os.path.exists(self._get_local_filepath(key)):
+                self._delete_local_copy(key)
+            return
+        if not os.path.exists(self.local_path):
+            os.makedirs(self.local_path, exist_ok=True)
+        filepath = self._get_local_filepath(key)
+        # Write to a temporary file first, so that other processes never read a partial copy
+        temp_filepath = "{}.{}.tmp".format(filepath, os.getpid())
+        with open(temp_filepath, "wb") as output:
+            output.write(serialized)
+        os.replace(temp_filepath, filepath)
+        total = self.index.record_local_copy(self.path, key, etag, len(serialized))
+        if total > self.local_tier_max_bytes:
+            evict_local_copies(self.local_tier_max_bytes)
+
+    def _read_s3(self, key):
+
+        s3_key = self.get_s3_key(key)
+        if not self.local_tier_max_bytes:
+            serialized = self.store.get(s3_key)
+            self.stats["s3_hits" if serialized is not None else "s3_misses"] += 1
+            return serialized
+
+        local_copy = self._get_local_copy(key)
+        serialized, etag = self.store.get_validated(s3_key, local_copy)
+        if serialized is S3Store.NOT_MODIFIED:
+            try:
+                with open(self._get_local_filepath(key), "rb") as infile:
+                    serialized = infile.read()
+            except (IOError, OSError):
+                # The copy was evicted by another process after it was validated
+                serialized, etag = self.store.get_validated(s3_key)
+            else:
+                self.stats["local_hits"] += 1
+                self.index.record_local_read(self.path, key)
+                return serialized
+        self.stats["local_stale" if local_copy else "local_misses"] += 1
+        if serialized is None:
+            self.stats["s3_misses"] += 1
+            if local_copy:
+                self._delete_local_copy(key)
+        else:
+            self.stats["s3_hits"] += 1
+            self._save_local_copy(key, serialized, etag)
+        return serialized
+
+    def _delete_local_copy(self, key):
+
+        try:
+            os.remove(self._get_local_filepath(key))
+        except (IOError, OSError):
+            pass
+        self.index.remove_local_copies([(self.path, key)])
+
+    def read(self, key, fingerprint=None):
+
+        """
+        Reads a key from the cache.
+
+        :param key: The cache key
+        :param fingerprint: (Optional) if the data was cached with a different fingerprint, it's treated as a miss
+        :return: The cached data, or None if it isn't cached
+        """
+
+        data = None
+        exists = self.contains(key)
+        if exists is not False:
+            entry = None
+            if fingerprint is not None:
+                entry = self.index.get_entry(self.path, key)
+            if not entry or entry["fingerprint"] == fingerprint:
+                if self.use_s3:
+                    data = self._read_s3(key)
+                    data = pickle.loads(data) if data is not None else None
+                else:
+                    data = self.handler.read(key)
+                if data is None and exists:
+                    # The file was deleted outside of the index
+                    self.index.remove(self.command_name, [(self.path, key)])
+        self.index.record_read(self.command_name, self.path, key, data is not None)
+        return data
+
+    def write(self, key, data, fingerprint=None, parameters=None):
+
+        """
+        Writes data to the cache, evicting older files if it pushes the cache over its `max_bytes` policy.
+
+        :param key: The cache key
+        :param data: The data to cache
+        :param fingerprint: (Optional) a string identifying the source of the data
+        :param parameters: (Optional) a dictionary of the command parameters that the data was cached for, which can \
+        be used to invalidate it later (see `invalidate`)
+        """
+
+        if self.use_s3:
+            serialized = pickle.dumps(data)
+            size = len(serialized)
+            if self.write_behind:
+                self.store.write_behind(self.get_s3_key(key), serialized)
+            else:
+                self.store.put(self.get_s3_key(key), serialized)
+            if self.local_tier_max_bytes:
+                self._save_local_copy(key, serialized, get_etag(serialized))
+        else:
+            self.handler.write(key, data)
+            filepath = os.path.join(self.path, "{}.pkl".format(key))
+            if os.path.exists(filepath):
+                size = os.path.getsize(filepath)
+            else:
+                size = len(pickle.dumps(data))
+        total = self.index.record_write(
+            self.command_name,
+            self.path,
+            key,
+            size,
+            fingerprint=fingerprint,
+            parameters=parameters,
+        )
+        policy = get_cache_policy(self.command_name) or {}
+        if policy.get("max_bytes") and total > policy["max_bytes"]:
+            evict(self.command_name, max_bytes=policy["max_bytes"])
+
+    def delete(self, key):
+
+        """
+        Deletes a cached file, if it exists.
+
+        :param key: The cache key
+        """
+
+        if self.use_s3:
+            self.store.delete(self.get_s3_key(key))
+            if self.local_tier_max_bytes:
+                self._delete_local_copy(key)
+        else:
+            try:
+                self.file_handler.clear_file(key, format="pkl")
+            except (IOError, OSError):
+                pass
+
+
+def _delete_entries(command_name, entries):
+
+    """
+    Deletes cached files and removes them from the index.
+
+    :param command_name: The name of the command
+    :param entries: A list of entry dictionaries (see `CacheIndex.find_entries`)
+    """
+
+    handlers = {}
+    for entry in entries:
+        if entry["folder"] not in handlers:
+            handlers[entry["folder"]] = CommandCache(
+                command_name,
+                entry["folder"],
+                use_s3=settings.DJANGO_COMMANDER_USE_S3,
+                bucket=settings.S3_BUCKET,
+            )
+        handlers[entry["folder"]].delete(entry["key"])
+    get_cache_index().remove(
+        command_name, [(entry["folder"], entry["key"]) for entry in entries]
+    )
+
+
+def evict(command_name, max_bytes=None, max_age_days=None, chunk_size=1000):
+
+    """
+    Deletes expired cache files for a command, using the index rather than walking its cache folder.
+
+    :param command_name: The name of the command
+    :param max_bytes: (Optional) deletes the least recently used files until the cache is no larger than this
+    :param max_age_days: (Optional) deletes files that were created more than this many days ago
+    :param chunk_size: The number of files to delete at a time
+    :return: A dictionary with the number of `entries` and `bytes` that were deleted
+    """
+
+    index = get_cache_index()
+    deleted = {"entries": 0, "bytes": 0}
+    if max_age_days is not None:
+        cutoff = time.time() - datetime.timedelta(days=max_age_days).total_seconds()
+        while True:
+            entries = index.find_entries(
+                command_name, order_by="created_at", before=cutoff, limit=chunk_size
+            )
+            if not entries:
+                break
+            _delete_entries(command_name, entries)
+            deleted["entries"] += len(entries)
+            deleted["bytes"] += sum([e["size"] for e in entries])
+    if max_bytes is not None:
+        totals = index.get_totals(command_name).get(command_name, {"bytes": 0})
+        excess = totals["bytes"] - max_bytes
+        while excess > 0:
+            entries = []
+            for entry in index.find_entries(
+                command_name, order_by="accessed_at", limit=chunk_size
+            ):
+                if excess <= 0:
+                    break
+                entries.append(entry)
+                excess -= entry["size"]
+            if not entries:
+                break
+            _delete_entries(command_name, entries)
+            deleted["entries"] += len(entries)
+            deleted["bytes"] += sum([e["size"] for e in entries])
+
+    return deleted
+
+
+def evict_local_copies(max_bytes, chunk_size=1000):
+
+    """
+    Deletes the least recently used copies from the local disk tier in front of the S3 caches (see `CommandCache`)
+    until it's no larger than `max_bytes`.
+
+    :param max_bytes: The maximum total size of the local disk tier
+    :param chunk_size: The number of copies to look up at a time
+    :return: The number of copies that were deleted
+    """
+
+    index = get_cache_index()
+    excess = index.get_local_copy_total() - max_bytes
+    deleted = 0
+    while excess > 0:
+        entries = []
+        for folder, key, size in index.find_local_copies(limit=chunk_size):
+            if excess <= 0:
+                break
+            try:
+                os.remove(
+                    os.path.join(get_local_tier_path(folder), "{}.pkl".format(key))
+                )
+            except (IOError, OSError):
+                pass
+            entries.append((folder, key))
+            excess -= size
+        if not entries:
+            break
+        index.remove_local_copies(entries)
+        deleted += len(entries)
+
+    return deleted
+
+
+def collect_garbage(command_names=None):
+
+    """
+    Applies each command's cache policy (see `get_cache_policy`).
+
+    :param command_names: (Optional) a list of command names; defaults to every command in the cache index
+    :return: A dictionary mapping command names to the results from `evict`
+    """
+
+    if command_names is None:
+        command_names = list(get_cache_index().get_totals().keys())
+
+    results = {}
+    for command_name in command_names:
+        policy = get_cache_policy(command_name)
+        if policy:
+            results[command_name] = evict(
+                command_name,
+                max_bytes=policy.get("max_bytes"),
+                max_age_days=policy.get("max_age_days"),
+            )
+
+    return results
+
+
+def invalidate(
+    command_name, prefix=None, older_than_days=None, parameters=None, chunk_size=1000
+):
+
+    """
+    Deletes a targeted set of a command's cache files, found using the index. With no filters, every indexed file is
+    deleted.
+
+    :param command_name: The name of the command
+    :param prefix: (Optional) only deletes files whose keys start with this string
+    :param older_than_days: (Optional) only deletes files that were created more than this many days ago
+    :param parameters: (Optional) only deletes files that were cached for these parameter values
+    :param chunk_size: The number of files to delete at a time
+    :return: The number of files that were deleted
+    """
+
+    index = get_cache_index()
+    before = None
+    if older_than_days is not None:
+        before = time.time() - datetime.timedelta(days=older_than_days).total_seconds()
+    deleted = 0
+    while True:
+        entries = index.find_entries(
+            command_name,
+            prefix=prefix,
+            before=before,
+            parameters=parameters,
+            order_by="created_at",
+            limit=chunk_size,
+        )
+        if not entries:
+            break
+        _delete_entries(command_name, entries)
+        deleted += len(entries)
+
+    return deleted
+
+
+def purge(command_name):
+
+    """
+    Deletes all of a command's indexed cache files.
+
+    :param command_name: The name of the command
+    :return: The number of files that were deleted
+    """
+
+    return invalidate(command_name)
+
+
+def list_entries(command_name, prefix=None, parameters=None):
+
+    """
+    Lists a command's cached files from the index, oldest first, without touching the cache folder. Useful for
+    warming up a cache or checking what a run would be able to reuse.
+
+    :param command_name: The name of the command
+    :param prefix: (Optional) only lists files whose keys start with this string
+    :param parameters: (Optional) only lists files that were cached for these parameter values
+    :return: A list of entry dictionaries (see `CacheIndex.find_entries`)
+    """
+
+    return get_cache_index().find_entries(
+        command_name, prefix=prefix, parameters=parameters, order_by="created_at"
+    )
+
+
+def index_existing_files(command_name, path):
+
+    """
+    Adds files that were cached before the index existed (or outside of `CommandCache`) to the index. This is the only
+    operation that has to walk a cache folder, and only needs to be run once. Only local folders can be indexed.
+
+    :param command_name: The name of the command
+    :param path: The command's cache folder
+    :return: The number of files that were indexed
+    """
+
+    indexed = 0
+    index = get_cache_index()
+    if os.path.isdir(path):
+        for entry in os.scandir(path):
+            if entry.is_file() and entry.name.endswith(".pkl"):
+                key = entry.name[: -len(".pkl")]
+                stat = entry.stat()
+                index.record_write(
+                    command_name,
+                    path,
+                    key,
+                    stat.st_size,
+                    created_at=stat.st_mtime,
+                )
+                indexed += 1
+        # Only a folder that was actually scanned is known to be fully indexed; an S3 prefix never is
+        index.mark_complete(path)
+
+    return indexed
@@ -4,24 +4,54 @@ from builtins import input
 from builtins import str
 from builtins import object
 
+import collections
+import contextlib
+import itertools
 import os
 import re
+import time
+import zlib
 
-from multiprocessing import Pool
 from argparse import ArgumentParser
 from difflib import SequenceMatcher
 
 from django.conf import settings
+from django.utils import timezone
 
-from django_pewtils import CacheHandler, get_app_settings_folders
+from django_pewtils import get_app_settings_folders
 from pewtils import is_not_null, extract_attributes_from_folder_modules, classproperty
 
-from django_commander.models import Command, CommandLog
+from django_commander.cache import CommandCache
+from django_commander.memory import MemoryGovernor, get_max_tasks_per_child
+from django_commander.models import (
+    Command,
+    CommandLog,
+    CommandStats,
+    get_error_class_name,
+)
+from django_commander.payloads import SpooledPayload, spool_payload
+from django_commander.ratelimit import RateLimiter
+from django_commander.retries import CircuitBreaker
+from django_commander.tracing import start_span
 from django_commander.utils import (
+    InvalidArgumentException,
     MissingDependencyException,
     cache_results,
     log_command,
     command_multiprocess_wrapper,
+    command_multiprocess_batch_wrapper,
+    command_multiprocess_download_wrapper,
+    command_multiprocess_download_batch_wrapper,
+    compile_parser_from_function,
+    create_worker_pool,
+    get_auto_num_cores,
+    get_worker_command,
+    declares_arguments,
+    iterate_in_batches,
+    parse_num_cores,
+    parse_shard,
+    PoolThrottle,
+    WorkerResult,
 )
 
 
@@ -30,6 +60,39 @@ class BasicCommand(object):
     The base `django_commander` command class.
     """
 
+    # How items are assigned to shards when the command is run with `--shard i/N`: "hash" assigns each item based on
+    # a hash of `get_shard_key`, and "round_robin" assigns items based on the order in which they're yielded
+    shard_by = "hash"
+
+    # If set, the pipeline command classes pass the items yielded by `iterate` to `parse_and_save_batch` in lists of
+    # this size, rather than passing them to `parse_and_save` one at a time (this can also be set with `--batch_size`)
+    batch_size = None
+
+    # An optional `RetryPolicy` for `download` calls, and the number of consecutive download failures after which the
+    # command pauses for `circuit_breaker_cooldown` seconds (see `CircuitBreaker`)
+    download_retry_policy = None
+    circuit_breaker_threshold = None
+    circuit_breaker_cooldown = 60
+
+    # The maximum number of `download` calls per second, shared by all of the processes running the command on this
+    # machine (see `RateLimiter` and `get_rate_limit_key`), and the number of calls that can be made in a burst
+    download_rate_limit = None
+    download_rate_limit_burst = None
+
+    # If True, items whose download still fails after any retries are recorded in the log's metrics and skipped, rather
+    # than aborting the whole run
+    skip_failed_items = False
+
+    # If True (or if the `DJANGO_COMMANDER_COUNT_QUERIES` setting is enabled), `log_command` counts and times the
+    # command's database queries in each stage of the run (see `stage`) and saves them to the log's "queries" metric.
+    # If `max_queries` is set, queries are always counted, and runs that exceed it raise `QueryLimitExceeded`
+    count_queries = False
+    max_queries = None
+
+    # A version string for the data returned by `download`; bumping it makes previously cached results stale, so
+    # they're downloaded again (see `get_cache_fingerprint`)
+    cache_version = None
+
     @classproperty
     def name(cls):
 
@@ -64,12 +127,89 @@ class BasicCommand(object):
         if not parser:
             parser = ArgumentParser()
         if hasattr(cls, "add_arguments"):
-            parser = cls.add_arguments(parser)
+            if declares_arguments(cls.add_arguments):
+                parser = compile_parser_from_function(parser, cls.add_arguments)
+            else:
+                parser = cls.add_arguments(parser)
+        elif declares_arguments(cls.run):
+            parser = compile_parser_from_function(parser, cls.run)
         parser.add_argument("--ignore_dependencies", action="store_true", default=False)
         parser.add_argument("--test", action="store_true", default=False)
 
         return parser
 
+    @classmethod
+    def get_parser_actions(cls):
+
+        """
+        Builds the command's argument parser once per class and caches its actions, keyed by destination.
+
+        :return: A dictionary mapping argument names to their argparse actions
+        """
+
+        if "_parser_actions" not in cls.__dict__:
+            cls._parser_actions = {
+                action.dest: action
+                for action in cls.create_or_modify_parser()._actions
+                if action.dest != "help"
+            }
+        return cls._parser_actions
+
+    def _merge_arguments(self, values, parameters=True):
+
+        """
+        Fills in the parser defaults for any arguments that weren't passed to the command, and converts and validates
+        the ones that were passed as strings, without round-tripping them through the parser.
+
+        :param values: The parameters or options that were passed to the command
+        :param parameters: Whether the values are parameters (True) or options (False)
+        :return: The merged values
+        """
+
+        values = dict(values)
+        missing = []
+        for dest, action in self.get_parser_actions().items():
+            if (dest in self.parameter_names) != parameters:
+                continue
+            if dest not in values:
+                if action.required:
+                    missing.append(dest)
+                else:
+                    values[dest] = action.default
+                continue
+            many = action.nargs in ["*", "+"] or isinstance(action.nargs, int)
+            value = values[dest]
+            if many and isinstance(value, str):
+                value = [value]
+            items = value if many and isinstance(value, (list, tuple)) else [value]
+            converted = []
+            for item in items:
+                if isinstance(item, str) and action.type not in [None, str]:
+                    try:
+                        item = action.type(item)
+                    except (TypeError, ValueError, KeyError) as e:
+                        raise InvalidArgumentException(
+                            "Invalid value for argument '{}' of command '{}': {}".format(
+                                dest, self.name, e
+                            )
+                        )
+                if action.choices is not None and item not in action.choices:
+                    raise InvalidArgumentException(
+                        "Invalid value for argument '{}' of command '{}': {} (choose from {})".format(
+                            dest, self.name, item, list(action.choices)
+                        )
+                    )
+                converted.append(item)
+            values[dest] = converted if many and isinstance(value, (list, tuple)) else converted[0]
+        if missing:
+            raise InvalidArgumentException(
+                "Missing required parameters for command '{}': {}".format(
+                    self.name, ", ".join(missing)
+                )
+            )
+
+        return values
+
     def __init__(self, **options):
 
         """
@@ -99,68 +239,50 @@ class BasicCommand(object):
             self.options.update(self.test_options)
 
         if not dispatched:
-
-            command_string = [self.parameters[p] for p in self.parameter_names]
-            for k, v in list(self.options.items()):
-                if type(v) != bool:
-                    command_string.extend(["--{}".format(k), str(v)])
-                elif v == True:
-                    command_string.append("--{}".format(k))
-            parser = self.create_or_modify_parser()
-
-            skip = False
-            try:
-                parsed = parser.parse_args(command_string)
-            except (SystemExit, TypeError):
-                try:
-                    parsed = parser.parse_known_args()[0]
-                    print(
-                        "Unable to parse arguments, using defaults and whatever was passed in manually to the "
-                        "function, if applicable"
-                    )
-                except SystemExit:
-                    print(
-                        "Unable to parse arguments, using defaults and whatever was passed in manually to the "
-                        "function, if applicable"
-                    )
-                    skip = True
-                except Exception as e:
-                    print("UNKNOWN ERROR: {}".format(e))
-                    print(
-                        "Unable to parse arguments, using defaults and whatever was passed in manually to the "
-                        "function, if applicable"
-                    )
-                    skip = True
-            except Exception as e:
-                print("UNKNOWN ERROR: {}".format(e))
-                print(
-                    "Unable to parse arguments, using defaults and whatever was passed in manually to the "
-                    "function, if applicable"
-                )
-                skip = True
-            if not skip:
-                for k, v in list(vars(parsed).items()):
-                    if k in self.parameter_names and k not in list(
-                        self.parameters.keys()
-                    ):
-                        self.parameters[k] = v
-                    elif k not in self.parameter_names and k not in list(
-                        self.options.keys()
-                    ):
-                        self.options[k] = v
+            self.parameters = self._merge_arguments(self.parameters, parameters=True)
+            self.options = self._merge_arguments(self.options, parameters=False)
+        if self.options.get("num_cores") == "auto":
+            self.options["num_cores"] = get_auto_num_cores()
 
         self.log = None
+        self.metrics = {}
+        self._metrics_flushed_at = time.time()
+        self._heartbeat = None
+        self.cache_hit = False
+        self.current_stage = "run"
+        self._query_counter = None
+        self.is_worker = False
+        self.worker_outcome = None
+        self._worker_outcomes = collections.deque()
+        self._throttle = None
+        self._memory_governor = MemoryGovernor(
+            ceiling=settings.DJANGO_COMMANDER_MEMORY_CEILING
+        )
+        if self.circuit_breaker_threshold:
+            self._circuit_breaker = CircuitBreaker(
+                failure_threshold=self.circuit_breaker_threshold,
+                cooldown=self.circuit_breaker_cooldown,
+            )
+        else:
+            self._circuit_breaker = None
+        if self.download_rate_limit:
+            self._rate_limiter = RateLimiter(
+                self.download_rate_limit, capacity=self.download_rate_limit_burst
+            )
+        else:
+            self._rate_limiter = None
         self.check_dependencies(dispatched=dispatched)
 
         if self.options["test"]:
             path = os.path.join(settings.DJANGO_COMMANDER_CACHE_PATH, self.name, "test")
         else:
             path = os.path.join(settings.DJANGO_COMMANDER_CACHE_PATH, self.name)
-        self.cache = CacheHandler(
+        self.cache = CommandCache(
+            self.name,
             path,
-            hash=False,
             use_s3=settings.DJANGO_COMMANDER_USE_S3,
             bucket=settings.S3_BUCKET,
+            write_behind=settings.DJANGO_COMMANDER_S3_WRITE_BEHIND,
         )
 
     def check_dependencies(self, dispatched=False):
@@ -177,21 +299,26 @@ class BasicCommand(object):
         if hasattr(self, "dependencies"):
             missing = []
             for d, params in self.dependencies:
-                logs = (
-                    CommandLog.objects.filter(command__name=d)
-                    .filter(end_time__isnull=False)
-                    .filter(error__isnull=True)
-                )
+                dependency_commands = Command.objects.filter(name=d)
                 for p in params:
                     if type(params[p]) == type(lambda x: x):
                         params[p] = params[p](self)
                     else:
                         params[p] = str(params[p])
-                    logs = logs.filter(
-                        command__parameters__regex=r"[\"']?%s[\"']?\: [\"']?%s[\"']?"
+                    dependency_commands = dependency_commands.filter(
+                        parameters__regex=r"[\"']?%s[\"']?\: [\"']?%s[\"']?"
                         % (p, params[p])
                     )
-                if logs.count() == 0:
+                # The stats rollup answers this without touching the logs; fall back to the logs in case the rollup
+                # hasn't been refreshed for the dependency yet
+                if not dependency_commands.filter(
+                    stats__success_count__gt=0
+                ).exists() and not (
+                    CommandLog.objects.filter(command__in=dependency_commands)
+                    .filter(end_time__isnull=False)
+                    .filter(error_class__isnull=True)
+                    .exists()
+                ):
                     missing.append((d, params))
             if len(missing) > 0 and not self.options["ignore_dependencies"]:
                 if dispatched:
@@ -217,6 +344,544 @@ class BasicCommand(object):
                         "Missing dependencies: %s" % str(missing)
                     )
 
+    def increment_metric(self, name, value=1):
+
+        """
+        Increments a metric on the command's current log. Metrics are saved to the log when the command finishes, and
+        periodically while it runs (see `flush_metrics`).
+
+        :param name: The name of the metric
+        :param value: The amount to increment it by
+        """
+
+        self.metrics[name] = self.metrics.get(name, 0) + value
+
+    def flush_metrics(self, force=False):
+
+        """
+        Saves the command's metrics to its log, if at least `DJANGO_COMMANDER_METRICS_FLUSH_INTERVAL` seconds have
+        passed since they were last saved, so that progress can be monitored while the command is running.
+
+        :param force: If True, saves the metrics regardless of when they were last saved
+        """
+
+        if self.log and (
+            force
+            or time.time() - self._metrics_flushed_at
+            >= settings.DJANGO_COMMANDER_METRICS_FLUSH_INTERVAL
+        ):
+            if getattr(self, "_throttle", None):
+                self.metrics.update(self._throttle.get_metrics())
+            CommandLog.objects.filter(pk=self.log_id).update(
+                metrics=self.metrics, metrics_updated_at=timezone.now()
+            )
+            self._metrics_flushed_at = time.time()
+
+    def check_memory(self, force=False):
+
+        """
+        Measures the memory used by the command and its workers (at most once a second, unless `force` is set) and
+        saves the high-water marks to its metrics. If `DJANGO_COMMANDER_MEMORY_CEILING` is set and the command is
+        getting close to it, this blocks until the pool's workers have caught up (see `MemoryGovernor`), so calling
+        it between items keeps `iterate` from running ahead.
+
+        :param force: If True, measures memory regardless of when it was last measured
+        """
+
+        if self._memory_governor.check(throttle=self._throttle, force=force):
+            self.metrics.update(self._memory_governor.get_metrics())
+
+    @contextlib.contextmanager
+    def stage(self, name):
+
+        """
+        Marks a stage of the command's run (like "download", "parse_and_save" or "cleanup"), so that the database
+        queries run during it are reported separately (see `count_queries`) and, if tracing is enabled, it's recorded as
+        a span (see `django_commander.tracing`). Stages can be nested, and the previous stage is restored when the block
+        exits.
+
+        :param name: The name of the stage
+        """
+
+        previous = self.current_stage
+        self.current_stage = name
+        if self._query_counter:
+            self._query_counter.stage = name
+        try:
+            with start_span(name, command=self.name):
+                yield
+        finally:
+            self.current_stage = previous
+            if self._query_counter:
+                self._query_counter.stage = previous
+
+    def get_shard_key(self, *args):
+
+        """
+        Returns the value used to assign an item yielded by `iterate` to a shard when `shard_by = "hash"`. Override
+        this if the string representation of the yielded values isn't stable across processes.
+
+        :param args: The values yielded by `iterate`
+        :return: A value whose `repr` identifies the item
+        """
+
+        return args
+
+    def iterate_shard(self, items):
+
+        """
+        Filters the items yielded by `iterate` down to the ones that belong to this command's shard (if it's being run
+        with `--shard i/N`), and counts the items that get processed. The time spent waiting on `iterate` for each item
+        is attributed to the "iterate" stage.
+
+        :param items: An iterable of lists of arguments
+        :return: Yields the lists of arguments that belong to this shard
+        """
+
+        shard = self.options.get("shard")
+        items = iter(items)
+        i = -1
+        while True:
+            with self.stage("iterate"):
+                try:
+                    iargs = next(items)
+                except StopIteration:
+                    return
+            i += 1
+            if shard:
+                index, num_shards = shard
+                if self.shard_by == "round_robin":
+                    key = i
+                else:
+                    key = zlib.crc32(repr(self.get_shard_key(*iargs)).encode("utf8"))
+                if key % num_shards != index:
+                    continue
+            yield iargs
+            self.increment_metric("items")
+            self.check_memory()
+            self.flush_metrics()
+
+    def get_cache_key(self, func_name, *args):
+
+        """
+        :param func_name: The name of the function whose results are being cached (i.e. "download")
+        :param args: The arguments being passed to the function
+        :return: The key that `cache_results` stores the function's results under
+        """
+
+        return (
+            str(self.__class__.name)
+            + str(func_name)
+            + str(args)
+            + str(self.parameters)
+        )
+
+    def prefetch_downloads(self, items):
+
+        """
+        Wraps the items yielded by `iterate` (or a batch of them) and starts fetching the cached `download` results for
+        the next `DJANGO_COMMANDER_S3_PREFETCH` items from S3 in the background, so that the command doesn't wait on a
+        round trip for each item. The items are read ahead and prefetched in batches. Items are passed through
+        unchanged if the cache is local, `download` isn't wrapped with `cache_results`, or the cache is being refreshed.
+
+        :param items: An iterable of lists of arguments for `download`
+        :return: Yields the same lists of arguments
+        """
+
+        window = settings.DJANGO_COMMANDER_S3_PREFETCH
+        if (
+            not window
+            or not self.cache.use_s3
+            or not getattr(self.download, "cached", False)
+            or self.options.get("refresh_cache")
+            or self.options.get("test")
+        ):
+            for iargs in items:
+                yield iargs
+        else:
+            # The window is topped up once half of it has been used, so that the keys are looked up in batches
+            items = iter(items)
+            upcoming = collections.deque()
+            refill = max(1, window // 2)
+            while True:
+                if window - len(upcoming) >= refill:
+                    batch = list(itertools.islice(items, window - len(upcoming)))
+                    if batch:
+                        self.cache.prefetch(
+                            [self.get_cache_key("download", *iargs) for iargs in batch]
+                        )
+                        upcoming.extend(batch)
+                if not upcoming:
+                    break
+                yield upcoming.popleft()
+
+    def flush_cache(self):
+
+        """
+        Waits for any background cache uploads to finish and records the command's S3 transfer counts and the hits and
+        misses for each cache tier in its metrics. The pipeline classes call this before `cleanup`.
+        """
+
+        with start_span("cache.flush", command=self.name):
+            self.cache.flush()
+        for name, value in self.cache.stats.items():
+            self.metrics["cache_{}".format(name)] = value
+        if self.cache.use_s3:
+            for name, value in self.cache.store.stats.items():
+                self.metrics["s3_{}".format(name)] = value
+
+    def get_cache_fingerprint(self, *args):
+
+        """
+        Returns a string identifying the source of the data that `cache_results` is about to cache for a `download`
+        call. Cached results with a different fingerprint are treated as misses. By default this is the command's
+        `cache_version`; override it to include something like a source file's modification time or an API version.
+
+        :param args: The arguments being passed to `download`
+        :return: A string, or None to accept any cached results
+        """
+
+        return str(self.cache_version) if self.cache_version is not None else None
+
+    def get_rate_limit_key(self, *args):
+
+        """
+        Returns the rate limiter bucket to use for a `download` call when `download_rate_limit` is set. By default,
+        all calls made by the command share a single bucket; override this to limit calls per provider, endpoint, etc.
+
+        :param args: The arguments being passed to `download`
+        :return: A string
+        """
+
+        return self.name
+
+    def download_with_retries(self, *args, **options):
+
+        """
+        Calls `download`, retrying it according to `download_retry_policy` and pausing first if the circuit breaker is
+        open or the rate limit has been reached. Retries, circuit breaker trips and time spent waiting on the rate
+        limiter are recorded in the log's metrics.
+
+        :param args: Passed to `download`
+        :param options: Passed to `download`
+        :return: The value returned by `download`
+        """
+
+        breaker = self._circuit_breaker
+        attempt = 0
+        while True:
+            attempt += 1
+            if breaker:
+                breaker.wait()
+            if self._rate_limiter:
+                waited = self._rate_limiter.acquire(key=self.get_rate_limit_key(*args))
+                if waited:
+                    self.increment_metric("rate_limit_wait_seconds", waited)
+            try:
+                with self.stage("download"):
+                    result = self.download(*args, **options)
+            except Exception as e:
+                self.record_download_result(False)
+                policy = self.download_retry_policy
+                if not policy or not policy.should_retry(e, attempt):
+                    raise
+                self.increment_metric("download_retries")
+                time.sleep(policy.get_delay(attempt))
+            else:
+                self.record_download_result(True)
+                return result
+
+    def record_download_result(self, succeeded, count=1):
+
+        """
+        Updates the circuit breaker with the result of one or more `download` attempts. In a worker, the results are
+        recorded in its metrics instead (see `pop_worker_metrics`), so that the parent's breaker can be updated from
+        every worker's results.
+
+        :param succeeded: Whether the attempts succeeded
+        :param count: The number of attempts
+        """
+
+        if self.is_worker:
+            if succeeded:
+                self.metrics["download_failure_streak"] = 0
+                self.increment_metric("download_successes", count)
+            else:
+                self.increment_metric("download_failure_streak", count)
+            return
+        breaker = self._circuit_breaker
+        if breaker:
+            trips = breaker.trips
+            for i in range(count):
+                if succeeded:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+            if breaker.trips > trips:
+                self.increment_metric("circuit_breaker_trips", breaker.trips - trips)
+
+    def pop_worker_metrics(self):
+
+        """
+        Collects the metrics that a worker has recorded for the items it downloaded (failures, retries, cache hits,
+        etc.), along with its cache's transfer counts, and resets them, so that they can be sent back to the parent
+        with the task's result rather than being lost when the worker's command instance is discarded.
+
+        :return: A dictionary of `metrics`, `cache_stats` and `s3_stats`
+        """
+
+        outcome = {"metrics": self.metrics, "cache_stats": dict(self.cache.stats)}
+        if self.cache.use_s3:
+            outcome["s3_stats"] = dict(self.cache.store.stats)
+            self.cache.store.stats.clear()
+        self.metrics = {}
+        self.cache.stats.clear()
+        return outcome
+
+    def merge_worker_metrics(self, outcome):
+
+        """
+        Adds the metrics returned by a worker (see `pop_worker_metrics`) to the command's own metrics and cache stats,
+        and updates the command's circuit breaker with the worker's download results.
+
+        :param outcome: A dictionary returned by `pop_worker_metrics`
+        """
+
+        metrics = dict(outcome["metrics"])
+        if metrics.get("download_successes"):
+            self.record_download_result(True)
+        streak = metrics.pop("download_failure_streak", 0)
+        if streak:
+            self.record_download_result(False, count=streak)
+        metrics.pop("download_successes", None)
+        for name, value in metrics.items():
+            if name == "item_errors":
+                errors = self.metrics.setdefault("item_errors", [])
+                limit = settings.DJANGO_COMMANDER_MAX_ITEM_ERRORS
+                errors.extend(value[: max(0, limit - len(errors))])
+            elif isinstance(value, (int, float)):
+                self.increment_metric(name, value)
+            else:
+                self.metrics[name] = value
+        self.cache.stats.update(outcome["cache_stats"])
+        if self.cache.use_s3 and outcome.get("s3_stats"):
+            self.cache.store.stats.update(outcome["s3_stats"])
+
+    def download_item(self, *args, **options):
+
+        """
+        Downloads the data for one of the items yielded by `iterate` with `download_with_retries`. If the download
+        still fails and `skip_failed_items` is enabled, the failure is recorded (see `record_item_failure`) and the
+        item is skipped.
+
+        :param args: The values yielded by `iterate`
+        :param options: Passed to `download`
+        :return: The values returned by `download`, or an empty list if the item was skipped
+        """
+
+        try:
+            return self.download_with_retries(*args, **options)
+        except Exception as e:
+            if not self.skip_failed_items:
+                raise
+            self.record_item_failure(args, e)
+            return []
+
+    def record_item_failure(self, args, exception):
+
+        """
+        Counts a failed item in the log's `failed_items` metric, and saves a summary of the error in `item_errors`
+        (up to `DJANGO_COMMANDER_MAX_ITEM_ERRORS` of them).
+
+        :param args: The values yielded by `iterate` for the item
+        :param exception: The exception that was raised
+        """
+
+        self.increment_metric("failed_items")
+        errors = self.metrics.setdefault("item_errors", [])
+        if len(errors) < settings.DJANGO_COMMANDER_MAX_ITEM_ERRORS:
+            errors.append(
+                {
+                    "item": repr(list(args))[:200],
+                    "error_class": get_error_class_name(exception),
+                    "error_message": str(exception),
+                }
+            )
+
+    def get_batch_size(self):
+
+        """
+        :return: The batch size passed with `--batch_size`, or the class's `batch_size` (None if batching is disabled)
+        """
+
+        return self.options.get("batch_size") or self.batch_size
+
+    def parse_and_save_batch(self, batch):
+
+        """
+        Processes a batch of items when batching is enabled (see `batch_size`). By default, this just passes each item
+        to `parse_and_save`, but it can be overridden to process the whole batch at once (e.g. with a single query for
+        all of the existing objects and a single bulk insert).
+
+        :param batch: A list of lists of arguments, each of which would otherwise be passed to `parse_and_save`
+        :return: A list of the values returned by `parse_and_save`
+        """
+
+        return [self.parse_and_save(*args) for args in batch]
+
+    def start_pool(self):
+
+        """
+        Creates the multiprocessing pool for a multiprocessed command. When the command is running on a single core,
+        no pool is created, and items are processed inline by `apply_in_pool` instead.
+
+        Workers are replaced with fresh processes after `DJANGO_COMMANDER_WORKER_MAX_TASKS` tasks. If that's "auto"
+        (the default), the limit is estimated from how quickly the workers' memory grew during the command's previous
+        run (see `get_max_tasks_per_child`), and workers are only recycled if they'd otherwise outgrow their share of
+        `DJANGO_COMMANDER_MEMORY_CEILING` or `DJANGO_COMMANDER_WORKER_MEMORY`.
+
+        :return: A `multiprocessing.Pool`, or None if the command is running on a single core
+        """
+
+        self._inline_worker = None
+        self._throttle = None
+        self._worker_outcomes = collections.deque()
+        if self.options["num_cores"] == 1:
+            return None
+        self._throttle = PoolThrottle(
+            self.options["num_cores"], autoscale=self.options.get("autoscale", False)
+        )
+        max_tasks = settings.DJANGO_COMMANDER_WORKER_MAX_TASKS
+        if max_tasks == "auto":
+            last_metrics = None
+            if getattr(self, "command", None):
+                last_metrics = (
+                    CommandStats.objects.filter(command=self.command)
+                    .values_list("last_metrics", flat=True)
+                    .first()
+                )
+            max_tasks = get_max_tasks_per_child(
+                self.options["num_cores"],
+                last_metrics or {},
+                ceiling=settings.DJANGO_COMMANDER_MEMORY_CEILING,
+                worker_memory=settings.DJANGO_COMMANDER_WORKER_MEMORY,
+            )
+        if max_tasks:
+            self.metrics["max_tasks_per_child"] = max_tasks
+        return create_worker_pool(
+            self.options["num_cores"], maxtasksperchild=max_tasks
+        )
+
+    def finish_pool(self, pool):
+
+        """
+        Waits for all of the pool's tasks to finish, and saves its throughput and memory metrics, and the metrics sent
+        back by its workers, to the command's log.
+
+        :param pool: The pool returned by `start_pool`
+        """
+
+        if pool is not None:
+            self.check_memory(force=True)
+            pool.close()
+            pool.join()
+            self.metrics.update(self._throttle.get_metrics())
+        self.merge_pending_worker_metrics()
+
+    def apply_in_pool(self, pool, rows, results, download=False):
+
+        """
+        Sends items to a multiprocessing pool to be processed by `parse_and_save` (or `parse_and_save_batch`, if
+        batching is enabled). If the pickled arguments are larger than `DJANGO_COMMANDER_SPOOL_THRESHOLD`, they're
+        written to a file once and the worker maps it into memory, rather than the payload being copied through the
+        pool's pipe; the file is deleted when the task finishes. Smaller payloads are sent in the pickled form that was
+        used to measure them, so they aren't pickled twice. If there's no pool, the items are processed inline
+        by a separate instance of the command, without any pickling.
+
+        When the workers download the items themselves, the metrics they record while downloading are sent back with
+        each task's result and added to this command's metrics (see `merge_worker_metrics`), and the command's circuit
+        breaker is checked before each task is sent.
+
+        :param pool: A `multiprocessing.Pool`, or None
+        :param rows: A list of lists of arguments; unless batching is enabled, this should contain a single item
+        :param results: A list to append the `AsyncResult` to, when running with more than one core
+        :param download: If True, the rows are values yielded by `iterate`, and the worker calls `download` on them \
+        before passing them to `parse_and_save`
+        """
+
+        if self.get_batch_size():
+            if download:
+                wrapper = command_multiprocess_download_batch_wrapper
+            else:
+                wrapper = command_multiprocess_batch_wrapper
+            payload = [list(args) for args in rows]
+            args = [payload]
+        else:
+            if download:
+                wrapper = command_multiprocess_download_wrapper
+            else:
+                wrapper = command_multiprocess_wrapper
+            payload = list(rows[0])
+            args = payload
+
+        if download:
+            self.merge_pending_worker_metrics()
+            if self._circuit_breaker:
+                self._circuit_breaker.wait()
+
+        if pool is None:
+            # The worker instance gets its own log when `parse_and_save` is decorated with `log_command`, so it has to
+            # be separate from this one
+            if not self._inline_worker:
+                self._inline_worker = get_worker_command(
+                    self.name, self.parameters, self.options
+                )
+            method = {
+                command_multiprocess_wrapper: "parse_and_save",
+                command_multiprocess_batch_wrapper: "parse_and_save_batch",
+                command_multiprocess_download_wrapper: "download_and_parse_and_save",
+                command_multiprocess_download_batch_wrapper: "download_and_parse_and_save_batch",
+            }[wrapper]
+            getattr(self._inline_worker, method)(*args)
+            if download:
+                self.merge_worker_metrics(self._inline_worker.worker_outcome)
+            return
+
+        spooled = spool_payload(payload)
+        if isinstance(spooled, SpooledPayload):
+            self.increment_metric("spooled_bytes", spooled.size)
+        if spooled is not payload:
+            args = [spooled]
+
+        started_at = time.time()
+
+        def task_done(result):
+            if isinstance(spooled, SpooledPayload):
+                spooled.unlink()
+            if download and isinstance(result, tuple):
+                # This runs in the pool's result handler thread, so the metrics are merged later by the main thread
+                self._worker_outcomes.append(result[1])
+            self._throttle.task_done(started_at)
+
+        with start_span("pool.wait", command=self.name):
+            self._throttle.wait()
+        result = pool.apply_async(
+            wrapper,
+            args=[self.name, self.parameters, self.options] + args,
+            callback=task_done,
+            error_callback=task_done,
+        )
+        results.append(WorkerResult(result) if download else result)
+
+    def merge_pending_worker_metrics(self):
+
+        """
+        Merges the metrics from the tasks that have finished since this was last called (see `merge_worker_metrics`).
+        """
+
+        while self._worker_outcomes:
+            self.merge_worker_metrics(self._worker_outcomes.popleft())
+
     @log_command
     def run(self):
         """
@@ -261,6 +926,9 @@ class DownloadIterateCommand(BasicCommand):
             parser=parser
         )
         parser.add_argument("--refresh_cache", action="store_true", default=False)
+        parser.add_argument("--shard", type=parse_shard, default=None)
+        parser.add_argument("--run_group", type=str, default=None)
+        parser.add_argument("--batch_size", type=int, default=None)
 
         return parser
 
@@ -296,11 +964,23 @@ class DownloadIterateCommand(BasicCommand):
         :return: None
         """
         self.check_dependencies()
-        dargs = self.download()
-        for iargs in self.iterate(*dargs):
-            if any([is_not_null(a) for a in iargs]):
-                self.parse_and_save(*iargs)
-        self.cleanup()
+        dargs = self.download_with_retries()
+        items = (
+            iargs
+            for iargs in self.iterate_shard(self.iterate(*dargs))
+            if any([is_not_null(a) for a in iargs])
+        )
+        if self.get_batch_size():
+            for batch in iterate_in_batches(items, self.get_batch_size()):
+                with self.stage("parse_and_save"):
+                    self.parse_and_save_batch(batch)
+        else:
+            for iargs in items:
+                with self.stage("parse_and_save"):
+                    self.parse_and_save(*iargs)
+        self.flush_cache()
+        with self.stage("cleanup"):
+            self.cleanup()
 
     def cleanup(self):
 
@@ -344,6 +1024,9 @@ class IterateDownloadCommand(BasicCommand):
             parser=parser
         )
         parser.add_argument("--refresh_cache", action="store_true", default=False)
+        parser.add_argument("--shard", type=parse_shard, default=None)
+        parser.add_argument("--run_group", type=str, default=None)
+        parser.add_argument("--batch_size", type=int, default=None)
 
         return parser
 
@@ -380,18 +1063,58 @@ class IterateDownloadCommand(BasicCommand):
         """
 
         self.check_dependencies()
-        for iargs in self.iterate():
-            dargs = self.download(*iargs)
-            if any([is_not_null(a) for a in dargs]):
+        items = self.prefetch_downloads(self.iterate_shard(self.iterate()))
+        if self.get_batch_size():
+            for batch in iterate_in_batches(items, self.get_batch_size()):
+                downloaded = []
+                for iargs in batch:
+                    dargs = self.download_item(*iargs)
+                    if any([is_not_null(a) for a in dargs]):
+                        downloaded.append((iargs, dargs, self.cache_hit))
+                if not downloaded:
+                    continue
                 try:
-                    self.parse_and_save(*(dargs + iargs))
+                    with self.stage("parse_and_save"):
+                        self.parse_and_save_batch(
+                            [list(d) + list(i) for i, d, _ in downloaded]
+                        )
                 except TypeError:
+                    # As with single items, only the rows loaded from the cache can be outdated, so only they're
+                    # downloaded again before the batch is retried
+                    if not any([cached for _, _, cached in downloaded]):
+                        raise
                     print("Outdated cache, refreshing data")
-                    dargs = self.download(*iargs, **{"refresh_cache": True})
-                    if any([is_not_null(a) for a in dargs]):
-                        self.parse_and_save(*(dargs + iargs))
-
-        self.cleanup()
+                    rows = []
+                    for iargs, dargs, cached in downloaded:
+                        if cached:
+                            dargs = self.download_item(
+                                *iargs, **{"refresh_cache": True}
+                            )
+                        if any([is_not_null(a) for a in dargs]):
+                            rows.append(list(dargs) + list(iargs))
+                    if rows:
+                        with self.stage("parse_and_save"):
+                            self.parse_and_save_batch(rows)
+        else:
+            for iargs in items:
+                dargs = self.download_item(*iargs)
+                if any([is_not_null(a) for a in dargs]):
+                    try:
+                        with self.stage("parse_and_save"):
+                            self.parse_and_save(*(dargs + iargs))
+                    except TypeError:
+                        # Only data loaded from the cache can be outdated; a fresh download would just fail again
+                        if not self.cache_hit:
+                            raise
+                        print("Outdated cache, refreshing data")
+                        dargs = self.download_item(*iargs, **{"refresh_cache": True})
+                        if any([is_not_null(a) for a in dargs]):
+                            with self.stage("parse_and_save"):
+                                self.parse_and_save(*(dargs + iargs))
+
+        self.flush_cache()
+        with self.stage("cleanup"):
+            self.cleanup()
 
     def cleanup(self):
 
@@ -411,8 +1134,14 @@ class MultiprocessedIterateDownloadCommand(BasicCommand):
 
     * Additionally, the `@log_command` decorator must be added to `parse_and_save` to enable logging on these commands.
 
+    * If `download_in_workers` is set (or the command is run with `--download_in_workers`), only the values yielded \
+    by `iterate` are sent to the pool, and each worker calls `download` itself before `parse_and_save`, so downloads \
+    run in parallel and the downloaded data never passes through the parent process.
+
     """
 
+    download_in_workers = False
+
     def __init__(self, **options):
 
         super(MultiprocessedIterateDownloadCommand, self).__init__(**options)
@@ -424,7 +1153,12 @@ class MultiprocessedIterateDownloadCommand(BasicCommand):
             MultiprocessedIterateDownloadCommand, cls
         ).create_or_modify_parser(parser=parser)
         parser.add_argument("--refresh_cache", action="store_true", default=False)
-        parser.add_argument("--num_cores", default=1, type=int)
+        parser.add_argument("--shard", type=parse_shard, default=None)
+        parser.add_argument("--run_group", type=str, default=None)
+        parser.add_argument("--batch_size", type=int, default=None)
+        parser.add_argument("--num_cores", default=1, type=parse_num_cores)
+        parser.add_argument("--autoscale", action="store_true", default=False)
+        parser.add_argument("--download_in_workers", action="store_true", default=False)
 
         return parser
 
@@ -450,31 +1184,72 @@ class MultiprocessedIterateDownloadCommand(BasicCommand):
         """
         raise NotImplementedError
 
+    def download_and_parse_and_save(self, *args):
+
+        """
+        Downloads the data for a single item and passes it to `parse_and_save`; this is what the workers run when
+        `download_in_workers` is enabled. The metrics recorded while downloading are saved to `worker_outcome`, to be
+        returned to the parent along with the result.
+
+        :param args: The values yielded by `iterate`
+        :return: The value returned by `parse_and_save`, or None if nothing was downloaded
+        """
+
+        dargs = self.download_item(*args)
+        self.worker_outcome = self.pop_worker_metrics()
+        if any([is_not_null(a) for a in dargs]):
+            with self.stage("parse_and_save"):
+                return self.parse_and_save(*(list(dargs) + list(args)))
+
+    def download_and_parse_and_save_batch(self, batch):
+
+        """
+        Downloads the data for each item in a batch and passes the results to `parse_and_save_batch`. The metrics
+        recorded while downloading are saved to `worker_outcome`, as with `download_and_parse_and_save`.
+
+        :param batch: A list of lists of values yielded by `iterate`
+        :return: The value returned by `parse_and_save_batch`
+        """
+
+        rows = []
+        for args in self.prefetch_downloads(batch):
+            dargs = self.download_item(*args)
+            if any([is_not_null(a) for a in dargs]):
+                rows.append(list(dargs) + list(args))
+        self.worker_outcome = self.pop_worker_metrics()
+        if not rows:
+            return []
+        with self.stage("parse_and_save"):
+            return self.parse_and_save_batch(rows)
+
     @log_command
     def run(self):
 
         self.check_dependencies()
         results = []
-        pool = Pool(processes=self.options["num_cores"])
-        for iargs in self.iterate():
-            dargs = self.download(*iargs)
-            if any([is_not_null(a) for a in dargs]):
-                pargs = (
-                    [self.name]
-                    + [self.parameters]
-                    + [self.options]
-                    + list(dargs)
-                    + list(iargs)
-                )
-                if self.options["num_cores"] == 1:
-                    pool.apply(command_multiprocess_wrapper, args=pargs)
-                else:
-                    results.append(
-                        pool.apply_async(command_multiprocess_wrapper, args=pargs)
-                    )
-        pool.close()
-        pool.join()
-        self.cleanup(results)
+        pool = self.start_pool()
+        batch_size = self.get_batch_size() or 1
+        download_in_workers = (
+            self.options.get("download_in_workers") or self.download_in_workers
+        )
+        items = self.iterate_shard(self.iterate())
+        if not download_in_workers:
+            items = self.prefetch_downloads(items)
+        for batch in iterate_in_batches(items, batch_size):
+            if download_in_workers:
+                self.apply_in_pool(pool, batch, results, download=True)
+                continue
+            rows = []
+            for iargs in batch:
+                dargs = self.download_item(*iargs)
+                if any([is_not_null(a) for a in dargs]):
+                    rows.append(list(dargs) + list(iargs))
+            if rows:
+                self.apply_in_pool(pool, rows, results)
+        self.finish_pool(pool)
+        self.flush_cache()
+        with self.stage("cleanup"):
+            self.cleanup(results)
 
     def cleanup(self, results):
 
@@ -507,7 +1282,11 @@ class MultiprocessedDownloadIterateCommand(BasicCommand):
             MultiprocessedDownloadIterateCommand, cls
         ).create_or_modify_parser(parser=parser)
         parser.add_argument("--refresh_cache", action="store_true", default=False)
-        parser.add_argument("--num_cores", default=1, type=int)
+        parser.add_argument("--shard", type=parse_shard, default=None)
+        parser.add_argument("--run_group", type=str, default=None)
+        parser.add_argument("--batch_size", type=int, default=None)
+        parser.add_argument("--num_cores", default=1, type=parse_num_cores)
+        parser.add_argument("--autoscale", action="store_true", default=False)
 
         return parser
 
@@ -524,20 +1303,18 @@ class MultiprocessedDownloadIterateCommand(BasicCommand):
     def run(self):
 
         self.check_dependencies()
-        dargs = self.download()
+        dargs = self.download_with_retries()
         results = []
-        pool = Pool(processes=self.options["num_cores"])
-        for iargs in self.iterate(*dargs):
-            iargs = [self.name] + [self.parameters] + [self.options] + list(iargs)
-            if self.options["num_cores"] == 1:
-                pool.apply(command_multiprocess_wrapper, args=iargs)
-            else:
-                results.append(
-                    pool.apply_async(command_multiprocess_wrapper, args=iargs)
-                )
-        pool.close()
-        pool.join()
-        self.cleanup(results)
+        pool = self.start_pool()
+        batch_size = self.get_batch_size() or 1
+        for batch in iterate_in_batches(
+            self.iterate_shard(self.iterate(*dargs)), batch_size
+        ):
+            self.apply_in_pool(pool, batch, results)
+        self.finish_pool(pool)
+        self.flush_cache()
+        with self.stage("cleanup"):
+            self.cleanup(results)
 
     def cleanup(self, results):
 
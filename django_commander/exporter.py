@@ -0,0 +1,221 @@
+import datetime
+import os
+import time
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from django_commander.models import CommandLog, CommandStats
+
+
+def _get_timestamp(value):
+
+    return value.timestamp() if value else None
+
+
+def _get_cache_hit_ratio(metrics):
+
+    lookups = metrics.get("cache_hits", 0) + metrics.get("cache_misses", 0)
+    return metrics.get("cache_hits", 0) / float(lookups) if lookups else None
+
+
+# The number of metrics flush intervals after which an open log that hasn't saved its metrics is assumed to be dead
+STALE_FLUSH_INTERVALS = 3
+
+
+def get_running_logs():
+
+    """
+    Returns the open logs of the top-level runs that are still alive. Logs created by workers on behalf of a parent
+    run are skipped, as are logs that recorded an error and logs whose heartbeat (see `LogHeartbeat`) or metrics
+    haven't updated them (or, if they never have, that started) within the last few
+    `DJANGO_COMMANDER_METRICS_FLUSH_INTERVAL` periods, since their process most likely crashed without closing them.
+
+    :return: A queryset of `CommandLog` objects
+    """
+
+    cutoff = timezone.now() - datetime.timedelta(
+        seconds=STALE_FLUSH_INTERVALS * settings.DJANGO_COMMANDER_METRICS_FLUSH_INTERVAL
+    )
+    return CommandLog.objects.filter(
+        Q(metrics_updated_at__gte=cutoff)
+        | Q(metrics_updated_at__isnull=True, start_time__gte=cutoff),
+        end_time__isnull=True,
+        error_class__isnull=True,
+        worker=False,
+    )
+
+
+def collect_metrics():
+
+    """
+    Collects metrics about the commands that are currently running and the history of every command. Running commands
+    are read from their live open logs (see `get_running_logs`; `BasicCommand.flush_metrics` keeps them up to date,
+    and they're found with a partial index rather than a scan of the whole log table), and everything else is read
+    from the `CommandStats` rollup, after recomputing the duration percentiles of the commands that have finished runs
+    since the last scrape.
+
+    :return: A list of `(name, type, help, samples)` tuples, where `samples` is a list of `(labels, value)` tuples
+    """
+
+    metrics = defaultdict(list)
+    now = time.time()
+
+    running = defaultdict(list)
+    for log in get_running_logs().select_related("command"):
+        running[log.command].append(log)
+    for command, logs in running.items():
+        labels = {"command": command.name, "command_id": command.pk}
+        items = sum([log.metrics.get("items", 0) for log in logs])
+        hits = sum([log.metrics.get("cache_hits", 0) for log in logs])
+        misses = sum([log.metrics.get("cache_misses", 0) for log in logs])
+        elapsed = max([now - log.start_time.timestamp() for log in logs])
+        metrics["running"].append((labels, len(logs)))
+        metrics["running_items"].append((labels, items))
+        metrics["running_items_per_second"].append(
+            (labels, items / elapsed if elapsed > 0 else 0)
+        )
+        metrics["running_errors"].append(
+            (labels, sum([log.metrics.get("failed_items", 0) for log in logs]))
+        )
+        metrics["running_cache_hit_ratio"].append(
+            (
+                labels,
+                _get_cache_hit_ratio({"cache_hits": hits, "cache_misses": misses}),
+            )
+        )
+        metrics["running_queue_depth"].append(
+            (labels, sum([log.metrics.get("in_flight", 0) for log in logs]))
+        )
+        metrics["running_max_memory_bytes"].append(
+            (labels, max([log.metrics.get("memory_max_total_pss", 0) for log in logs]))
+        )
+
+    CommandStats.objects.refresh_durations()
+    for stats in CommandStats.objects.select_related("command"):
+        labels = {"command": stats.command.name, "command_id": stats.command_id}
+        last_metrics = stats.last_metrics or {}
+        metrics["runs_total"].append((labels, stats.run_count))
+        metrics["successes_total"].append((labels, stats.success_count))
+        metrics["failures_total"].append((labels, stats.failure_count))
+        metrics["last_run_timestamp_seconds"].append(
+            (labels, _get_timestamp(stats.last_run_time))
+        )
+        metrics["last_success_timestamp_seconds"].append(
+            (labels, _get_timestamp(stats.last_success_time))
+        )
+        metrics["duration_p50_seconds"].append((labels, stats.p50_duration))
+        metrics["duration_p95_seconds"].append((labels, stats.p95_duration))
+        metrics["last_run_items"].append((labels, last_metrics.get("items")))
+        metrics["last_run_items_per_second"].append(
+            (
+                labels,
+                last_metrics.get("items", 0) / stats.last_duration
+                if stats.last_duration
+                else None,
+            )
+        )
+        metrics["last_run_errors"].append(
+            (labels, last_metrics.get("failed_items", 0))
+        )
+        metrics["last_run_cache_hit_ratio"].append(
+            (labels, _get_cache_hit_ratio(last_metrics))
+        )
+        metrics["last_run_max_memory_bytes"].append(
+            (labels, last_metrics.get("memory_max_total_pss"))
+        )
+
+    return [
+        (
+            "django_commander_{}".format(name),
+            "counter" if name.endswith("_total") else "gauge",
+            METRIC_DESCRIPTIONS[name],
+            metrics[name],
+        )
+        for name in METRIC_DESCRIPTIONS
+        if metrics[name]
+    ]
+
+
+METRIC_DESCRIPTIONS = {
+    "running": "The number of runs of the command that are in progress",
+    "running_items": "The number of items processed so far by the command's open logs",
+    "running_items_per_second": "The number of items processed per second by the command's open logs",
+    "running_errors": "The number of items that have failed so far in the command's open logs",
+    "running_cache_hit_ratio": "The share of cache lookups that were hits in the command's open logs",
+    "running_queue_depth": "The number of tasks waiting on or running in the command's worker pools",
+    "running_max_memory_bytes": "The highest combined memory of the command's open runs and their workers so far",
+    "runs_total": "The total number of runs of the command",
+    "successes_total": "The number of runs of the command that finished without an error",
+    "failures_total": "The number of runs of the command that raised an error",
+    "last_run_timestamp_seconds": "The time at which the command was most recently started",
+    "last_success_timestamp_seconds": "The time at which the command most recently finished successfully",
+    "duration_p50_seconds": "The median duration of the command's successful runs",
+    "duration_p95_seconds": "The 95th percentile duration of the command's successful runs",
+    "last_run_items": "The number of items processed by the command's most recently finished run",
+    "last_run_items_per_second": "The number of items processed per second by the command's most recently finished run",
+    "last_run_errors": "The number of items that failed in the command's most recently finished run",
+    "last_run_cache_hit_ratio": "The share of cache lookups that were hits in the command's most recently finished run",
+    "last_run_max_memory_bytes": "The highest combined memory of the command and its workers in its most recently finished run",
+}
+
+
+def _escape_label_value(value):
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics(metrics=None):
+
+    """
+    Renders metrics in the Prometheus text exposition format. Samples without a value are left out.
+
+    :param metrics: (Optional) the metrics to render; defaults to `collect_metrics()`
+    :return: A string
+    """
+
+    if metrics is None:
+        metrics = collect_metrics()
+
+    lines = []
+    for name, metric_type, description, samples in metrics:
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        for labels, value in samples:
+            if value is None:
+                continue
+            lines.append(
+                "{}{{{}}} {}".format(
+                    name,
+                    ",".join(
+                        [
+                            '{}="{}"'.format(k, _escape_label_value(v))
+                            for k, v in sorted(labels.items())
+                        ]
+                    ),
+                    repr(float(value)),
+                )
+            )
+
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics_textfile(path):
+
+    """
+    Writes the metrics to a file for the Prometheus node exporter's textfile collector. The file is written to a
+    temporary path and then renamed, so the collector never reads a partial file.
+
+    :param path: The file to write, which should end in `.prom`
+    """
+
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp_path, "w") as output:
+        output.write(render_metrics())
+    os.replace(temp_path, path)
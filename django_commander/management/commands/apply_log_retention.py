@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from django_commander.retention import apply_log_retention
+
+
+class Command(BaseCommand):
+
+    """
+    Applies each command's log retention policy, archiving expired logs to `DJANGO_COMMANDER_ARCHIVE_PATH` before
+    deleting them.
+    """
+
+    help = "Archives and deletes command logs that have expired under their retention policies"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+            "command_names",
+            nargs="*",
+            help="The commands to apply retention to (defaults to all commands)",
+        )
+        parser.add_argument(
+            "--dry_run",
+            action="store_true",
+            default=False,
+            help="Report the number of logs that would be expired without deleting them",
+        )
+        parser.add_argument(
+            "--no_archive",
+            action="store_true",
+            default=False,
+            help="Delete expired logs without archiving them first",
+        )
+        parser.add_argument("--chunk_size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+
+        start = time.time()
+        expired = apply_log_retention(
+            command_names=options["command_names"] or None,
+            dry_run=options["dry_run"],
+            archive=not options["no_archive"],
+            chunk_size=options["chunk_size"],
+        )
+        for command_name, count in sorted(expired.items()):
+            self.stdout.write("{}: {}".format(command_name, count))
+        self.stdout.write(
+            "{} {} logs in {:.2f}s".format(
+                "Would expire" if options["dry_run"] else "Expired",
+                sum(expired.values()),
+                time.time() - start,
+            )
+        )
@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from django_commander.utils import clear_unfinished_command_logs
+
+
+class Command(BaseCommand):
+
+    """
+    Deletes command logs that never finished (or that logged an error), along with any commands that are left without
+    logs. Deletes are set-based and chunked by primary key range to keep each transaction small.
+    """
+
+    help = "Clears out unfinished and failed command logs"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+            "--older_than",
+            type=float,
+            default=None,
+            help="Only clear logs that were started more than this many days ago",
+        )
+        parser.add_argument(
+            "--dry_run",
+            action="store_true",
+            default=False,
+            help="Report the number of rows that would be deleted without deleting them",
+        )
+        parser.add_argument("--chunk_size", type=int, default=10000)
+
+    def handle(self, *args, **options):
+
+        start = time.time()
+        deleted = clear_unfinished_command_logs(
+            older_than=options["older_than"],
+            dry_run=options["dry_run"],
+            chunk_size=options["chunk_size"],
+        )
+        elapsed = time.time() - start
+        self.stdout.write(
+            "{} {} logs and {} commands in {:.2f}s ({:.1f} logs/s)".format(
+                "Would delete" if options["dry_run"] else "Deleted",
+                deleted["logs"],
+                deleted["commands"],
+                elapsed,
+                deleted["logs"] / elapsed if elapsed else 0.0,
+            )
+        )
@@ -0,0 +1,148 @@
+import datetime
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from django_commander.cache import (
+    collect_garbage,
+    get_cache_index,
+    index_existing_files,
+    invalidate,
+    list_entries,
+    purge,
+)
+
+
+class Command(BaseCommand):
+
+    """
+    Manages the command caches using the cache index:
+
+    * `gc`: Applies each command's cache policy, evicting expired and least recently used files
+    * `stats`: Reports the number of cached files, their total size and the hit rate for each command
+    * `purge`: Deletes all of a command's cached files
+    * `invalidate`: Deletes the cached files matching `--prefix`, `--older_than` and/or `--parameter`
+    * `list`: Lists the cached files matching `--prefix` and/or `--parameter`, e.g. to see what a run can reuse
+    * `index`: Adds files that were cached before the index existed to it (this walks the cache folder, but only needs \
+    to be run once, and isn't available for S3 caches)
+    """
+
+    help = "Manages the django_commander command caches"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+            "action", choices=["gc", "stats", "purge", "index", "invalidate", "list"]
+        )
+        parser.add_argument("command_names", nargs="*", type=str)
+        parser.add_argument("--prefix", type=str, default=None)
+        parser.add_argument(
+            "--older_than", type=float, default=None, help="Age in days"
+        )
+        parser.add_argument(
+            "--parameter",
+            action="append",
+            default=[],
+            help="A key=value pair; values are parsed as JSON if possible",
+        )
+
+    def get_parameters(self, options):
+
+        parameters = {}
+        for parameter in options["parameter"]:
+            if "=" not in parameter:
+                raise CommandError(
+                    "Parameters must be formatted as key=value: '{}'".format(parameter)
+                )
+            key, value = parameter.split("=", 1)
+            try:
+                parameters[key] = json.loads(value)
+            except ValueError:
+                parameters[key] = value
+        return parameters or None
+
+    def handle(self, *args, **options):
+
+        command_names = options["command_names"] or None
+        if options["action"] == "gc":
+            for command_name, deleted in collect_garbage(command_names).items():
+                self.stdout.write(
+                    "{}: evicted {} files ({} bytes)".format(
+                        command_name, deleted["entries"], deleted["bytes"]
+                    )
+                )
+        elif options["action"] == "stats":
+            totals = get_cache_index().get_totals()
+            for command_name, stats in totals.items():
+                if command_names and command_name not in command_names:
+                    continue
+                lookups = stats["hits"] + stats["misses"]
+                self.stdout.write(
+                    "{}: {} files, {} bytes, {} hits, {} misses ({})".format(
+                        command_name,
+                        stats["entries"],
+                        stats["bytes"],
+                        stats["hits"],
+                        stats["misses"],
+                        "{:.1%} hit rate".format(stats["hits"] / float(lookups))
+                        if lookups
+                        else "no reads",
+                    )
+                )
+        elif options["action"] == "purge":
+            if not command_names:
+                raise CommandError("Specify the commands whose caches should be purged")
+            for command_name in command_names:
+                self.stdout.write(
+                    "{}: deleted {} files".format(command_name, purge(command_name))
+                )
+        elif options["action"] == "invalidate":
+            if not command_names:
+                raise CommandError(
+                    "Specify the commands whose caches should be invalidated"
+                )
+            for command_name in command_names:
+                deleted = invalidate(
+                    command_name,
+                    prefix=options["prefix"],
+                    older_than_days=options["older_than"],
+                    parameters=self.get_parameters(options),
+                )
+                self.stdout.write("{}: deleted {} files".format(command_name, deleted))
+        elif options["action"] == "list":
+            if not command_names:
+                raise CommandError("Specify the commands whose caches should be listed")
+            for command_name in command_names:
+                for entry in list_entries(
+                    command_name,
+                    prefix=options["prefix"],
+                    parameters=self.get_parameters(options),
+                ):
+                    self.stdout.write(
+                        "{}\t{}\t{}\t{}".format(
+                            command_name,
+                            entry["key"],
+                            entry["size"],
+                            datetime.datetime.fromtimestamp(
+                                entry["created_at"]
+                            ).isoformat(),
+                        )
+                    )
+        elif options["action"] == "index":
+            from django_commander.commands import commands
+
+            if settings.DJANGO_COMMANDER_USE_S3:
+                raise CommandError(
+                    "Only local caches can be indexed; S3 caches are indexed as "
+                    "they're written"
+                )
+
+            for command_name in command_names or sorted(commands.keys()):
+                path = os.path.join(settings.DJANGO_COMMANDER_CACHE_PATH, command_name)
+                indexed = index_existing_files(command_name, path)
+                indexed += index_existing_files(
+                    command_name, os.path.join(path, "test")
+                )
+                self.stdout.write("{}: indexed {} files".format(command_name, indexed))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from django_commander.models import Command as CommandModel, consolidate_command_logs
+
+
+class Command(BaseCommand):
+
+    """
+    Collapses the logs of every command (or of the commands with the given names) into a single log per command.
+    """
+
+    help = "Consolidates each command's logs into a single log"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+            "command_names",
+            nargs="*",
+            help="The commands to consolidate the logs of (defaults to all commands)",
+        )
+
+    def handle(self, *args, **options):
+
+        commands = None
+        if options["command_names"]:
+            commands = CommandModel.objects.filter(name__in=options["command_names"])
+        consolidated = consolidate_command_logs(commands=commands)
+        self.stdout.write("Consolidated logs for {} commands".format(len(consolidated)))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from django_commander.models import Command as CommandModel, CommandStats
+
+
+class Command(BaseCommand):
+
+    """
+    Backfills (or refreshes) the `CommandStats` rollup table from the existing command logs. Commands are processed
+    in batches, each of which is recomputed with a handful of bulk queries.
+    """
+
+    help = "Refreshes the CommandStats rollup table from the CommandLog table"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+            "--command_name",
+            type=str,
+            default=None,
+            help="Only refresh the statistics for commands with this name",
+        )
+        parser.add_argument("--batch_size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+
+        commands = CommandModel.objects.order_by("pk")
+        if options["command_name"]:
+            commands = commands.filter(name=options["command_name"])
+        command_ids = list(commands.values_list("pk", flat=True))
+
+        refreshed = 0
+        for i in range(0, len(command_ids), options["batch_size"]):
+            refreshed += CommandStats.objects.refresh(
+                command_ids=command_ids[i : i + options["batch_size"]],
+                batch_size=options["batch_size"],
+            )
+        self.stdout.write("Refreshed statistics for {} commands".format(refreshed))
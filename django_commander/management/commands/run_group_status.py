@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+
+from django_commander.models import CommandRunGroup
+
+
+class Command(BaseCommand):
+
+    """
+    Reports the combined progress of sharded runs (see the `--shard` option on the pipeline command classes), and
+    marks any groups whose shards have all finished as complete.
+    """
+
+    help = "Reports the progress of sharded command runs"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument("command_name", type=str, nargs="?", default=None)
+        parser.add_argument(
+            "--run_group",
+            type=str,
+            default=None,
+            help="Only report on run groups with this key",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            default=False,
+            help="Include run groups that have already finished",
+        )
+
+    def handle(self, *args, **options):
+
+        groups = CommandRunGroup.objects.select_related("command").order_by("start_time")
+        if options["command_name"]:
+            groups = groups.filter(command__name=options["command_name"])
+        if options["run_group"]:
+            groups = groups.filter(key=options["run_group"])
+        if not options["all"]:
+            groups = groups.filter(end_time__isnull=True)
+
+        for group in groups:
+            group.update_status()
+            progress = group.progress
+            self.stdout.write(str(group))
+            self.stdout.write(
+                "  {started}/{num_shards} shards started, {finished} finished, {failed} failed, "
+                "{items} items processed".format(**progress)
+            )
+            for index, log in enumerate(group.shards):
+                if log:
+                    status = (
+                        "FAILED"
+                        if log.error_class
+                        else ("COMPLETED" if log.end_time else "RUNNING")
+                    )
+                    self.stdout.write(
+                        "  shard {}: {} ({} items)".format(
+                            index, status, log.metrics.get("items", 0)
+                        )
+                    )
+                else:
+                    self.stdout.write("  shard {}: NOT STARTED".format(index))
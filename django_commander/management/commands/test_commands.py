@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from django_commander.utils import test_commands
+
+
+class Command(BaseCommand):
+
+    """
+    Runs every command (or the ones specified) with its `test_parameters` and `test_options`, optionally in parallel,
+    and prints how long each one took.
+    """
+
+    help = "Runs commands with their test parameters"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument("command_names", nargs="*", type=str)
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=1,
+            help="The number of commands to run at once; commands still wait for their dependencies",
+        )
+        parser.add_argument(
+            "--fail_fast",
+            action="store_true",
+            default=False,
+            help="Stop starting new commands as soon as one fails",
+        )
+
+    def handle(self, *args, **options):
+
+        results = test_commands(
+            jobs=options["jobs"],
+            fail_fast=options["fail_fast"],
+            command_names=options["command_names"] or None,
+            raise_errors=False,
+        )
+        width = max([len(r["command"]) for r in results] + [len("Command")])
+        self.stdout.write(
+            "{}  {:>9}  {}".format("Command".ljust(width), "Seconds", "Result")
+        )
+        for result in sorted(results, key=lambda r: -r["seconds"]):
+            self.stdout.write(
+                "{}  {:>9.2f}  {}".format(
+                    result["command"].ljust(width),
+                    result["seconds"],
+                    result["error"] or "OK",
+                )
+            )
+
+        failures = [r for r in results if r["error"]]
+        if failures:
+            raise CommandError(
+                "{} of {} commands failed".format(len(failures), len(results))
+            )
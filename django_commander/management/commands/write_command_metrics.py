@@ -0,0 +1,45 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from django_commander.exporter import write_metrics_textfile
+
+
+class Command(BaseCommand):
+
+    """
+    Writes the command metrics (see `django_commander.exporter`) to a file for the Prometheus node exporter's textfile
+    collector, either once (e.g. from cron) or every `--interval` seconds.
+    """
+
+    help = "Writes command metrics to a Prometheus textfile"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+            "path",
+            nargs="?",
+            type=str,
+            default=None,
+            help="The .prom file to write; defaults to DJANGO_COMMANDER_METRICS_TEXTFILE",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=None,
+            help="Keep rewriting the file every this many seconds",
+        )
+
+    def handle(self, *args, **options):
+
+        path = options["path"] or settings.DJANGO_COMMANDER_METRICS_TEXTFILE
+        if not path:
+            raise CommandError(
+                "Specify a path or set DJANGO_COMMANDER_METRICS_TEXTFILE"
+            )
+        while True:
+            write_metrics_textfile(path)
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
@@ -1,4 +1,9 @@
-from django.db.models import Count
+from collections import defaultdict
+
+from django.db import models
+from django.db.models import Count, F, Max, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
 
 from django_pewtils.managers import BasicExtendedManager
 from django_pewtils import get_model
@@ -44,3 +49,230 @@ class LoggedExtendedManager(BasicExtendedManager):
             existing.command_logs.add(command_log)
             existing.commands.add(command_log.command)
         return existing
+
+
+def _percentile(values, percentile):
+
+    """
+    Returns the linearly-interpolated percentile of a sorted list of values (or None if the list is empty)
+
+    :param values: A sorted list of numbers
+    :param percentile: The percentile to compute, between 0 and 100
+    :return: The value at the requested percentile
+    """
+
+    if not values:
+        return None
+    position = (len(values) - 1) * (percentile / 100.0)
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def _get_durations(logs):
+
+    """
+    Collects the durations of the most recent successful runs (up to `DJANGO_COMMANDER_STATS_WINDOW` of them) for
+    each command, with a single streaming query. Logs created by workers for individual items aren't runs, and are
+    skipped.
+
+    :param logs: A `CommandLog` queryset
+    :return: A dictionary mapping command IDs to sorted lists of durations, in seconds
+    """
+
+    from django.conf import settings
+
+    window = settings.DJANGO_COMMANDER_STATS_WINDOW
+    durations = defaultdict(list)
+    for command_id, start_time, end_time in (
+        logs.filter(end_time__isnull=False, error_class__isnull=True, worker=False)
+        .order_by("command_id", "-start_time")
+        .values_list("command_id", "start_time", "end_time")
+        .iterator()
+    ):
+        if not window or len(durations[command_id]) < window:
+            durations[command_id].append((end_time - start_time).total_seconds())
+    return {command_id: sorted(values) for command_id, values in durations.items()}
+
+
+class CommandStatsManager(models.Manager):
+
+    """
+    Manager for the `CommandStats` rollup table. `record_run` updates a command's statistics in place when one of its
+    logs is closed, `refresh_durations` recomputes the duration percentiles of commands that have finished runs since
+    they were last computed, and `refresh` recomputes everything directly from the logs.
+    """
+
+    def record_run(self, log):
+
+        """
+        Adds a log that was just closed out to its command's statistics with a single `UPDATE`, so that closing a log
+        costs the same no matter how much history the command has. The duration percentiles are only flagged as stale
+        (see `refresh_durations`). If the command doesn't have statistics yet, they're computed with `refresh`. Logs
+        created by workers on behalf of a run are skipped, since they each cover a single item of the parent's run.
+
+        :param log: The `CommandLog` that was closed
+        """
+
+        if log.worker:
+            return
+
+        succeeded = log.end_time is not None and log.error_class is None
+        start_time = Value(log.start_time, output_field=models.DateTimeField())
+        values = {
+            "run_count": F("run_count") + 1,
+            "success_count": F("success_count") + int(succeeded),
+            "failure_count": F("failure_count") + int(log.error_class is not None),
+            "last_run_time": Greatest(
+                Coalesce("last_run_time", start_time), start_time
+            ),
+            "updated_at": timezone.now(),
+        }
+        if log.end_time is not None:
+            values["last_duration"] = (log.end_time - log.start_time).total_seconds()
+            values["last_metrics"] = log.metrics
+        if succeeded:
+            end_time = Value(log.end_time, output_field=models.DateTimeField())
+            values["last_success_time"] = Greatest(
+                Coalesce("last_success_time", end_time), end_time
+            )
+            values["durations_stale"] = True
+        if not self.filter(command_id=log.command_id).update(**values):
+            self.refresh(command_ids=[log.command_id])
+
+    def refresh_durations(self, command_ids=None):
+
+        """
+        Recomputes the duration percentiles for commands whose percentiles are stale.
+
+        :param command_ids: (Optional) a list of `Command` primary keys to limit the refresh to
+        :return: The number of commands that were refreshed
+        """
+
+        CommandLog = get_model("CommandLog", app_name="django_commander")
+
+        stale = self.filter(durations_stale=True)
+        if command_ids is not None:
+            stale = stale.filter(command_id__in=command_ids)
+        stats = list(stale)
+        if not stats:
+            return 0
+        durations = _get_durations(
+            CommandLog.objects.filter(command_id__in=[s.command_id for s in stats])
+        )
+        for s in stats:
+            values = durations.get(s.command_id, [])
+            s.p50_duration = _percentile(values, 50)
+            s.p95_duration = _percentile(values, 95)
+            s.durations_stale = False
+        self.bulk_update(stats, ["p50_duration", "p95_duration", "durations_stale"])
+        return len(stats)
+
+    def refresh(self, command_ids=None, batch_size=1000):
+
+        """
+        Recomputes the run statistics for the specified commands (or all commands, if none are provided) using a
+        single aggregate query for the counts and a single streaming query for the durations, and then writes the
+        results back with bulk updates and inserts. Only logs that have been closed out (successfully or with an
+        error) by top-level runs are counted, as with `record_run`.
+
+        :param command_ids: (Optional) a list of `Command` primary keys to refresh
+        :param batch_size: The number of rows to write per bulk query
+        :return: The number of commands that were refreshed
+        """
+
+        CommandLog = get_model("CommandLog", app_name="django_commander")
+        Command = get_model("Command", app_name="django_commander")
+
+        logs = CommandLog.objects.filter(worker=False)
+        if command_ids is not None:
+            logs = logs.filter(command_id__in=command_ids)
+        succeeded = Q(end_time__isnull=False, error_class__isnull=True)
+        finished = Q(end_time__isnull=False) | Q(error_class__isnull=False)
+        rows = {
+            row["command_id"]: row
+            for row in logs.order_by()
+            .values("command_id")
+            .annotate(
+                run_count=Count("pk", filter=finished),
+                success_count=Count("pk", filter=succeeded),
+                failure_count=Count("pk", filter=Q(error_class__isnull=False)),
+                last_run_time=Max("start_time", filter=finished),
+                last_success_time=Max("end_time", filter=succeeded),
+            )
+        }
+        durations = _get_durations(logs)
+
+        if command_ids is None:
+            command_ids = Command.objects.values_list("pk", flat=True)
+
+        # The metrics from each command's most recently finished run are copied over too, so that they can be exported
+        # without reading the logs (see `django_commander.exporter`)
+        latest_log_ids = (
+            Command.objects.filter(pk__in=command_ids)
+            .annotate(
+                latest_log_id=Subquery(
+                    CommandLog.objects.filter(
+                        command_id=OuterRef("pk"), end_time__isnull=False, worker=False
+                    )
+                    .order_by("-end_time")
+                    .values("pk")[:1]
+                )
+            )
+            .values_list("latest_log_id", flat=True)
+        )
+        latest_logs = {
+            row[0]: row[1:]
+            for row in CommandLog.objects.filter(
+                pk__in=[pk for pk in latest_log_ids if pk]
+            ).values_list("command_id", "start_time", "end_time", "metrics")
+        }
+        existing = {
+            s.command_id: s
+            for s in self.model.objects.filter(command_id__in=command_ids)
+        }
+        to_create, to_update = [], []
+        for command_id in command_ids:
+            row = rows.get(command_id, {})
+            values = durations.get(command_id, [])
+            stats = existing.get(command_id, self.model(command_id=command_id))
+            stats.run_count = row.get("run_count", 0)
+            stats.success_count = row.get("success_count", 0)
+            stats.failure_count = row.get("failure_count", 0)
+            stats.last_run_time = row.get("last_run_time")
+            stats.last_success_time = row.get("last_success_time")
+            stats.p50_duration = _percentile(values, 50)
+            stats.p95_duration = _percentile(values, 95)
+            stats.durations_stale = False
+            latest = latest_logs.get(command_id)
+            if latest:
+                stats.last_duration = (latest[1] - latest[0]).total_seconds()
+                stats.last_metrics = latest[2]
+            stats.updated_at = timezone.now()
+            if stats.pk:
+                to_update.append(stats)
+            else:
+                to_create.append(stats)
+
+        self.model.objects.bulk_update(
+            to_update,
+            [
+                "run_count",
+                "success_count",
+                "failure_count",
+                "last_run_time",
+                "last_success_time",
+                "p50_duration",
+                "p95_duration",
+                "durations_stale",
+                "last_duration",
+                "last_metrics",
+                "updated_at",
+            ],
+            batch_size=batch_size,
+        )
+        self.model.objects.bulk_create(
+            to_create, batch_size=batch_size, ignore_conflicts=True
+        )
+
+        return len(to_update) + len(to_create)
@@ -0,0 +1,214 @@
+import gc
+import multiprocessing
+import os
+import statistics
+import time
+
+from django.db import reset_queries
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def get_rss(pid=None):
+
+    """
+    Measures the resident memory of a process, using `psutil` if it's installed and `/proc` otherwise.
+
+    :param pid: (Optional) the process ID; defaults to the current process
+    :return: The process's resident set size in bytes, or None if it can't be measured (e.g. the process has exited)
+    """
+
+    pid = pid or os.getpid()
+    if psutil:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return None
+    try:
+        with open("/proc/{}/statm".format(pid), "r") as infile:
+            return int(infile.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def get_pss(pid=None):
+
+    """
+    Measures the proportional set size of a process: its private memory plus an even share of the pages it shares
+    with other processes. Forked workers share most of their pages with the parent until they're written to, so
+    adding up their PSS (unlike their RSS) doesn't count the shared pages more than once. This reads
+    `/proc/<pid>/smaps_rollup` where it's available and otherwise uses `psutil` (falling back to the unique set size
+    on platforms that don't report PSS).
+
+    :param pid: (Optional) the process ID; defaults to the current process
+    :return: The process's proportional set size in bytes, or None if it can't be measured
+    """
+
+    pid = pid or os.getpid()
+    try:
+        with open("/proc/{}/smaps_rollup".format(pid), "r") as infile:
+            for line in infile:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    if psutil:
+        try:
+            info = psutil.Process(pid).memory_full_info()
+        except psutil.Error:
+            return None
+        return getattr(info, "pss", None) or getattr(info, "uss", None)
+    return None
+
+
+class MemoryGovernor(object):
+
+    """
+    Keeps track of the memory of a command's process and its worker processes, and records high-water marks for the
+    command's log. The combined memory is the sum of the processes' proportional set sizes (see `get_pss`), so that
+    the pages the workers share with the parent are only counted once; the high-water marks for the individual
+    processes are resident set sizes. If a `ceiling` is set and the combined memory gets within `pause_ratio` of it,
+    `check` frees what it can in the parent (garbage and Django's query log) and then blocks until the memory drops
+    or the pool has no more tasks in flight, so that `iterate` can't keep piling up work while the workers catch up.
+
+    Each worker's memory growth over its lifetime is also recorded, so that the next run can recycle leaky workers
+    before they outgrow their share of the ceiling (see `get_max_tasks_per_child`).
+
+    :param ceiling: (Optional) the maximum combined memory of the command and its workers, in bytes
+    :param interval: (Optional) the minimum number of seconds between measurements
+    :param pause_ratio: (Optional) the fraction of the ceiling at which `check` starts pausing
+    """
+
+    def __init__(self, ceiling=None, interval=1.0, pause_ratio=0.9):
+
+        self.ceiling = ceiling
+        self.interval = interval
+        self.pause_ratio = pause_ratio
+        self.max_rss = 0
+        self.max_worker_rss = 0
+        self.max_total_pss = 0
+        self.pauses = 0
+        self.pause_seconds = 0.0
+        self._workers = {}
+        self._checked_at = None
+
+    def sample(self):
+
+        """
+        Measures the memory of the current process and its children and updates the high-water marks.
+
+        :return: The combined proportional set size, in bytes
+        """
+
+        now = time.time()
+        rss = get_rss() or 0
+        total = get_pss() or rss
+        for child in multiprocessing.active_children():
+            worker_rss = get_rss(child.pid)
+            if worker_rss is None:
+                continue
+            total += get_pss(child.pid) or worker_rss
+            self.max_worker_rss = max(self.max_worker_rss, worker_rss)
+            first = self._workers.get(child.pid, (now, worker_rss))[:2]
+            self._workers[child.pid] = first + (now, worker_rss)
+        self.max_rss = max(self.max_rss, rss)
+        self.max_total_pss = max(self.max_total_pss, total)
+        self._checked_at = now
+        return total
+
+    def check(self, throttle=None, force=False):
+
+        """
+        Samples memory (at most once per `interval` seconds, unless `force` is set), and pauses while the command is
+        over the pause threshold and the pool still has tasks in flight.
+
+        :param throttle: (Optional) the command's `PoolThrottle`, if it has a pool
+        :param force: If True, samples memory regardless of when it was last sampled
+        :return: True if memory was sampled
+        """
+
+        if (
+            not force
+            and self._checked_at is not None
+            and time.time() - self._checked_at < self.interval
+        ):
+            return False
+        total = self.sample()
+        if not self.ceiling or total < self.ceiling * self.pause_ratio:
+            return True
+        gc.collect()
+        reset_queries()
+        total = self.sample()
+        if total < self.ceiling * self.pause_ratio:
+            return True
+        self.pauses += 1
+        start = time.time()
+        while (
+            throttle
+            and throttle.in_flight > 0
+            and total >= self.ceiling * self.pause_ratio
+        ):
+            time.sleep(self.interval)
+            total = self.sample()
+        self.pause_seconds += time.time() - start
+        return True
+
+    def get_worker_growth(self):
+
+        """
+        :return: The median rate at which the workers' memory grew over their lifetimes, in bytes per second, or \
+        None if no worker has been measured at two different times
+        """
+
+        rates = [
+            (last_rss - first_rss) / (last_time - first_time)
+            for first_time, first_rss, last_time, last_rss in self._workers.values()
+            if last_time > first_time
+        ]
+        return statistics.median(rates) if rates else None
+
+    def get_metrics(self):
+
+        """
+        :return: A dictionary of metrics to save on the command's log
+        """
+
+        metrics = {
+            "memory_max_rss": self.max_rss,
+            "memory_max_worker_rss": self.max_worker_rss,
+            "memory_max_total_pss": self.max_total_pss,
+            "memory_pauses": self.pauses,
+            "memory_pause_seconds": round(self.pause_seconds, 3),
+        }
+        if self._workers:
+            metrics["memory_worker_baseline_rss"] = min(
+                [first_rss for _, first_rss, _, _ in self._workers.values()]
+            )
+            metrics["memory_worker_growth"] = self.get_worker_growth()
+        return metrics
+
+
+def get_max_tasks_per_child(num_cores, last_metrics, ceiling=None, worker_memory=None):
+
+    """
+    Estimates how many tasks a worker can run before it should be replaced with a fresh one, based on how quickly the
+    workers' memory grew during the command's previous run and how long its tasks took. Each worker's budget is
+    `worker_memory` or, failing that, an equal share of the `ceiling` (with one share left for the parent process).
+
+    :param num_cores: The number of workers in the pool
+    :param last_metrics: The metrics from the command's previous run (see `CommandStats.last_metrics`)
+    :param ceiling: (Optional) the maximum combined memory of the command and its workers, in bytes
+    :param worker_memory: (Optional) the memory budget for each worker, in bytes
+    :return: An integer, or None if workers don't need to be recycled (or there isn't enough data to tell)
+    """
+
+    budget = worker_memory or (ceiling // (num_cores + 1) if ceiling else None)
+    growth = last_metrics.get("memory_worker_growth")
+    baseline = last_metrics.get("memory_worker_baseline_rss")
+    task_seconds = last_metrics.get("task_seconds")
+    if not budget or not growth or growth <= 0 or not baseline or not task_seconds:
+        return None
+    return max(1, int((budget - baseline) / (growth * task_seconds)))
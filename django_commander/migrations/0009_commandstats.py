@@ -0,0 +1,32 @@
+# Generated by Django 3.1.2 on 2026-10-19 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_commander', '0008_remove_commandlog_celery_task_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommandStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_count', models.IntegerField(default=0, help_text='The total number of logs for the command')),
+                ('success_count', models.IntegerField(default=0, help_text='The number of runs that finished without an error')),
+                ('failure_count', models.IntegerField(default=0, help_text='The number of runs that raised an error')),
+                ('p50_duration', models.FloatField(help_text='The median duration of successful runs, in seconds', null=True)),
+                ('p95_duration', models.FloatField(help_text='The 95th percentile duration of successful runs, in seconds', null=True)),
+                ('last_run_time', models.DateTimeField(help_text='The time at which the command was most recently started', null=True)),
+                ('last_success_time', models.DateTimeField(help_text='The time at which the command most recently finished successfully', null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, help_text='The time at which these statistics were refreshed')),
+                ('command', models.OneToOneField(help_text='The command these statistics summarize', on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='django_commander.command')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
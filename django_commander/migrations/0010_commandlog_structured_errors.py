@@ -0,0 +1,37 @@
+# Generated by Django 3.1.2 on 2026-10-19 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_commander', '0009_commandstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commandlog',
+            name='error_class',
+            field=models.CharField(help_text='The class of the error raised by the command (if applicable)', max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='commandlog',
+            name='error_digest',
+            field=models.CharField(help_text='A hash of the error class and the frames in its traceback, for grouping identical errors', max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='commandlog',
+            name='error_message',
+            field=models.TextField(help_text='The message of the error raised by the command (if applicable)', null=True),
+        ),
+        migrations.AddField(
+            model_name='commandlog',
+            name='error_traceback',
+            field=models.BinaryField(help_text='The zlib-compressed traceback of the error (if applicable)', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='commandlog',
+            index=models.Index(fields=['error_class', 'error_digest'], name='django_comm_error_c_375232_idx'),
+        ),
+    ]
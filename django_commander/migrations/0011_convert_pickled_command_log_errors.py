@@ -0,0 +1,76 @@
+import hashlib
+import re
+import zlib
+
+from django.db import migrations
+
+
+BATCH_SIZE = 1000
+TRACEBACK_FRAME_REGEX = re.compile(r'File "([^"]+)", line \d+, in (\S+)')
+
+
+def _get_error_class_name(exception):
+
+    error_class = type(exception)
+    if error_class.__module__ == "builtins":
+        return error_class.__qualname__
+    return "{}.{}".format(error_class.__module__, error_class.__qualname__)
+
+
+def _get_error_digest(error_class, tb):
+
+    frames = TRACEBACK_FRAME_REGEX.findall(tb or "")
+    signature = "|".join([error_class] + ["{}:{}".format(f, n) for f, n in frames])
+    return hashlib.sha1(signature.encode("utf8")).hexdigest()
+
+
+def convert_pickled_errors(apps, schema_editor):
+
+    """
+    Converts the pickled `error` values into the structured error fields, one batch of logs at a time. Errors were
+    stored as `{"traceback": ..., "exception": ...}` dictionaries, where the exception is either the original
+    exception object or its string representation; anything else is stored as a generic error message.
+    """
+
+    CommandLog = apps.get_model("django_commander", "CommandLog")
+    last_pk = 0
+    while True:
+        logs = list(
+            CommandLog.objects.filter(pk__gt=last_pk, error__isnull=False)
+            .order_by("pk")
+            .only("pk", "error")[:BATCH_SIZE]
+        )
+        if not logs:
+            break
+        for log in logs:
+            error, tb = log.error, None
+            if isinstance(error, dict):
+                tb = error.get("traceback")
+                tb = str(tb) if tb is not None else None
+                error = error.get("exception")
+            if isinstance(error, BaseException):
+                log.error_class = _get_error_class_name(error)
+                log.error_message = str(error)
+            else:
+                log.error_class = "Error"
+                log.error_message = str(error) if error is not None else None
+            log.error_digest = _get_error_digest(log.error_class, tb)
+            log.error_traceback = zlib.compress(tb.encode("utf8")) if tb else None
+        CommandLog.objects.bulk_update(
+            logs, ["error_class", "error_message", "error_digest", "error_traceback"]
+        )
+        last_pk = logs[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    # Each batch is committed separately, so that converting a large table doesn't hold a single long transaction
+    atomic = False
+
+    dependencies = [
+        ('django_commander', '0010_commandlog_structured_errors'),
+    ]
+
+    operations = [
+        migrations.RunPython(convert_pickled_errors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.2 on 2026-10-19 10:00
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_commander', '0011_convert_pickled_command_log_errors'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='commandlog',
+            name='error',
+        ),
+    ]
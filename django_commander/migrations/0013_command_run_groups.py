@@ -0,0 +1,44 @@
+# Generated by Django 3.1.2 on 2026-10-19 10:00
+
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_commander', '0012_remove_commandlog_error'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommandRunGroup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(db_index=True, default='default', help_text='The name of the run group, passed with the `--run_group` option', max_length=200)),
+                ('num_shards', models.IntegerField(help_text='The number of shards in the run')),
+                ('start_time', models.DateTimeField(auto_now_add=True, help_text='The time at which the first shard started')),
+                ('end_time', models.DateTimeField(help_text='The time at which the last shard finished (if applicable)', null=True)),
+                ('command', models.ForeignKey(help_text='The command that was sharded', on_delete=django.db.models.deletion.CASCADE, related_name='run_groups', to='django_commander.command')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='commandlog',
+            name='metrics',
+            field=models.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder, help_text='Metrics recorded while the command was running (e.g. the number of items processed)'),
+        ),
+        migrations.AddField(
+            model_name='commandlog',
+            name='run_group',
+            field=models.ForeignKey(help_text='The run group this log belongs to, if the command was run in shards', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='logs', to='django_commander.commandrungroup'),
+        ),
+        migrations.AddField(
+            model_name='commandlog',
+            name='shard',
+            field=models.IntegerField(help_text='The shard of the run group that this log processed (if applicable)', null=True),
+        ),
+    ]
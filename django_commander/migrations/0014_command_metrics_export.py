@@ -0,0 +1,28 @@
+# Generated by Django 3.1.2 on 2026-10-19 12:00
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_commander', '0013_command_run_groups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commandstats',
+            name='last_duration',
+            field=models.FloatField(help_text='The duration of the most recently finished run, in seconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='commandstats',
+            name='last_metrics',
+            field=models.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder, help_text='The metrics recorded by the most recently finished run'),
+        ),
+        migrations.AddIndex(
+            model_name='commandlog',
+            index=models.Index(condition=models.Q(end_time__isnull=True), fields=['command', 'start_time'], name='commandlog_running'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.2 on 2026-10-20 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_commander', '0014_command_metrics_export'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commandstats',
+            name='durations_stale',
+            field=models.BooleanField(default=False, help_text='Whether runs have finished since the duration percentiles were computed'),
+        ),
+    ]
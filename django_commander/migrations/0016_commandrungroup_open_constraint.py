@@ -0,0 +1,44 @@
+# Generated by Django 3.1.2 on 2026-10-20 12:00
+
+from django.db import migrations, models
+
+
+def abandon_duplicate_open_groups(apps, schema_editor):
+
+    """
+    Marks all but the most recent open group for each command, key and number of shards as abandoned, so that the
+    unique constraint on open groups can be added.
+    """
+
+    CommandRunGroup = apps.get_model("django_commander", "CommandRunGroup")
+    seen = set()
+    duplicates = []
+    for pk, command_id, key, num_shards in (
+        CommandRunGroup.objects.filter(end_time__isnull=True)
+        .order_by("-pk")
+        .values_list("pk", "command_id", "key", "num_shards")
+    ):
+        if (command_id, key, num_shards) in seen:
+            duplicates.append(pk)
+        seen.add((command_id, key, num_shards))
+    CommandRunGroup.objects.filter(pk__in=duplicates).update(abandoned=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_commander', '0015_commandstats_durations_stale'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commandrungroup',
+            name='abandoned',
+            field=models.BooleanField(default=False, help_text='Whether the group timed out before all of its shards finished'),
+        ),
+        migrations.RunPython(abandon_duplicate_open_groups, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='commandrungroup',
+            constraint=models.UniqueConstraint(condition=models.Q(('abandoned', False), ('end_time__isnull', True)), fields=('command', 'key', 'num_shards'), name='commandrungroup_open'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.2 on 2026-10-20 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_commander', '0016_commandrungroup_open_constraint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commandlog',
+            name='metrics_updated_at',
+            field=models.DateTimeField(help_text='The time at which the metrics were last saved while the command was running', null=True),
+        ),
+        migrations.AddField(
+            model_name='commandlog',
+            name='worker',
+            field=models.BooleanField(default=False, help_text='Whether the log was created by a worker process on behalf of another run'),
+        ),
+    ]
@@ -1,11 +1,49 @@
 from builtins import str
 from builtins import object
-from django.db import models
+
+import hashlib
+import re
+import zlib
+
+from django.db import models, transaction
 from django.core.serializers.json import DjangoJSONEncoder
-from picklefield.fields import PickledObjectField
 
 from django_pewtils.abstract_models import BasicExtendedModel
-from django_pewtils import get_model, consolidate_objects
+from django_pewtils import get_model
+
+from django_commander.managers import CommandStatsManager
+
+
+TRACEBACK_FRAME_REGEX = re.compile(r'File "([^"]+)", line \d+, in (\S+)')
+
+
+def get_error_class_name(exception):
+
+    """
+    :param exception: An exception
+    :return: The exception's class name, qualified by its module unless it's a builtin
+    """
+
+    error_class = type(exception)
+    if error_class.__module__ == "builtins":
+        return error_class.__qualname__
+    return "{}.{}".format(error_class.__module__, error_class.__qualname__)
+
+
+def get_error_digest(error_class, tb=None):
+
+    """
+    Computes a digest that identifies errors of the same class raised from the same place. Line numbers and messages
+    are ignored, so the digest doesn't change when unrelated lines in the same files are edited.
+
+    :param error_class: The name of the error class
+    :param tb: (Optional) the formatted traceback
+    :return: A SHA1 hex digest
+    """
+
+    frames = TRACEBACK_FRAME_REGEX.findall(tb or "")
+    signature = "|".join([error_class] + ["{}:{}".format(f, n) for f, n in frames])
+    return hashlib.sha1(signature.encode("utf8")).hexdigest()
 
 
 class LoggedExtendedModel(BasicExtendedModel):
@@ -77,14 +115,14 @@ class Command(BasicExtendedModel):
 
     def consolidate_logs(self):
 
-        first = self.logs.order_by("start_time")[0]
-        first_time = first.start_time
-        last = self.logs.order_by("-start_time")[0]
-        last_time = last.start_time
-        for extra in self.logs.exclude(pk=last.pk):
-            consolidated = consolidate_objects(source=extra, target=last)
-        consolidated.start_time = first_time
-        consolidated.save()
+        """
+        Collapses all of the command's logs into its most recent log (which inherits the start time of the earliest
+        log). See `consolidate_command_logs` for details.
+
+        :return: The consolidated log
+        """
+
+        return consolidate_command_logs(commands=[self])[0]
 
 
 class CommandLog(BasicExtendedModel):
@@ -110,9 +148,56 @@ class CommandLog(BasicExtendedModel):
         help_text="The options passed to the command",
         encoder=DjangoJSONEncoder,
     )
-    error = PickledObjectField(
-        null=True, help_text="The error returned by the command (if applicable)"
+    error_class = models.CharField(
+        max_length=255,
+        null=True,
+        help_text="The class of the error raised by the command (if applicable)",
+    )
+    error_message = models.TextField(
+        null=True, help_text="The message of the error raised by the command (if applicable)"
+    )
+    error_digest = models.CharField(
+        max_length=40,
+        null=True,
+        help_text="A hash of the error class and the frames in its traceback, for grouping identical errors",
+    )
+    error_traceback = models.BinaryField(
+        null=True, help_text="The zlib-compressed traceback of the error (if applicable)"
+    )
+    metrics = models.JSONField(
+        default=dict,
+        help_text="Metrics recorded while the command was running (e.g. the number of items processed)",
+        encoder=DjangoJSONEncoder,
+    )
+    metrics_updated_at = models.DateTimeField(
+        null=True, help_text="The time at which the metrics were last saved while the command was running"
+    )
+    worker = models.BooleanField(
+        default=False,
+        help_text="Whether the log was created by a worker process on behalf of another run",
+    )
+    run_group = models.ForeignKey(
+        "django_commander.CommandRunGroup",
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name="logs",
+        help_text="The run group this log belongs to, if the command was run in shards",
     )
+    shard = models.IntegerField(
+        null=True, help_text="The shard of the run group that this log processed (if applicable)"
+    )
+
+    class Meta(object):
+
+        indexes = [
+            models.Index(fields=["error_class", "error_digest"]),
+            # Keeps lookups of the commands that are currently running cheap, no matter how many logs there are
+            models.Index(
+                fields=["command", "start_time"],
+                name="commandlog_running",
+                condition=models.Q(end_time__isnull=True),
+            ),
+        ]
 
     def __str__(self):
 
@@ -124,6 +209,345 @@ class CommandLog(BasicExtendedModel):
             status = "RUNNING"
         return "%s (pk=%s): %s" % (str(self.command), str(self.pk), status)
 
+    @property
+    def traceback(self):
+
+        """
+        :return: The decompressed traceback of the error raised by the command, if there was one
+        """
+
+        if self.error_traceback is None:
+            return None
+        return zlib.decompress(bytes(self.error_traceback)).decode("utf8")
+
+    @property
+    def error(self):
+
+        """
+        :return: A dictionary describing the error raised by the command (or None, if the command didn't fail)
+        """
+
+        if self.error_class is None:
+            return None
+        return {
+            "exception": self.error_class,
+            "message": self.error_message,
+            "traceback": self.traceback,
+        }
+
+    @error.setter
+    def error(self, value):
+
+        if value is None:
+            self.set_error(None)
+        elif isinstance(value, BaseException):
+            self.set_error(value)
+        elif isinstance(value, dict):
+            exception = value.get("exception")
+            if isinstance(exception, BaseException):
+                self.set_error(exception, tb=value.get("traceback"))
+            else:
+                self.set_error(
+                    error_class=str(exception) if exception is not None else "Error",
+                    message=value.get("message"),
+                    tb=value.get("traceback"),
+                )
+        else:
+            self.set_error(error_class="Error", message=str(value))
+
+    def set_error(self, exception=None, tb=None, error_class=None, message=None):
+
+        """
+        Records an error on the log (or clears it, if nothing is passed).
+
+        :param exception: (Optional) the exception that was raised
+        :param tb: (Optional) the formatted traceback
+        :param error_class: (Optional) the name of the error class, if no exception is provided
+        :param message: (Optional) the error message, if no exception is provided
+        """
+
+        if exception is not None:
+            error_class = get_error_class_name(exception)
+            message = str(exception)
+        if error_class is None:
+            self.error_class = None
+            self.error_message = None
+            self.error_digest = None
+            self.error_traceback = None
+        else:
+            self.error_class = error_class
+            self.error_message = message
+            self.error_digest = get_error_digest(error_class, tb)
+            self.error_traceback = (
+                zlib.compress(tb.encode("utf8")) if tb is not None else None
+            )
+
+
+class CommandRunGroup(BasicExtendedModel):
+
+    """
+    Groups together the logs of a command that was split into shards with the `--shard i/N` option (e.g. across
+    multiple machines). Each shard writes its own CommandLog, and the group is marked as finished once every shard
+    has completed successfully. A command can only have one open group per key and number of shards; groups that no
+    shard has joined for `DJANGO_COMMANDER_RUN_GROUP_TIMEOUT` seconds are marked as abandoned, so that the next run
+    starts a new group instead of joining one that crashed.
+    """
+
+    command = models.ForeignKey(
+        "django_commander.Command",
+        on_delete=models.CASCADE,
+        related_name="run_groups",
+        help_text="The command that was sharded",
+    )
+    key = models.CharField(
+        max_length=200,
+        default="default",
+        db_index=True,
+        help_text="The name of the run group, passed with the `--run_group` option",
+    )
+    num_shards = models.IntegerField(help_text="The number of shards in the run")
+    start_time = models.DateTimeField(
+        auto_now_add=True, help_text="The time at which the first shard started"
+    )
+    end_time = models.DateTimeField(
+        null=True, help_text="The time at which the last shard finished (if applicable)"
+    )
+    abandoned = models.BooleanField(
+        default=False,
+        help_text="Whether the group timed out before all of its shards finished",
+    )
+
+    class Meta(object):
+
+        constraints = [
+            # Shards that start at the same time have to agree on a single group, even on databases that can't lock rows
+            models.UniqueConstraint(
+                fields=["command", "key", "num_shards"],
+                name="commandrungroup_open",
+                condition=models.Q(end_time__isnull=True, abandoned=False),
+            )
+        ]
+
+    def __str__(self):
+
+        if self.end_time:
+            status = "COMPLETED"
+        elif self.abandoned:
+            status = "ABANDONED"
+        else:
+            status = "RUNNING"
+        return "%s [%s] (%s shards): %s" % (
+            str(self.command),
+            self.key,
+            self.num_shards,
+            status,
+        )
+
+    @property
+    def shards(self):
+
+        """
+        :return: A list with the most recent log for each shard (or None, for shards that haven't started)
+        """
+
+        shards = [None] * self.num_shards
+        for log in self.logs.order_by("start_time"):
+            if log.shard is not None and log.shard < self.num_shards:
+                shards[log.shard] = log
+        return shards
+
+    @property
+    def progress(self):
+
+        """
+        :return: A dictionary summarizing the combined progress of the shards
+        """
+
+        shards = self.shards
+        return {
+            "num_shards": self.num_shards,
+            "started": len([log for log in shards if log]),
+            "finished": len([log for log in shards if log and log.end_time]),
+            "failed": len([log for log in shards if log and log.error_class]),
+            "items": sum([log.metrics.get("items", 0) for log in shards if log]),
+        }
+
+    def update_status(self):
+
+        """
+        Marks the group as finished if every shard has a successful log.
+
+        :return: True if the group has finished
+        """
+
+        if not self.end_time:
+            finished = (
+                self.logs.filter(end_time__isnull=False, error_class__isnull=True)
+                .values("shard")
+                .distinct()
+                .count()
+            )
+            if finished >= self.num_shards:
+                self.end_time = (
+                    self.logs.order_by("-end_time").values_list("end_time", flat=True)[0]
+                )
+                self.save()
+        return self.end_time is not None
+
+
+class CommandStats(BasicExtendedModel):
+
+    """
+    A rollup of the run history of a single Command, which gets updated whenever one of the command's logs is
+    closed out (and which can be backfilled in bulk with `python manage.py refresh_command_stats`). This allows the
+    dashboard and dependency checks to look up a command's history without scanning the CommandLog table. The
+    duration percentiles are only recomputed when they're read (see `CommandStatsManager.refresh_durations`).
+    """
+
+    command = models.OneToOneField(
+        "django_commander.Command",
+        on_delete=models.CASCADE,
+        related_name="stats",
+        help_text="The command these statistics summarize",
+    )
+    run_count = models.IntegerField(
+        default=0, help_text="The total number of logs for the command"
+    )
+    success_count = models.IntegerField(
+        default=0, help_text="The number of runs that finished without an error"
+    )
+    failure_count = models.IntegerField(
+        default=0, help_text="The number of runs that raised an error"
+    )
+    p50_duration = models.FloatField(
+        null=True, help_text="The median duration of successful runs, in seconds"
+    )
+    p95_duration = models.FloatField(
+        null=True,
+        help_text="The 95th percentile duration of successful runs, in seconds",
+    )
+    durations_stale = models.BooleanField(
+        default=False,
+        help_text="Whether runs have finished since the duration percentiles were computed",
+    )
+    last_run_time = models.DateTimeField(
+        null=True, help_text="The time at which the command was most recently started"
+    )
+    last_success_time = models.DateTimeField(
+        null=True,
+        help_text="The time at which the command most recently finished successfully",
+    )
+    last_duration = models.FloatField(
+        null=True, help_text="The duration of the most recently finished run, in seconds"
+    )
+    last_metrics = models.JSONField(
+        default=dict,
+        help_text="The metrics recorded by the most recently finished run",
+        encoder=DjangoJSONEncoder,
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True, help_text="The time at which these statistics were refreshed"
+    )
+
+    objects = CommandStatsManager()
+
+    def __str__(self):
+
+        return "%s: %s runs (%s succeeded, %s failed)" % (
+            str(self.command),
+            self.run_count,
+            self.success_count,
+            self.failure_count,
+        )
+
+
+def get_command_log_through_models():
+
+    """
+    Finds the through tables for the `command_logs` relations on every concrete `LoggedExtendedModel`, so that
+    operations on logs can be applied to their links in bulk.
+
+    :return: A list of `(through_model, object_column, log_column)` tuples, where the columns are the attribute names
+        of the foreign keys to the related object and to the `CommandLog`, respectively
+    """
+
+    through_models = []
+    for rel in CommandLog._meta.related_objects:
+        if rel.many_to_many and issubclass(rel.related_model, LoggedExtendedModel):
+            through = rel.through
+            through_models.append(
+                (
+                    through,
+                    through._meta.get_field(rel.field.m2m_field_name()).attname,
+                    through._meta.get_field(rel.field.m2m_reverse_field_name()).attname,
+                )
+            )
+    return through_models
+
+
+def consolidate_command_logs(commands=None):
+
+    """
+    Collapses the logs for each of the provided commands (or every command, if none are provided) into a single log.
+    For each command, the most recent log is kept and given the start time of the earliest log. Every link between a
+    `LoggedExtendedModel` object and one of the extra logs is repointed to the kept log with a single `UPDATE` per
+    through table (after dropping the links that would be duplicated), and the extra logs are then deleted in a single
+    statement. Each command is consolidated inside its own transaction.
+
+    :param commands: (Optional) an iterable of `Command` objects
+    :return: A list of the consolidated logs
+    """
+
+    if commands is None:
+        commands = Command.objects.filter(
+            pk__in=CommandLog.objects.order_by()
+            .values("command_id")
+            .annotate(num_logs=models.Count("pk"))
+            .filter(num_logs__gt=1)
+            .values("command_id")
+        )
+
+    through_models = get_command_log_through_models()
+    consolidated = []
+    for command in commands:
+        with transaction.atomic():
+            logs = command.logs.order_by("start_time")
+            first = logs.first()
+            if not first:
+                continue
+            last = logs.order_by("-start_time").select_for_update()[0]
+            extra_ids = list(logs.exclude(pk=last.pk).values_list("pk", flat=True))
+            if extra_ids:
+                for through, object_column, log_column in through_models:
+                    extra_links = through.objects.filter(
+                        **{"{}__in".format(log_column): extra_ids}
+                    )
+                    # Drop links to objects that are already linked to the target log
+                    extra_links.filter(
+                        **{
+                            "{}__in".format(object_column): through.objects.filter(
+                                **{log_column: last.pk}
+                            ).values(object_column)
+                        }
+                    ).delete()
+                    # Drop links to objects that are linked to more than one of the extra logs, keeping one of them
+                    extra_links.exclude(
+                        pk__in=extra_links.order_by()
+                        .values(object_column)
+                        .annotate(keep_pk=models.Min("pk"))
+                        .values("keep_pk")
+                    ).delete()
+                    extra_links.update(**{log_column: last.pk})
+                CommandLog.objects.filter(pk__in=extra_ids).delete()
+            last.start_time = first.start_time
+            last.save()
+        consolidated.append(last)
+
+    if consolidated:
+        CommandStats.objects.refresh(command_ids=[log.command_id for log in consolidated])
+
+    return consolidated
+
 
 from django.db.models.signals import m2m_changed
 
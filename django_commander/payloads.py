@@ -0,0 +1,143 @@
+import mmap
+import os
+import pickle
+import tempfile
+import uuid
+
+from django.conf import settings
+
+
+def get_spool_path():
+
+    """
+    Returns the folder that large payloads are spooled to. Defaults to `/dev/shm` when it's available, so that spooled
+    payloads live in shared memory rather than on disk, and otherwise falls back to the system's temp folder.
+
+    :return: A folder path
+    """
+
+    if settings.DJANGO_COMMANDER_SPOOL_PATH:
+        return settings.DJANGO_COMMANDER_SPOOL_PATH
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+class PickledPayload(object):
+
+    """
+    A payload that has already been pickled, so that it isn't pickled a second time when it's sent to a
+    multiprocessing worker. The worker unpickles it with `load`.
+
+    :param data: The pickle stream
+    :param buffers: A list of the pickle's out-of-band buffers, as bytes
+    """
+
+    def __init__(self, data, buffers):
+
+        self.data = data
+        self.buffers = buffers
+
+    @property
+    def size(self):
+        return len(self.data) + sum([len(b) for b in self.buffers])
+
+    def load(self):
+
+        """
+        Unpickles the payload
+
+        :return: The original payload
+        """
+
+        return pickle.loads(self.data, buffers=self.buffers)
+
+
+class SpooledPayload(object):
+
+    """
+    A small, picklable reference to a payload that has been written to a file. Multiprocessing workers receive the
+    reference instead of the payload itself, and map the file into memory rather than reading it through a pipe.
+    Values that support out-of-band pickling with protocol 5 (e.g. NumPy arrays and `pickle.PickleBuffer` objects) are
+    stored as separate buffers, and are loaded as views into the mapped file without being copied.
+
+    :param path: The location of the spooled file
+    :param segments: A list of `(offset, length)` tuples; the first is the pickle stream and the rest are its buffers
+    """
+
+    def __init__(self, path, segments):
+
+        self.path = path
+        self.segments = segments
+
+    @property
+    def size(self):
+        return sum([length for offset, length in self.segments])
+
+    def load(self):
+
+        """
+        Maps the spooled file into memory and unpickles the payload
+
+        :return: The original payload
+        """
+
+        with open(self.path, "rb") as infile:
+            mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        # The mapping stays open for as long as any of the loaded values reference it
+        view = memoryview(mapped)
+        offset, length = self.segments[0]
+        return pickle.loads(
+            view[offset : offset + length],
+            buffers=[view[o : o + l] for o, l in self.segments[1:]],
+        )
+
+    def unlink(self, *args):
+
+        """
+        Deletes the spooled file. Accepts and ignores positional arguments so it can be used as a pool callback.
+        """
+
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def spool_payload(payload, threshold=None):
+
+    """
+    Pickles a payload and, if it's larger than the threshold, writes it to a file in the spool folder (see
+    `get_spool_path`) once, so that it doesn't have to be copied through a multiprocessing pipe. Smaller payloads are
+    returned in their pickled form, so that they're only serialized once on their way to the worker.
+
+    :param payload: Any picklable value
+    :param threshold: (Optional) the minimum size in bytes to spool; defaults to `DJANGO_COMMANDER_SPOOL_THRESHOLD`, \
+    and payloads are never spooled if it's None
+    :return: A `SpooledPayload`, or a `PickledPayload` if it's under the threshold (or the original payload if \
+    spooling is disabled)
+    """
+
+    if threshold is None:
+        threshold = settings.DJANGO_COMMANDER_SPOOL_THRESHOLD
+    if threshold is None:
+        return payload
+
+    buffers = []
+    data = pickle.dumps(payload, protocol=5, buffer_callback=buffers.append)
+    buffers = [b.raw() for b in buffers]
+    if len(data) + sum([b.nbytes for b in buffers]) < threshold:
+        return PickledPayload(data, [b.tobytes() for b in buffers])
+
+    path = os.path.join(
+        get_spool_path(), "django_commander-{}.payload".format(uuid.uuid4().hex)
+    )
+    segments = []
+    offset = 0
+    with open(path, "wb") as output:
+        for segment in [memoryview(data)] + buffers:
+            output.write(segment)
+            segments.append((offset, segment.nbytes))
+            offset += segment.nbytes
+
+    return SpooledPayload(path, segments)
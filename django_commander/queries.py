@@ -0,0 +1,116 @@
+import collections
+import re
+import time
+
+from django.db import connections
+
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%s|\?")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def get_sql_shape(sql):
+
+    """
+    Reduces a SQL statement to its "shape" by replacing literals and parameter placeholders with `?` and collapsing
+    lists of values, so that the same query run for different rows is counted together.
+
+    :param sql: A SQL statement
+    :return: The normalized statement
+    """
+
+    sql = _STRING_LITERAL.sub("?", sql)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    sql = _PLACEHOLDER.sub("?", sql)
+    sql = _PLACEHOLDER_LIST.sub("(...)", sql)
+    return _WHITESPACE.sub(" ", sql).strip()
+
+
+class QueryLimitExceeded(Exception):
+    pass
+
+
+class QueryCounter(object):
+
+    """
+    A database execute wrapper (see `connection.execute_wrapper` in the Django docs) that counts and times the queries
+    a command runs, broken down by the stage the command was in at the time (see `BasicCommand.stage`).
+
+    :param top: The number of most frequently repeated query shapes to report for each stage
+    """
+
+    def __init__(self, top=5):
+
+        self.top = top
+        self.stage = "run"
+        self.counts = collections.Counter()
+        self.seconds = collections.Counter()
+        self.shapes = collections.defaultdict(collections.Counter)
+        self._installed = []
+
+    def __call__(self, execute, sql, params, many, context):
+
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.counts[self.stage] += 1
+            self.seconds[self.stage] += time.perf_counter() - start
+            self.shapes[self.stage][get_sql_shape(sql)] += 1
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def install(self):
+
+        """
+        Adds the counter to all of the current thread's database connections.
+        """
+
+        for connection in connections.all():
+            connection.execute_wrappers.append(self)
+            self._installed.append(connection)
+
+    def uninstall(self):
+
+        for connection in self._installed:
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+        self._installed = []
+
+    def get_report(self):
+
+        """
+        :return: A dictionary mapping each stage to its query `count`, total `seconds` spent in the database, and \
+        its `top` repeated query shapes as `[shape, count]` pairs
+        """
+
+        return {
+            stage: {
+                "count": self.counts[stage],
+                "seconds": round(self.seconds[stage], 6),
+                "top": [
+                    [shape, count]
+                    for shape, count in self.shapes[stage].most_common(self.top)
+                ],
+            }
+            for stage in self.counts
+        }
+
+    def check(self, max_queries):
+
+        """
+        :param max_queries: The maximum number of queries allowed, or None for no limit
+        :raises QueryLimitExceeded: If the counter has seen more queries than that
+        """
+
+        if max_queries is not None and self.total > max_queries:
+            raise QueryLimitExceeded(
+                "Ran {} queries, more than the limit of {}: {}".format(
+                    self.total, max_queries, self.get_report()
+                )
+            )
@@ -0,0 +1,112 @@
+import os
+import sqlite3
+import tempfile
+import time
+
+from django.conf import settings
+
+
+def get_rate_limit_path():
+
+    """
+    :return: The SQLite file that rate limiter state is stored in; defaults to a file in the system's temp folder, \
+    which is shared by all of the commands running on the same machine
+    """
+
+    return settings.DJANGO_COMMANDER_RATE_LIMIT_PATH or os.path.join(
+        tempfile.gettempdir(), "django_commander_rate_limits.sqlite3"
+    )
+
+
+class RateLimiter(object):
+
+    """
+    A token bucket rate limiter whose state is kept in a SQLite file, so that it's shared by every process that uses
+    the same file, including all of the workers in a multiprocessing pool. Each key has its own bucket, which refills
+    at `rate` tokens per second up to `capacity` tokens. Rather than sleeping for a fixed interval, `acquire` waits
+    exactly until the next token is available, so throughput can run right up to the allowed rate.
+
+    :param rate: The number of tokens added to each bucket per second (i.e. the allowed requests per second)
+    :param capacity: (Optional) the maximum number of tokens a bucket can hold, which allows short bursts; defaults \
+    to `rate` (or 1, if the rate is lower)
+    :param path: (Optional) the SQLite file to use; defaults to `get_rate_limit_path()`
+    """
+
+    def __init__(self, rate, capacity=None, path=None):
+
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, self.rate))
+        self.path = path or get_rate_limit_path()
+        self._connection = None
+        self._pid = None
+
+    def _get_connection(self):
+
+        # Connections can't be shared with forked processes, so each process opens its own
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(
+                self.path, timeout=60, isolation_level=None
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._pid = os.getpid()
+        return self._connection
+
+    def try_acquire(self, key="default", tokens=1):
+
+        """
+        Takes tokens from a bucket if they're available.
+
+        :param key: The bucket to take tokens from
+        :param tokens: The number of tokens to take
+        :return: 0 if the tokens were taken, otherwise the number of seconds until they'll be available
+        """
+
+        connection = self._get_connection()
+        # Lock the database for writing so that the read and update happen atomically across processes
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = connection.execute(
+                "SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            if row:
+                available = min(self.capacity, row[0] + (now - row[1]) * self.rate)
+            else:
+                available = self.capacity
+            if available >= tokens:
+                available -= tokens
+                wait = 0
+            else:
+                wait = (tokens - available) / self.rate
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated_at) "
+                "VALUES (?, ?, ?)",
+                (key, available, now),
+            )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        return wait
+
+    def acquire(self, key="default", tokens=1):
+
+        """
+        Blocks until tokens are available in a bucket, and then takes them.
+
+        :param key: The bucket to take tokens from
+        :param tokens: The number of tokens to take
+        :return: The number of seconds spent waiting
+        """
+
+        waited = 0
+        while True:
+            wait = self.try_acquire(key=key, tokens=tokens)
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
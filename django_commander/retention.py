@@ -0,0 +1,229 @@
+import datetime
+import gzip
+import json
+import os
+import uuid
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from django_commander.models import (
+    Command,
+    CommandLog,
+    get_command_log_through_models,
+)
+
+
+def get_retention_policy(command_name):
+
+    """
+    Looks up the log retention policy for a command. Policies are dictionaries with any of the following keys:
+
+    * `keep_last`: Always keep the N most recent logs for each set of parameters
+    * `keep_successes_days`: Keep successful runs that started within the last X days
+    * `keep_failures`: Keep every run that raised an error (defaults to True)
+
+    A log is kept if any of these rules apply to it, and runs that are still in progress are never expired. Policies
+    defined in the `DJANGO_COMMANDER_LOG_RETENTION` setting (keyed by command name) take precedence over a
+    `log_retention` attribute on the command class, and commands without either fall back to the "default" policy in
+    the setting, if there is one.
+
+    :param command_name: The name of the command
+    :return: The retention policy dictionary, or None if the command's logs should be kept indefinitely
+    """
+
+    from django_commander.commands import commands
+
+    policies = settings.DJANGO_COMMANDER_LOG_RETENTION
+    if command_name in policies:
+        return policies[command_name]
+    if getattr(commands.get(command_name), "log_retention", None) is not None:
+        return commands[command_name].log_retention
+    return policies.get("default", None)
+
+
+def get_expired_logs(policy, logs=None):
+
+    """
+    Returns the logs that have expired under a retention policy.
+
+    :param policy: A retention policy dictionary (see `get_retention_policy`)
+    :param logs: (Optional) a `CommandLog` queryset to filter; defaults to all logs
+    :return: A queryset of expired logs
+    """
+
+    if logs is None:
+        logs = CommandLog.objects.all()
+    keep_last = policy.get("keep_last", None)
+    keep_successes_days = policy.get("keep_successes_days", None)
+    if keep_last is None and keep_successes_days is None:
+        return logs.none()
+
+    logs = logs.filter(Q(end_time__isnull=False) | Q(error_class__isnull=False))
+    if policy.get("keep_failures", True):
+        logs = logs.filter(error_class__isnull=True)
+    if keep_last is not None:
+        # Logs older than the Nth most recent log for the same command; commands with fewer than N logs have a null
+        # cutoff and are excluded by the comparison
+        logs = logs.annotate(
+            retention_cutoff=Subquery(
+                CommandLog.objects.filter(command_id=OuterRef("command_id"))
+                .order_by("-start_time")
+                .values("start_time")[keep_last - 1 : keep_last]
+            )
+        ).filter(start_time__lt=F("retention_cutoff"))
+    if keep_successes_days is not None:
+        logs = logs.exclude(
+            error_class__isnull=True,
+            start_time__gte=timezone.now()
+            - datetime.timedelta(days=keep_successes_days),
+        )
+
+    return logs
+
+
+def _archive_logs(log_ids, path):
+
+    """
+    Appends the specified logs, along with the IDs of the objects linked to them, to a gzipped JSONL file.
+
+    :param log_ids: A list of `CommandLog` primary keys
+    :param path: The file to append to
+    """
+
+    related = defaultdict(lambda: defaultdict(list))
+    for through, object_column, log_column in get_command_log_through_models():
+        label = through._meta.get_field(object_column).related_model._meta.label
+        for log_id, object_id in through.objects.filter(
+            **{"{}__in".format(log_column): log_ids}
+        ).values_list(log_column, object_column):
+            related[log_id][label].append(object_id)
+
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with gzip.open(path, "at", encoding="utf8") as output:
+        for log in CommandLog.objects.filter(pk__in=log_ids).select_related("command"):
+            record = {
+                "id": log.pk,
+                "command_id": log.command_id,
+                "command_name": log.command.name,
+                "command_parameters": log.command.parameters,
+                "start_time": log.start_time,
+                "end_time": log.end_time,
+                "options": log.options,
+                "error_class": log.error_class,
+                "error_message": log.error_message,
+                "error_digest": log.error_digest,
+                "error_traceback": log.traceback,
+                "related": related[log.pk],
+            }
+            output.write(json.dumps(record, cls=DjangoJSONEncoder) + "\n")
+
+
+def apply_log_retention(command_names=None, dry_run=False, archive=True, chunk_size=1000):
+
+    """
+    Applies the retention policy for each command (see `get_retention_policy`) to its logs. Expired logs are archived
+    to `DJANGO_COMMANDER_ARCHIVE_PATH/<command name>/` as gzipped JSONL files and then deleted, one chunk at a time,
+    so that a log is never deleted before it has been written to the archive.
+
+    :param command_names: (Optional) a list of command names to apply retention to; defaults to all commands
+    :param dry_run: If True, only counts the logs that would be expired
+    :param archive: If False, expired logs are deleted without being archived
+    :param chunk_size: The number of logs to archive and delete per transaction
+    :return: A dictionary mapping command names to the number of logs that were (or would be) expired
+    """
+
+    if command_names is None:
+        command_names = (
+            Command.objects.order_by("name").values_list("name", flat=True).distinct()
+        )
+
+    expired_counts = {}
+    for command_name in command_names:
+        policy = get_retention_policy(command_name)
+        if not policy:
+            continue
+        expired = get_expired_logs(
+            policy, logs=CommandLog.objects.filter(command__name=command_name)
+        )
+        if dry_run:
+            expired_counts[command_name] = expired.count()
+            continue
+
+        path = os.path.join(
+            settings.DJANGO_COMMANDER_ARCHIVE_PATH,
+            command_name,
+            "{}-{}.jsonl.gz".format(
+                timezone.now().strftime("%Y%m%dT%H%M%S"), uuid.uuid4().hex[:8]
+            ),
+        )
+        expired_counts[command_name] = 0
+        last_pk = 0
+        while True:
+            log_ids = list(
+                expired.filter(pk__gt=last_pk)
+                .order_by("pk")
+                .values_list("pk", flat=True)[:chunk_size]
+            )
+            if not log_ids:
+                break
+            if archive:
+                _archive_logs(log_ids, path)
+            with transaction.atomic():
+                CommandLog.objects.filter(pk__in=log_ids).delete()
+            expired_counts[command_name] += len(log_ids)
+            last_pk = log_ids[-1]
+
+    return expired_counts
+
+
+def iter_archived_logs(command_name=None, since=None, until=None, parameters=None):
+
+    """
+    Iterates over archived logs without restoring them to the database.
+
+    :param command_name: (Optional) only return logs for this command
+    :param since: (Optional) only return logs that started at or after this datetime
+    :param until: (Optional) only return logs that started before this datetime
+    :param parameters: (Optional) a dictionary of parameter values that the command must match
+    :return: Yields archived log records as dictionaries, with `start_time` and `end_time` parsed into datetimes
+    """
+
+    root = settings.DJANGO_COMMANDER_ARCHIVE_PATH
+    if command_name:
+        command_names = [command_name]
+    elif os.path.exists(root):
+        command_names = sorted(os.listdir(root))
+    else:
+        command_names = []
+
+    for name in command_names:
+        folder = os.path.join(root, name)
+        if not os.path.isdir(folder):
+            continue
+        for filename in sorted(os.listdir(folder)):
+            if not filename.endswith(".jsonl.gz"):
+                continue
+            with gzip.open(os.path.join(folder, filename), "rt", encoding="utf8") as infile:
+                for line in infile:
+                    record = json.loads(line)
+                    for field in ["start_time", "end_time"]:
+                        if record[field]:
+                            record[field] = parse_datetime(record[field])
+                    if since and record["start_time"] < since:
+                        continue
+                    if until and record["start_time"] >= until:
+                        continue
+                    if parameters and any(
+                        record["command_parameters"].get(k) != v
+                        for k, v in parameters.items()
+                    ):
+                        continue
+                    yield record
@@ -0,0 +1,104 @@
+import random
+import time
+
+
+class RetryPolicy(object):
+
+    """
+    Describes how a command should retry `download` calls that raise an exception. Delays grow exponentially with each
+    attempt, up to `max_delay`, and with `jitter` each delay is drawn uniformly between zero and that value, so that
+    workers that failed at the same time don't all retry at the same time.
+
+    :param max_attempts: The maximum number of times to call `download` for an item, including the first attempt
+    :param delay: The delay before the first retry, in seconds
+    :param max_delay: The maximum delay between attempts, in seconds
+    :param jitter: Whether to randomize the delays
+    :param retry_on: A tuple of exception classes that should be retried; anything else is raised immediately
+    """
+
+    def __init__(
+        self,
+        max_attempts=3,
+        delay=1.0,
+        max_delay=60.0,
+        jitter=True,
+        retry_on=(Exception,),
+    ):
+
+        self.max_attempts = max_attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retry_on = tuple(retry_on)
+
+    def should_retry(self, exception, attempt):
+
+        """
+        :param exception: The exception that was raised
+        :param attempt: The number of attempts that have been made so far
+        :return: Whether to make another attempt
+        """
+
+        return attempt < self.max_attempts and isinstance(exception, self.retry_on)
+
+    def get_delay(self, attempt):
+
+        """
+        :param attempt: The number of attempts that have been made so far
+        :return: The number of seconds to wait before the next attempt
+        """
+
+        delay = min(self.max_delay, self.delay * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+
+class CircuitBreaker(object):
+
+    """
+    Pauses a command after a run of consecutive `download` failures, on the assumption that whatever it's downloading
+    from is unavailable and that hammering it with more requests won't help. Once `cooldown` seconds have passed, the
+    next call is let through; if it fails too, the breaker opens again straight away.
+
+    :param failure_threshold: The number of consecutive failures that opens the breaker
+    :param cooldown: The number of seconds to pause for once it's open
+    """
+
+    def __init__(self, failure_threshold=10, cooldown=60.0):
+
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def record_success(self):
+
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.time()
+            self.trips += 1
+            # Let a single call through after the cooldown before opening again
+            self.failures = self.failure_threshold - 1
+
+    def wait(self):
+
+        """
+        Blocks until the breaker's cooldown has passed, if it's open.
+        """
+
+        if self.is_open:
+            remaining = self.opened_at + self.cooldown - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+            self.opened_at = None
@@ -0,0 +1,278 @@
+import collections
+import hashlib
+import io
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from django.conf import settings
+
+
+def get_transfer_config():
+
+    """
+    :return: A `TransferConfig` that splits objects larger than `DJANGO_COMMANDER_S3_MULTIPART_THRESHOLD` into parts \
+    of `DJANGO_COMMANDER_S3_MULTIPART_CHUNKSIZE` bytes, which are uploaded and downloaded in parallel
+    """
+
+    return TransferConfig(
+        multipart_threshold=settings.DJANGO_COMMANDER_S3_MULTIPART_THRESHOLD,
+        multipart_chunksize=settings.DJANGO_COMMANDER_S3_MULTIPART_CHUNKSIZE,
+        max_concurrency=settings.DJANGO_COMMANDER_S3_CONCURRENCY,
+    )
+
+
+def get_etag(data):
+
+    """
+    Computes the ETag that S3 assigns to an object uploaded with `get_transfer_config`, so that a local copy of an
+    object can be validated without having to look up its ETag after every upload. (Objects encrypted with KMS get
+    different ETags, in which case their local copies are simply refreshed the first time they're read.)
+
+    :param data: The object's contents, as bytes
+    :return: The ETag, including its quotes
+    """
+
+    config = get_transfer_config()
+    if len(data) < config.multipart_threshold:
+        return '"{}"'.format(hashlib.md5(data).hexdigest())
+    digests = [
+        hashlib.md5(data[i : i + config.multipart_chunksize]).digest()
+        for i in range(0, len(data), config.multipart_chunksize)
+    ]
+    return '"{}-{}"'.format(hashlib.md5(b"".join(digests)).hexdigest(), len(digests))
+
+
+class S3Store(object):
+
+    """
+    Reads and writes cache objects in an S3 bucket using a small thread pool, so that the round trips for many keys
+    can overlap rather than running one after another. Keys can be fetched ahead of time with `prefetch`, and writes
+    can be queued with `write_behind` and uploaded in the background until `flush` is called. Large objects are
+    transferred in parallel parts (see `get_transfer_config`).
+
+    If a local copy of an object exists, `get_validated` can be used instead of `get` to check the copy's ETag against
+    S3 with a conditional `GET` request, which only returns the object if the copy is stale.
+
+    :param bucket: The S3 bucket
+    :param concurrency: (Optional) the number of requests to run at once; defaults to \
+    `DJANGO_COMMANDER_S3_CONCURRENCY`
+    :param max_prefetched: (Optional) the maximum number of prefetched objects to hold in memory; the oldest are \
+    dropped if they aren't read in time. Defaults to four times the concurrency.
+    """
+
+    # Returned by `get_validated` when the local copy of an object is up to date
+    NOT_MODIFIED = object()
+
+    def __init__(self, bucket, concurrency=None, max_prefetched=None):
+
+        self.bucket = bucket
+        self.concurrency = concurrency or settings.DJANGO_COMMANDER_S3_CONCURRENCY
+        self.max_prefetched = max_prefetched or self.concurrency * 4
+        self.stats = collections.Counter()
+        self._client = None
+        self._executor = None
+        self._pid = None
+        self._prefetched = collections.OrderedDict()
+        self._uploads = collections.deque()
+        self._lock = threading.Lock()
+
+    def _check_process(self):
+
+        # Clients and threads don't survive a fork, so each process creates its own
+        if self._pid != os.getpid():
+            self._client = boto3.client(
+                "s3", config=Config(max_pool_connections=self.concurrency)
+            )
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+            self._prefetched = collections.OrderedDict()
+            self._uploads = collections.deque()
+            self._pid = os.getpid()
+
+    @property
+    def client(self):
+
+        self._check_process()
+        return self._client
+
+    @property
+    def executor(self):
+
+        self._check_process()
+        return self._executor
+
+    def _get(self, key):
+
+        output = io.BytesIO()
+        try:
+            self.client.download_fileobj(
+                self.bucket, key, output, Config=get_transfer_config()
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ["404", "NoSuchKey"]:
+                return None
+            raise
+        return output.getvalue()
+
+    def _get_validated(self, key, local_copy):
+
+        # A single conditional request both validates the local copy and, if it's stale, returns the new contents
+        kwargs = {"Bucket": self.bucket, "Key": key}
+        if local_copy and local_copy[0]:
+            kwargs["IfNoneMatch"] = local_copy[0]
+        try:
+            response = self.client.get_object(**kwargs)
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code in ["304", "NotModified"]:
+                return self.NOT_MODIFIED, local_copy[0]
+            if code in ["404", "NoSuchKey"]:
+                return None, None
+            raise
+        etag = response["ETag"]
+        if response["ContentLength"] < get_transfer_config().multipart_threshold:
+            return response["Body"].read(), etag
+        # Large objects are downloaded in parallel parts instead. If the object is replaced in the meantime, the copy
+        # is simply saved with the old ETag, and is refreshed again the next time it's read.
+        response["Body"].close()
+        return self._get(key), etag
+
+    def _put(self, key, data):
+
+        self.client.upload_fileobj(
+            io.BytesIO(data), self.bucket, key, Config=get_transfer_config()
+        )
+
+    def prefetch(self, keys, local_copies=None):
+
+        """
+        Starts downloading keys in the background, so that a later `get` for them returns without waiting.
+
+        :param keys: A list of S3 keys
+        :param local_copies: (Optional) a dictionary mapping keys to the `(etag, size)` of their local copies (or \
+        None, for keys without one); if provided, the keys are fetched for `get_validated` rather than `get`
+        """
+
+        with self._lock:
+            for key in keys:
+                if key in self._prefetched:
+                    continue
+                if local_copies is not None:
+                    self._prefetched[key] = self.executor.submit(
+                        self._get_validated, key, local_copies.get(key)
+                    )
+                else:
+                    self._prefetched[key] = self.executor.submit(self._get, key)
+                self.stats["prefetched"] += 1
+                while len(self._prefetched) > self.max_prefetched:
+                    self._prefetched.popitem(last=False)[1].cancel()
+
+    def get(self, key):
+
+        """
+        :param key: The S3 key
+        :return: The object's contents, or None if it doesn't exist
+        """
+
+        with self._lock:
+            future = self._prefetched.pop(key, None)
+            if future and not future.cancelled():
+                self.stats["prefetch_hits"] += 1
+            else:
+                future = None
+        if future:
+            return future.result()
+        return self._get(key)
+
+    def get_validated(self, key, local_copy=None):
+
+        """
+        :param key: The S3 key
+        :param local_copy: (Optional) the `(etag, size)` of a local copy of the object
+        :return: A tuple of the object's contents (or `NOT_MODIFIED` if the local copy matches, or None if the object \
+        doesn't exist) and its ETag
+        """
+
+        with self._lock:
+            future = self._prefetched.pop(key, None)
+            if future and not future.cancelled():
+                self.stats["prefetch_hits"] += 1
+            else:
+                future = None
+        if future:
+            return future.result()
+        return self._get_validated(key, local_copy)
+
+    def put(self, key, data):
+
+        """
+        Uploads an object, waiting for it to finish.
+
+        :param key: The S3 key
+        :param data: The object's contents, as bytes
+        """
+
+        with self._lock:
+            self._prefetched.pop(key, None)
+        self._put(key, data)
+        with self._lock:
+            self.stats["uploads"] += 1
+
+    def write_behind(self, key, data):
+
+        """
+        Queues an object to be uploaded in the background. If too many uploads are already pending, waits for the
+        oldest to finish first, so that the data waiting to be uploaded doesn't grow without limit.
+
+        :param key: The S3 key
+        :param data: The object's contents, as bytes
+        """
+
+        while True:
+            with self._lock:
+                self._prefetched.pop(key, None)
+                if len(self._uploads) < self.concurrency * 2:
+                    self._uploads.append(self.executor.submit(self._put, key, data))
+                    self.stats["uploads"] += 1
+                    return
+                oldest = self._uploads.popleft()
+            # Other threads can keep reading while this one waits
+            oldest.result()
+
+    def delete(self, key):
+
+        """
+        Waits for any pending uploads and then deletes an object.
+
+        :param key: The S3 key
+        """
+
+        self.flush()
+        with self._lock:
+            self._prefetched.pop(key, None)
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def flush(self):
+
+        """
+        Waits for all of the pending uploads to finish, raising the first error if any of them failed.
+        """
+
+        error = None
+        while True:
+            with self._lock:
+                if not self._uploads:
+                    break
+                upload = self._uploads.popleft()
+            try:
+                upload.result()
+            except Exception as e:
+                error = error or e
+        if error:
+            raise error
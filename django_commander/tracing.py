@@ -0,0 +1,263 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+_local = threading.local()
+
+
+def get_trace_path():
+
+    """
+    :return: The file that the JSONL exporter appends spans to; defaults to a file in the system's temp folder, which \
+    is shared by all of the commands running on the same machine
+    """
+
+    return settings.DJANGO_COMMANDER_TRACE_PATH or os.path.join(
+        tempfile.gettempdir(), "django_commander_traces.jsonl"
+    )
+
+
+class _NoopSpan(object):
+
+    """
+    Returned by `start_span` when tracing is disabled, so that instrumented code pays for little more than a function
+    call.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def set_attribute(self, name, value):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span(object):
+
+    """
+    A span recorded by `JsonLinesTracer`. Its IDs follow the W3C Trace Context format that OpenTelemetry uses, so the
+    exported spans can be loaded into the same tools.
+
+    :param tracer: The tracer that exports the span when it ends
+    :param name: The name of the span
+    :param attributes: A dictionary of attributes
+    """
+
+    def __init__(self, tracer, name, attributes):
+
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.trace_id = None
+        self.span_id = None
+        self.parent_span_id = None
+        self.start_time = None
+        self.end_time = None
+        self.status = "OK"
+        self._previous = None
+
+    def set_attribute(self, name, value):
+
+        self.attributes[name] = value
+
+    def __enter__(self):
+
+        self._previous = getattr(_local, "span", None)
+        parent = self._previous or getattr(_local, "remote_parent", None)
+        if parent:
+            self.trace_id, self.parent_span_id = parent.trace_id, parent.span_id
+        else:
+            self.trace_id = os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.start_time = time.time_ns()
+        _local.span = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+
+        self.end_time = time.time_ns()
+        if exc_type is not None:
+            self.status = "ERROR"
+            self.attributes["error_class"] = exc_type.__name__
+        _local.span = self._previous
+        self.tracer.export(self)
+        return False
+
+    def to_dict(self):
+
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "start_time_unix_nano": self.start_time,
+            "end_time_unix_nano": self.end_time,
+            "status": self.status,
+            "attributes": self.attributes,
+            "pid": os.getpid(),
+        }
+
+
+class _RemoteParent(object):
+    def __init__(self, trace_id, span_id):
+
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+
+class JsonLinesTracer(object):
+
+    """
+    The default tracer, which has no dependencies. Each finished span is appended to a file as a line of JSON with a
+    single write, so that the workers in a multiprocessing pool can share the file.
+
+    :param path: The file to append spans to
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self._lock = threading.Lock()
+
+    def start_span(self, name, attributes):
+
+        return Span(self, name, attributes)
+
+    def export(self, span):
+
+        line = (json.dumps(span.to_dict(), default=str) + "\n").encode("utf8")
+        folder = os.path.dirname(self.path)
+        with self._lock:
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder, exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+    def get_traceparent(self):
+
+        span = getattr(_local, "span", None) or getattr(_local, "remote_parent", None)
+        if span:
+            return "00-{}-{}-01".format(span.trace_id, span.span_id)
+        return None
+
+    def set_traceparent(self, traceparent):
+
+        match = _TRACEPARENT.match(traceparent or "")
+        _local.span = None
+        _local.remote_parent = _RemoteParent(*match.groups()) if match else None
+
+
+class OpenTelemetryTracer(object):
+
+    """
+    Records spans with the OpenTelemetry API, so that they're sent wherever the process's tracer provider exports
+    them. This requires the `opentelemetry-api` package, and the provider has to be configured separately (e.g. with
+    `opentelemetry-sdk` or `opentelemetry-instrument`).
+    """
+
+    def __init__(self):
+
+        from opentelemetry import context, propagate, trace
+
+        self._context = context
+        self._propagate = propagate
+        self._tracer = trace.get_tracer("django_commander")
+
+    def start_span(self, name, attributes):
+
+        return self._tracer.start_as_current_span(name, attributes=attributes)
+
+    def get_traceparent(self):
+
+        carrier = {}
+        self._propagate.inject(carrier)
+        return carrier.get("traceparent")
+
+    def set_traceparent(self, traceparent):
+
+        carrier = {"traceparent": traceparent} if traceparent else {}
+        self._context.attach(self._propagate.extract(carrier))
+
+
+_tracer = None
+_tracer_key = None
+
+
+def get_tracer():
+
+    """
+    :return: The tracer selected by the `DJANGO_COMMANDER_TRACING` setting ("jsonl" or "opentelemetry"), or None if \
+    tracing is disabled
+    """
+
+    global _tracer, _tracer_key
+
+    key = (settings.DJANGO_COMMANDER_TRACING, settings.DJANGO_COMMANDER_TRACE_PATH)
+    if key != _tracer_key:
+        if not key[0]:
+            _tracer = None
+        elif key[0] == "jsonl":
+            _tracer = JsonLinesTracer(get_trace_path())
+        elif key[0] == "opentelemetry":
+            _tracer = OpenTelemetryTracer()
+        else:
+            raise ValueError(
+                "Unknown DJANGO_COMMANDER_TRACING value: {}".format(key[0])
+            )
+        _tracer_key = key
+    return _tracer
+
+
+def start_span(name, **attributes):
+
+    """
+    Starts a span, to be used as a context manager. Spans started inside of another span's block are its children,
+    and exceptions that escape the block mark the span as failed. If tracing is disabled, a shared no-op span is
+    returned.
+
+    :param name: The name of the span
+    :param attributes: Attributes to record on the span
+    :return: A span with a `set_attribute(name, value)` method
+    """
+
+    if not settings.DJANGO_COMMANDER_TRACING:
+        return NOOP_SPAN
+    return get_tracer().start_span(name, attributes)
+
+
+def get_traceparent():
+
+    """
+    :return: A W3C `traceparent` header value for the current span, to pass to another process, or None
+    """
+
+    if not settings.DJANGO_COMMANDER_TRACING:
+        return None
+    return get_tracer().get_traceparent()
+
+
+def set_traceparent(traceparent):
+
+    """
+    Makes spans started in the current thread children of a span from another process (see `get_traceparent`).
+
+    :param traceparent: A W3C `traceparent` header value, or None to start new traces again
+    """
+
+    if settings.DJANGO_COMMANDER_TRACING:
+        get_tracer().set_traceparent(traceparent)
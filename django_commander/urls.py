@@ -6,5 +6,11 @@ from django_commander import views
 app_name = "django_commander"
 urlpatterns = [
     re_path(r"^$", views.home, name="home"),
+    re_path(
+        r"^run_groups/(?P<run_group_id>\d+)$",
+        views.view_run_group,
+        name="view_run_group",
+    ),
+    re_path(r"^metrics$", views.metrics, name="metrics"),
     re_path(r"^(?P<command_id>.+)$", views.view_command, name="view_command"),
 ]
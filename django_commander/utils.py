@@ -1,9 +1,17 @@
 import traceback
 import datetime
+import functools
 import os
+import pickle
+import threading
+import time
 
-from tqdm import tqdm
-from multiprocessing import Process
+from collections.abc import Sequence
+from enum import Enum
+from pathlib import PurePath
+from typing import Union, get_type_hints
+
+from multiprocessing import Pipe, Pool, Process
 
 try:
     from inspect import signature
@@ -13,13 +21,32 @@ except ImportError:
 from pewtils import is_not_null
 from django_pewtils import reset_django_connection
 
-from django_commander.models import Command, CommandLog
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.db.models import Max, Q
+from django.db.models.deletion import Collector
+from django.utils import timezone
+
+from django_commander.models import (
+    Command,
+    CommandLog,
+    CommandRunGroup,
+    CommandStats,
+    get_error_class_name,
+)
+from django_commander.payloads import PickledPayload, SpooledPayload
+from django_commander.queries import QueryCounter, QueryLimitExceeded
+from django_commander.tracing import get_traceparent, set_traceparent, start_span
 
 
 class MissingDependencyException(Exception):
     pass
 
 
+class InvalidArgumentException(Exception):
+    pass
+
+
 def run_command_task(*args, **kwargs):
     """
     DEPRECATED
@@ -57,61 +84,444 @@ def _command_wrapper(settings_module, command_name, **params):
     commands[command_name](**params).run()
 
 
+def _start_query_counter(command, stage):
+
+    """
+    Starts counting the command's database queries, if it has `count_queries` or `max_queries` set or the
+    `DJANGO_COMMANDER_COUNT_QUERIES` setting is enabled.
+
+    :param command: The command instance
+    :param stage: The stage to attribute queries to until another one starts (see `BasicCommand.stage`)
+    :return: A tuple of the new `QueryCounter` (or None) and the command's previous one, to restore afterwards
+    """
+
+    previous = getattr(command, "_query_counter", None)
+    counter = None
+    if (
+        settings.DJANGO_COMMANDER_COUNT_QUERIES
+        or getattr(command, "count_queries", False)
+        or getattr(command, "max_queries", None) is not None
+    ):
+        counter = QueryCounter()
+        counter.stage = stage
+        counter.install()
+    command._query_counter = counter
+    command.current_stage = stage
+    return counter, previous
+
+
+def _stop_query_counter(command, counter, previous):
+
+    """
+    Stops counting the command's database queries, saves the report to the `queries` metric and restores the
+    command's previous counter.
+    """
+
+    if counter and counter._installed:
+        counter.uninstall()
+        command.metrics["queries"] = counter.get_report()
+        command.metrics["query_count"] = counter.total
+        command.metrics["query_seconds"] = round(sum(counter.seconds.values()), 6)
+    command._query_counter = previous
+
+
+class LogHeartbeat(threading.Thread):
+
+    """
+    Keeps a running command's log marked as alive by updating its `metrics_updated_at` every `interval` seconds from a
+    background thread, so that the command is reported as running (see `django_commander.exporter`) even while the
+    main thread is busy with a long stage or a single slow item and isn't flushing its metrics.
+
+    :param log_id: The primary key of the command's log
+    :param interval: The number of seconds between updates
+    """
+
+    def __init__(self, log_id, interval):
+
+        super(LogHeartbeat, self).__init__(daemon=True)
+        self.log_id = log_id
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+
+        try:
+            while not self._stopped.wait(self.interval):
+                try:
+                    CommandLog.objects.filter(
+                        pk=self.log_id, end_time__isnull=True
+                    ).update(metrics_updated_at=timezone.now())
+                except DatabaseError:
+                    # A missed beat only matters if the next ones fail too
+                    pass
+        finally:
+            connections.close_all()
+
+    def stop(self):
+
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+
 def log_command(handle):
+    @functools.wraps(handle)
     def wrapper(self, *args, **options):
-        if "num_cores" in self.options and self.options["num_cores"] > 1:
-            reset_django_connection()
-        self.command = Command.objects.create_or_update(
-            {"name": self.name, "parameters": self.parameters}
-        )
-        option_subset = {}
-        for k, v in self.options.items():
-            if k not in [
-                "no_color",
-                "settings",
-                "traceback",
-                "verbosity",
-                "pythonpath",
-                "force_color",
-            ]:
-                option_subset[k] = v
-        self.log = CommandLog.objects.create(
-            command=self.command, options=option_subset
-        )
-        self.log_id = int(self.log.pk)
-        try:
-            result = handle(self, *args, **options)
+        with start_span(
+            "command", command=self.name, method=handle.__name__
+        ) as span:
+            counter, previous_counter = _start_query_counter(self, handle.__name__)
             if "num_cores" in self.options and self.options["num_cores"] > 1:
-                reset_django_connection()
-            if self.log:
-                self.log.end_time = datetime.datetime.now()
-                try:
-                    self.log.save()
-                except:
-                    # sometimes for really long-standing processes, there's a timeout SSL error
-                    # so, we'll just fetch the log object again before saving and closing out
-                    reset_django_connection()
-                    self.log = CommandLog.objects.get(pk=self.log_id)
-                    self.log.end_time = datetime.datetime.now()
-                    self.log.save()
-            return result
-        except Exception as e:
-            tb = traceback.format_exc()
-            print(e)
-            print(tb)
-            if self.log:
-                try:
-                    self.log.error = {"traceback": tb, "exception": e}
-                    self.log.save()
-                except:
-                    self.log.error = {"traceback": str(tb), "exception": str(e)}
-                    self.log.save()
-            return None
+                ensure_usable_connections()
+            with self.stage("log"):
+                self.command = Command.objects.create_or_update(
+                    {
+                        "name": self.name,
+                        "parameters": get_serializable_arguments(self.parameters),
+                    }
+                )
+                option_subset = {}
+                for k, v in self.options.items():
+                    if k not in [
+                        "no_color",
+                        "settings",
+                        "traceback",
+                        "verbosity",
+                        "pythonpath",
+                        "force_color",
+                    ]:
+                        option_subset[k] = v
+                option_subset = get_serializable_arguments(option_subset)
+                self.log = CommandLog.objects.create(
+                    command=self.command, options=option_subset, worker=self.is_worker
+                )
+                self.log_id = int(self.log.pk)
+                span.set_attribute("log_id", self.log_id)
+                self.metrics = {}
+                self._metrics_flushed_at = time.time()
+                _join_run_group(self)
+            heartbeat = None
+            # Items logged within a run (e.g. `parse_and_save` without a pool) are covered by the run's heartbeat
+            if (
+                not self.is_worker
+                and settings.DJANGO_COMMANDER_METRICS_FLUSH_INTERVAL
+                and not getattr(self, "_heartbeat", None)
+            ):
+                heartbeat = self._heartbeat = LogHeartbeat(
+                    self.log_id, settings.DJANGO_COMMANDER_METRICS_FLUSH_INTERVAL
+                )
+                heartbeat.start()
+            if not args and not options:
+                # Commands that declare their arguments on `run` get them passed in directly
+                options = get_declared_arguments(self, handle)
+            try:
+                result = handle(self, *args, **options)
+                if heartbeat:
+                    heartbeat.stop()
+                    self._heartbeat = None
+                _stop_query_counter(self, counter, previous_counter)
+                if counter:
+                    # Checked before the log is closed, so that a run over the limit is only recorded once, as a failure
+                    counter.check(self.max_queries)
+                if not self.is_worker:
+                    # The parent measures its workers' memory, so they don't measure their own
+                    self.check_memory(force=True)
+                if "num_cores" in self.options and self.options["num_cores"] > 1:
+                    ensure_usable_connections()
+                if self.log:
+                    with self.stage("log"):
+                        self.log.end_time = datetime.datetime.now()
+                        self.log.metrics = self.metrics
+                        try:
+                            self.log.save()
+                        except:
+                            # sometimes for really long-standing processes, there's a timeout SSL error
+                            # so, we'll just fetch the log object again before saving and closing out
+                            reset_django_connection()
+                            self.log = CommandLog.objects.get(pk=self.log_id)
+                            self.log.end_time = datetime.datetime.now()
+                            self.log.metrics = self.metrics
+                            self.log.save()
+                        _refresh_command_stats(self)
+                        if self.log.run_group_id:
+                            self.log.run_group.update_status()
+                return result
+            except Exception as e:
+                if heartbeat:
+                    heartbeat.stop()
+                    self._heartbeat = None
+                _stop_query_counter(self, counter, previous_counter)
+                if not self.is_worker:
+                    self.check_memory(force=True)
+                tb = traceback.format_exc()
+                print(e)
+                print(tb)
+                span.set_attribute("error_class", get_error_class_name(e))
+                if self.log:
+                    with self.stage("log"):
+                        self.log.set_error(e, tb=tb)
+                        self.log.metrics = self.metrics
+                        self.log.save()
+                        _refresh_command_stats(self)
+                if isinstance(e, QueryLimitExceeded):
+                    # Query limits are meant for tests, so they have to fail loudly
+                    raise
+                return None
 
     return wrapper
 
 
+def _join_run_group(command):
+
+    """
+    If the command is being run as one shard of a sharded run (with the `--shard i/N` option), links its log to the
+    open run group for the command (creating the group if it doesn't exist yet). Open groups are unique per command,
+    key and number of shards, so shards that start at the same time all end up in the same group: if two of them try
+    to create it at once, `get_or_create` fetches the one that won. Open groups that no shard has joined for
+    `DJANGO_COMMANDER_RUN_GROUP_TIMEOUT` seconds are marked as abandoned first, so a new run doesn't join a group
+    from a run that crashed.
+
+    :param command: The command instance whose log was just created
+    """
+
+    shard = command.options.get("shard")
+    if shard:
+        index, num_shards = shard
+        lookup = {
+            "command": command.command,
+            "key": command.options.get("run_group") or "default",
+            "num_shards": num_shards,
+            "end_time": None,
+            "abandoned": False,
+        }
+        if settings.DJANGO_COMMANDER_RUN_GROUP_TIMEOUT:
+            cutoff = timezone.now() - datetime.timedelta(
+                seconds=settings.DJANGO_COMMANDER_RUN_GROUP_TIMEOUT
+            )
+            stale = (
+                CommandRunGroup.objects.filter(**lookup)
+                .annotate(last_joined=Max("logs__start_time"))
+                .filter(Q(last_joined__lt=cutoff) | Q(last_joined__isnull=True))
+                .filter(start_time__lt=cutoff)
+                .values_list("pk", flat=True)
+            )
+            CommandRunGroup.objects.filter(pk__in=list(stale)).update(abandoned=True)
+        group, _ = CommandRunGroup.objects.get_or_create(**lookup)
+        command.log.run_group = group
+        command.log.shard = index
+        command.log.save()
+
+
+def parse_shard(value):
+
+    """
+    Argument type for the `--shard` option, which takes the form `i/N` (the zero-indexed shard `i` out of `N`).
+
+    :param value: The value passed to the option
+    :return: A tuple of the shard index and the number of shards
+    """
+
+    if isinstance(value, (list, tuple)):
+        index, num_shards = value
+    else:
+        try:
+            index, num_shards = [int(v) for v in str(value).split("/")]
+        except ValueError:
+            raise ValueError(
+                "Shards must be specified as i/N (e.g. 0/4), not '{}'".format(value)
+            )
+    if num_shards < 1 or not 0 <= index < num_shards:
+        raise ValueError(
+            "Shard index must be between 0 and {}, not {}".format(num_shards - 1, index)
+        )
+    return (index, num_shards)
+
+
+def parse_num_cores(value):
+
+    """
+    Parses the value of a `--num_cores` argument, which can be a number or "auto" (see `get_auto_num_cores`).
+
+    :param value: A string
+    :return: An integer, or "auto"
+    """
+
+    if value == "auto":
+        return value
+    value = int(value)
+    if value < 1:
+        raise ValueError("num_cores must be at least 1")
+    return value
+
+
+def _get_available_memory():
+
+    """
+    :return: The amount of memory available to new processes, in bytes, or None if it can't be determined
+    """
+
+    try:
+        with open("/proc/meminfo", "r") as infile:
+            for line in infile:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _get_available_db_connections():
+
+    """
+    :return: The number of database connections that can still be opened, based on the \
+    `DJANGO_COMMANDER_MAX_DB_CONNECTIONS` setting or, for PostgreSQL, the server's `max_connections` and the number of \
+    connections that are currently open; None if it can't be determined
+    """
+
+    from django.db import connection
+
+    if settings.DJANGO_COMMANDER_MAX_DB_CONNECTIONS is not None:
+        return settings.DJANGO_COMMANDER_MAX_DB_CONNECTIONS
+    if connection.vendor != "postgresql":
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute("SHOW max_connections")
+        max_connections = int(cursor.fetchone()[0])
+        cursor.execute("SELECT COUNT(*) FROM pg_stat_activity")
+        open_connections = cursor.fetchone()[0]
+    return max_connections - open_connections
+
+
+def get_auto_num_cores():
+
+    """
+    Picks the number of worker processes to use for `--num_cores auto`: the number of CPUs, limited by the number of
+    workers that fit into the available memory (if `DJANGO_COMMANDER_WORKER_MEMORY` is set to a per-worker budget in
+    bytes) and by the number of database connections that are still available, leaving one spare.
+
+    :return: An integer
+    """
+
+    limits = [os.cpu_count() or 1]
+    if settings.DJANGO_COMMANDER_WORKER_MEMORY:
+        memory = _get_available_memory()
+        if memory is not None:
+            limits.append(memory // settings.DJANGO_COMMANDER_WORKER_MEMORY)
+    db_connections = _get_available_db_connections()
+    if db_connections is not None:
+        limits.append(db_connections - 1)
+
+    return max(1, min(limits))
+
+
+class PoolThrottle(object):
+
+    """
+    Limits the number of tasks that a command has waiting in its multiprocessing pool, so that `iterate` can't run
+    arbitrarily far ahead of the workers. By default, up to `DJANGO_COMMANDER_TASKS_PER_WORKER` tasks per worker can
+    be in flight. With `autoscale`, the limit starts at half of the workers and is adjusted after every window of
+    completed tasks: it keeps moving in the same direction (one worker at a time) while throughput improves, and turns
+    around when it gets worse.
+
+    :param num_cores: The number of workers in the pool
+    :param autoscale: Whether to adjust the number of tasks in flight based on measured throughput
+    :param window: (Optional) the number of completed tasks between adjustments; defaults to four per worker
+    """
+
+    def __init__(self, num_cores, autoscale=False, window=None):
+
+        self.num_cores = num_cores
+        self.autoscale = autoscale
+        self.window = window or max(10, num_cores * 4)
+        if autoscale:
+            self.limit = max(1, num_cores // 2)
+        else:
+            self.limit = num_cores * settings.DJANGO_COMMANDER_TASKS_PER_WORKER
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.completed = 0
+        self.task_seconds = 0.0
+        self._direction = 1
+        self._throughput = None
+        self._window_start = time.time()
+        self._window_completed = 0
+        self._condition = threading.Condition()
+
+    def wait(self):
+
+        """
+        Blocks until there's room for another task
+        """
+
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def task_done(self, started_at):
+
+        """
+        Records a finished task; this is called from the pool's result handler thread.
+
+        :param started_at: The time at which the task was dispatched
+        """
+
+        with self._condition:
+            self.in_flight -= 1
+            self.completed += 1
+            self.task_seconds += time.time() - started_at
+            self._window_completed += 1
+            if self.autoscale and self._window_completed >= self.window:
+                self._adjust()
+            self._condition.notify_all()
+
+    def _adjust(self):
+
+        now = time.time()
+        throughput = self._window_completed / max(now - self._window_start, 1e-6)
+        if self._throughput is not None and throughput < self._throughput:
+            self._direction = -self._direction
+        self._throughput = throughput
+        self.limit = min(self.num_cores, max(1, self.limit + self._direction))
+        self._window_start = now
+        self._window_completed = 0
+
+    def get_metrics(self):
+
+        """
+        :return: A dictionary of metrics to save on the command's log
+        """
+
+        return {
+            "queue_depth": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "concurrency": self.limit,
+            "task_seconds": (
+                self.task_seconds / self.completed if self.completed else None
+            ),
+        }
+
+
+def _refresh_command_stats(command):
+
+    """
+    Adds a log that has just been closed out to its command's `CommandStats` rollup (see
+    `CommandStatsManager.record_run`), unless this has been disabled with the `DJANGO_COMMANDER_UPDATE_STATS` setting
+    (in which case the rollup can be refreshed periodically with `python manage.py refresh_command_stats` instead).
+
+    :param command: The command instance whose log was just closed
+    """
+
+    if settings.DJANGO_COMMANDER_UPDATE_STATS:
+        CommandStats.objects.record_run(command.log)
+
+
 def cache_results(func):
+    @functools.wraps(func)
     def wrapper(self, *args, **options):
 
         """
@@ -119,12 +529,8 @@ def cache_results(func):
         `IterateDownloadCommand`. Caches the results either locally or in S3 based on your settings.
         """
 
-        hashstr = (
-            str(self.__class__.name)
-            + str(func.__name__)
-            + str(args)
-            + str(self.parameters)
-        )
+        hashstr = self.get_cache_key(func.__name__, *args)
+        fingerprint = self.get_cache_fingerprint(*args)
         if (
             self.options["refresh_cache"]
             or options.get("refresh_cache")
@@ -132,7 +538,11 @@ def cache_results(func):
         ):
             data = None
         else:
-            data = self.cache.read(hashstr)
+            with start_span("cache.read", command=self.name) as span:
+                data = self.cache.read(hashstr, fingerprint=fingerprint)
+                span.set_attribute("hit", is_not_null(data))
+            self.increment_metric("cache_hits" if is_not_null(data) else "cache_misses")
+        self.cache_hit = is_not_null(data)
         if (
             not is_not_null(data)
             or self.options["refresh_cache"]
@@ -145,98 +555,676 @@ def cache_results(func):
                 )
             )
             data = func(self, *args)
-            self.cache.write(hashstr, data)
+            with start_span("cache.write", command=self.name):
+                self.cache.write(
+                    hashstr,
+                    data,
+                    fingerprint=fingerprint,
+                    parameters=get_serializable_arguments(self.parameters),
+                )
 
         return data
 
+    # Lets the pipeline classes know that `download` results can be prefetched from the cache
+    wrapper.cached = True
+
     return wrapper
 
 
-def command_multiprocess_wrapper(command_name, parameters, options, *args):
+def ensure_usable_connections():
 
     """
-    Decorator that resets Django connections for multiprocessing
+    Closes any database connections that have errored and are no longer usable, or that have outlived their maximum
+    age, so that they're reopened on the next query. Healthy connections are left open and reused.
+    """
+
+    for connection in connections.all():
+        connection.close_if_unusable_or_obsolete()
+
+
+def _init_worker(traceparent):
+
+    """
+    Runs when a multiprocessing worker starts: sets up its database connections (see `_init_worker_connections`)
+    and, if tracing is enabled, makes the spans it records children of the span that created the pool.
+
+    :param traceparent: The `traceparent` of the span that created the pool, or None
+    """
+
+    _init_worker_connections()
+    set_traceparent(traceparent)
+
+
+def _init_worker_connections():
+
+    """
+    Initializes the database connections in a new multiprocessing worker. Workers keep a single connection open for
+    all of the tasks they run (for up to `DJANGO_COMMANDER_WORKER_CONN_MAX_AGE` seconds, or indefinitely if it's None)
+    rather than reconnecting for every item.
+    """
+
+    for connection in connections.all():
+        if connection.connection is not None:
+            # A connection inherited from the parent process shares its socket, so it has to be discarded rather than
+            # closed (which would close it for the parent too)
+            connection.connection = None
+        connection.settings_dict[
+            "CONN_MAX_AGE"
+        ] = settings.DJANGO_COMMANDER_WORKER_CONN_MAX_AGE
+        # The parent's query counter can't report anything from here; workers count their own queries
+        connection.execute_wrappers = [
+            w for w in connection.execute_wrappers if not isinstance(w, QueryCounter)
+        ]
+
+
+def create_worker_pool(processes, maxtasksperchild=None):
+
+    """
+    Creates a multiprocessing pool for a command. The parent's database connections are closed first so that the
+    forked workers don't inherit them, and each worker opens its own connection the first time it needs one. If
+    tracing is enabled, the workers' spans are recorded as children of the current span.
+
+    :param processes: The number of worker processes
+    :param maxtasksperchild: (Optional) the number of tasks after which each worker is replaced with a fresh process
+    :return: A `multiprocessing.Pool`
+    """
+
+    for connection in connections.all():
+        if not connection.in_atomic_block:
+            connection.close()
+    return Pool(
+        processes=processes,
+        initializer=_init_worker,
+        initargs=(get_traceparent(),),
+        maxtasksperchild=maxtasksperchild,
+    )
+
+
+def get_worker_command(command_name, parameters, options):
+
+    """
+    Checks the worker's database connections and initializes a command inside of a multiprocessing worker
 
     :param command_name: Name of the command
     :param parameters: Command parameters
     :param options: Command options
-    :param args: Additional arguments
 
-    :return:
+    :return: The command instance
     """
 
     params = {}
     params.update(parameters)
     params.update(options)
-    # if not params.get("test", False):
-    reset_django_connection()
+    # Workers process items on behalf of a shard, but don't belong to its run group themselves
+    for option in ["shard", "run_group"]:
+        params.pop(option, None)
+    ensure_usable_connections()
     from django_commander.commands import commands
 
-    return commands[command_name](**params).parse_and_save(*args)
+    command = commands[command_name](**params)
+    # Background uploads would be lost when the worker exits, since nothing flushes them
+    command.cache.write_behind = False
+    # Download results and failures are sent back to the parent, which keeps the circuit breaker for all workers
+    command.is_worker = True
+    command._circuit_breaker = None
+
+    return command
 
 
-def test_commands():
+def command_multiprocess_wrapper(command_name, parameters, options, *args):
 
     """
-    Loops over all commands, and runs any that have defined `test_parameters`.
+    Decorator that resets Django connections for multiprocessing
+
+    :param command_name: Name of the command
+    :param parameters: Command parameters
+    :param options: Command options
+    :param args: Additional arguments, or a single `PickledPayload` or `SpooledPayload` containing them
+
+    :return:
+    """
+
+    if len(args) == 1 and isinstance(args[0], (PickledPayload, SpooledPayload)):
+        args = args[0].load()
+    return get_worker_command(command_name, parameters, options).parse_and_save(*args)
+
+
+def command_multiprocess_batch_wrapper(command_name, parameters, options, batch):
+
+    """
+    Equivalent to `command_multiprocess_wrapper`, but passes a whole batch of items to `parse_and_save_batch` so that
+    each pool task processes many items
+
+    :param command_name: Name of the command
+    :param parameters: Command parameters
+    :param options: Command options
+    :param batch: A list of lists of arguments, or a `PickledPayload` or `SpooledPayload` containing one
+
+    :return:
+    """
+
+    if isinstance(batch, (PickledPayload, SpooledPayload)):
+        batch = batch.load()
+    return get_worker_command(command_name, parameters, options).parse_and_save_batch(
+        batch
+    )
+
+
+def command_multiprocess_download_wrapper(command_name, parameters, options, *args):
+
+    """
+    Equivalent to `command_multiprocess_wrapper`, but runs `download` inside of the worker before passing its results
+    to `parse_and_save` (see `MultiprocessedIterateDownloadCommand.download_in_workers`)
+
+    :param command_name: Name of the command
+    :param parameters: Command parameters
+    :param options: Command options
+    :param args: The values yielded by `iterate`, or a single `PickledPayload` or `SpooledPayload` containing them
+
+    :return: A tuple of the value returned by `parse_and_save` and the metrics recorded while downloading (see \
+    `WorkerResult`)
+    """
+
+    if len(args) == 1 and isinstance(args[0], (PickledPayload, SpooledPayload)):
+        args = args[0].load()
+    command = get_worker_command(command_name, parameters, options)
+    result = command.download_and_parse_and_save(*args)
+    return result, command.worker_outcome
+
+
+def command_multiprocess_download_batch_wrapper(
+    command_name, parameters, options, batch
+):
+
+    """
+    Equivalent to `command_multiprocess_batch_wrapper`, but runs `download` for each item inside of the worker (see
+    `MultiprocessedIterateDownloadCommand.download_in_workers`)
+
+    :param command_name: Name of the command
+    :param parameters: Command parameters
+    :param options: Command options
+    :param batch: A list of lists of values yielded by `iterate`, or a `PickledPayload` or `SpooledPayload` containing one
+
+    :return: A tuple of the value returned by `parse_and_save_batch` and the metrics recorded while downloading
+    """
+
+    if isinstance(batch, (PickledPayload, SpooledPayload)):
+        batch = batch.load()
+    command = get_worker_command(command_name, parameters, options)
+    result = command.download_and_parse_and_save_batch(batch)
+    return result, command.worker_outcome
+
+
+class WorkerResult(object):
+
+    """
+    Wraps the `AsyncResult` of a task that downloads items in a worker, whose function returns the metrics recorded
+    while downloading along with its result, so that the results passed to `cleanup` still return just the value
+    from `parse_and_save`.
+
+    :param result: A `multiprocessing.pool.AsyncResult`
+    """
+
+    def __init__(self, result):
+
+        self.result = result
+
+    def get(self, timeout=None):
+
+        return self.result.get(timeout)[0]
+
+    def wait(self, timeout=None):
+
+        self.result.wait(timeout)
+
+    def ready(self):
+
+        return self.result.ready()
+
+    def successful(self):
+
+        return self.result.successful()
+
+
+def iterate_in_batches(items, batch_size):
+
+    """
+    Groups the values from an iterable into lists
+
+    :param items: An iterable
+    :param batch_size: The maximum number of values in each list
+
+    :return: Yields lists of values
+    """
+
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_test_command(command_name, raise_errors=False):
+
+    """
+    Runs a single command with its `test_parameters` and `test_options` (if it has any) and the `test` option, which
+    keeps its cache isolated in the command's `test` cache folder.
+
+    :param command_name: Name of the command
+    :param raise_errors: If True, exceptions raised by the command are re-raised rather than being recorded
+    :return: A dictionary with the command's name, the number of seconds it took, and an error message if it failed
+    """
+
+    from django_commander.commands import commands
+
+    command_class = commands[command_name]
+    params = {}
+    params.update(getattr(command_class, "test_options", {}))
+    params.update(getattr(command_class, "test_parameters", {}))
+    params["test"] = True
+    start = time.time()
+    error = None
+    try:
+        command = command_class(**params)
+        command.run()
+        if command.log and command.log.error_class:
+            error = "{}: {}".format(command.log.error_class, command.log.error_message)
+    except Exception as e:
+        if raise_errors:
+            raise
+        error = "{}: {}".format(get_error_class_name(e), e)
+
+    return {"command": command_name, "seconds": time.time() - start, "error": error}
+
+
+def _run_test_command_process(command_name, raise_errors, traceparent, connection):
+
+    """
+    Runs `run_test_command` in a separate process started by `test_commands`, and sends back a tuple of its result
+    and the exception it raised (if `raise_errors` is set), one of which is None.
+
+    :param command_name: Name of the command
+    :param raise_errors: Passed on to `run_test_command`
+    :param traceparent: The `traceparent` of the span that started the process, or None
+    :param connection: The sending end of a `multiprocessing.Pipe`
+    """
+
+    _init_worker(traceparent)
+    try:
+        connection.send(
+            (run_test_command(command_name, raise_errors=raise_errors), None)
+        )
+    except Exception as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = Exception("{}: {}".format(get_error_class_name(e), e))
+        connection.send((None, e))
+    finally:
+        connection.close()
+
+
+def test_commands(jobs=1, fail_fast=False, command_names=None, raise_errors=True):
+
+    """
+    Loops over all commands, and runs each of them with `run_test_command`. Commands are ordered by their
+    `dependencies`, so a command only runs once all of the dependencies that are being tested alongside it have
+    finished, and it's skipped if any of them failed.
+
+    When running more than one command at once, each command gets its own (non-daemonic) process, so that commands
+    can still start their own multiprocessing pools.
+
+    :param jobs: The number of commands to run at once, in separate processes
+    :param fail_fast: If True, stops starting new commands as soon as one fails
+    :param command_names: (Optional) a list of commands to test; defaults to all of them
+    :param raise_errors: If True, an exception raised by a command is re-raised once the commands that are already \
+    running have finished; otherwise it's recorded in the command's result
+    :return: A list of the results from `run_test_command`, in the order the commands finished
     """
 
     from django_commander.commands import commands
 
-    for command_name in list(commands.keys()):
-        params = {}
-        if hasattr(commands[command_name], "test_options") or hasattr(
-            commands[command_name], "test_parameters"
+    names = list(command_names or commands.keys())
+    waiting = {}
+    for name in names:
+        waiting[name] = set(
+            [
+                d
+                for d, params in getattr(commands[name], "dependencies", [])
+                if d in names and d != name
+            ]
+        )
+
+    results = []
+    finished = {}
+    running = {}
+    exceptions = []
+
+    def finish(result):
+        results.append(result)
+        finished[result["command"]] = result
+
+    def start(name):
+        for connection in connections.all():
+            if not connection.in_atomic_block:
+                connection.close()
+        receiver, sender = Pipe(duplex=False)
+        process = Process(
+            target=_run_test_command_process,
+            args=(name, raise_errors, get_traceparent(), sender),
+        )
+        process.start()
+        sender.close()
+        running[name] = (process, receiver)
+
+    while waiting or running:
+        failed = exceptions or any([r["error"] for r in results])
+        if not ((fail_fast or exceptions) and failed):
+            for name in list(waiting.keys()):
+                if jobs > 1 and len(running) >= jobs:
+                    break
+                dependencies = waiting[name]
+                if not dependencies.issubset(finished):
+                    continue
+                del waiting[name]
+                failed_dependencies = [d for d in dependencies if finished[d]["error"]]
+                if failed_dependencies:
+                    finish(
+                        {
+                            "command": name,
+                            "seconds": 0.0,
+                            "error": "Skipped: dependencies failed ({})".format(
+                                ", ".join(sorted(failed_dependencies))
+                            ),
+                        }
+                    )
+                elif jobs > 1:
+                    start(name)
+                else:
+                    finish(run_test_command(name, raise_errors=raise_errors))
+                    if fail_fast and finished[name]["error"]:
+                        break
+        elif not running:
+            break
+
+        if not running and waiting and not any(
+            [waiting[name].issubset(finished) for name in waiting]
         ):
-            if hasattr(commands[command_name], "test_options"):
-                params.update(commands[command_name].test_options)
-            if hasattr(commands[command_name], "test_parameters"):
-                params.update(commands[command_name].test_parameters)
-        params["test"] = True
-        commands[command_name](**params).run()
+            for name in list(waiting.keys()):
+                finish(
+                    {
+                        "command": name,
+                        "seconds": 0.0,
+                        "error": "Skipped: circular dependencies ({})".format(
+                            ", ".join(sorted(waiting[name] - set(finished)))
+                        ),
+                    }
+                )
+                del waiting[name]
+
+        for name, (process, receiver) in list(running.items()):
+            if receiver.poll():
+                result, exception = receiver.recv()
+            elif process.is_alive():
+                continue
+            elif receiver.poll():
+                # The process sent its result just before it exited
+                result, exception = receiver.recv()
+            else:
+                result, exception = (
+                    {
+                        "command": name,
+                        "seconds": 0.0,
+                        "error": "Exited with code {}".format(process.exitcode),
+                    },
+                    None,
+                )
+            process.join()
+            receiver.close()
+            del running[name]
+            if exception:
+                exceptions.append(exception)
+            else:
+                finish(result)
+        if running:
+            time.sleep(0.05)
+
+    if exceptions:
+        raise exceptions[0]
+
+    return results
+
 
+def chunked_delete(queryset, chunk_size=10000, dry_run=False):
 
-def clear_unfinished_command_logs():
     """
-    Clears out extra logs in the database for commands that didn't log an end time.
+    Deletes the rows in a queryset in chunks of up to `chunk_size` primary keys, paging through them in key order so
+    that each chunk is a single indexed query no matter how sparse the keys are. Each chunk is deleted in its own
+    transaction, so the whole table is never locked at once. If the model has no cascades or delete signals, the
+    chunks are deleted with a single raw `DELETE` each, without loading the rows first.
+
+    :param queryset: The queryset to delete
+    :param chunk_size: The number of rows to delete per transaction
+    :param dry_run: If True, counts the rows that would be deleted without deleting them
+    :return: The number of rows in the queryset that were (or would be) deleted
+    """
+
+    if dry_run:
+        return queryset.count()
+
+    model = queryset.model
+    fast = Collector(using=queryset.db).can_fast_delete(queryset)
+    deleted = 0
+    last_pk = None
+    while True:
+        chunk = queryset.order_by("pk")
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        pks = list(chunk.values_list("pk", flat=True)[:chunk_size])
+        if not pks:
+            break
+        last_pk = pks[-1]
+        rows = model._base_manager.using(queryset.db).filter(pk__in=pks)
+        with transaction.atomic(using=queryset.db):
+            if fast:
+                deleted += rows._raw_delete(queryset.db)
+            else:
+                _, counts = rows.delete()
+                deleted += counts.get(model._meta.label, 0)
+
+    return deleted
+
+
+def clear_unfinished_command_logs(older_than=None, dry_run=False, chunk_size=10000):
     """
+    Clears out extra logs in the database for commands that didn't log an end time (or that logged an error), and
+    then removes any commands that no longer have any logs. All of the deletes are chunked (see `chunked_delete`).
+
+    :param older_than: (Optional) only clear logs that were started more than this many days ago
+    :param dry_run: If True, only counts the logs and commands that would be deleted
+    :param chunk_size: The number of rows to delete per transaction
+    :return: A dictionary with the number of logs and commands that were (or would be) deleted
+    """
+
+    logs = CommandLog.objects.filter(
+        Q(error_class__isnull=False) | Q(end_time__isnull=True)
+    )
+    if older_than is not None:
+        logs = logs.filter(
+            start_time__lt=timezone.now() - datetime.timedelta(days=older_than)
+        )
+    deleted = {"logs": chunked_delete(logs, chunk_size=chunk_size, dry_run=dry_run)}
+
+    if dry_run:
+        # Commands whose logs would all be removed, plus any that are already empty
+        remaining = CommandLog.objects.exclude(pk__in=logs.values("pk"))
+        empty = Command.objects.exclude(pk__in=remaining.values("command_id"))
+    else:
+        empty = Command.objects.filter(logs__isnull=True)
+    deleted["commands"] = chunked_delete(
+        Command.objects.filter(pk__in=empty.values("pk")),
+        chunk_size=chunk_size,
+        dry_run=dry_run,
+    )
+
+    return deleted
 
-    for command in tqdm(Command.objects.all(), desc="Clearing extra logs"):
-        command.logs.filter(error__isnull=False).delete()
-        command.logs.filter(end_time__isnull=True).delete()
-        if command.logs.count() == 0:
-            command.delete()
+
+def _enum_argument_type(enum_class):
+
+    """
+    :param enum_class: An `Enum` subclass
+    :return: An argparse type function that looks up members of the enum by name or by value
+    """
+
+    def convert(value):
+        if isinstance(value, enum_class):
+            return value
+        try:
+            return enum_class[value]
+        except KeyError:
+            return enum_class(value)
+
+    convert.__name__ = enum_class.__name__
+    return convert
+
+
+def _get_argument_type(annotation):
+
+    """
+    Translates a type annotation into the arguments for `parser.add_argument`.
+
+    :param annotation: A type annotation (e.g. `int`, `Path`, `List[int]`, `Optional[MyEnum]`)
+    :return: A tuple of the argument's type, whether it accepts multiple values, and whether it accepts None
+    """
+
+    optional, many = False, False
+    if getattr(annotation, "__origin__", None) is Union:
+        members = [a for a in annotation.__args__ if a is not type(None)]
+        optional = len(members) < len(annotation.__args__)
+        annotation = members[0] if len(members) == 1 else str
+    if getattr(annotation, "__origin__", None) in [list, tuple, set, Sequence]:
+        many = True
+        members = getattr(annotation, "__args__", None) or [str]
+        annotation = members[0] if members[0] is not Ellipsis else str
+    elif annotation in [list, tuple, set]:
+        many, annotation = True, str
+    if isinstance(annotation, type) and issubclass(annotation, Enum):
+        annotation = _enum_argument_type(annotation)
+    elif not callable(annotation) or getattr(annotation, "__origin__", None):
+        annotation = str
+
+    return annotation, many, optional
 
 
 def compile_parser_from_function(parser, func):
 
     """
     Iterates over all of the arguments and keyword arguments defined in a given function and adds them to an argparse
-    parser. Assumes that required (non-keyword) arguments are strings, and that boolean keyword arguments are False
-    by default. Detects the type of other keyword arguments based on their specified defaults.
+    parser. Arguments without defaults become positional arguments and keyword arguments become options. Types are
+    taken from the function's type annotations where available, including `int`, `float`, `Path`, `Enum` subclasses,
+    `Optional[...]` and lists (e.g. `List[int]`, which accepts multiple values). Unannotated positional arguments are
+    treated as strings, boolean keyword arguments become flags, and other unannotated keyword arguments are typed
+    based on their defaults.
 
-    # TODO: kwargs with default=None don't know what type to case; only way to fix this is with Python 3 type annotations
-
-    :param parser:
-    :param func:
-    :return:
+    :param parser: An argparse parser
+    :param func: The function whose signature should be compiled
+    :return: The parser
     """
 
+    try:
+        hints = get_type_hints(func)
+    except Exception:
+        hints = {}
+
     for param in signature(func).parameters.values():
 
-        if param.default == param.empty:
-            parser.add_argument(param.name, type=str)
-        elif isinstance(param.default, bool):
-            parser.add_argument(
-                "--{}".format(param.name), action="store_true", default=param.default
-            )
-        elif isinstance(param.default, None):
-            parser.add_argument("--{}".format(param.name), type=str, default=None)
+        if param.name in ["self", "cls", "parser"] or param.kind in [
+            param.VAR_POSITIONAL,
+            param.VAR_KEYWORD,
+        ]:
+            continue
+        annotation = hints.get(param.name, param.annotation)
+        required = param.default == param.empty
+        name = param.name if required else "--{}".format(param.name)
+        kwargs = {} if required else {"default": param.default}
+
+        if annotation is bool or (
+            annotation == param.empty and isinstance(param.default, bool)
+        ):
+            parser.add_argument(name, action="store_true", **kwargs)
+            continue
+        if annotation != param.empty:
+            arg_type, many, optional = _get_argument_type(annotation)
+            if many:
+                kwargs["nargs"] = "+" if required else "*"
+        elif required or param.default is None:
+            arg_type = str
         else:
-            parser.add_argument(
-                "--{}".format(param.name),
-                type=type(param.default),
-                default=param.default,
-            )
+            arg_type = type(param.default)
+        parser.add_argument(name, type=arg_type, **kwargs)
 
     return parser
+
+
+def get_serializable_arguments(values):
+
+    """
+    Converts typed argument values (like `Path` and `Enum` values) into JSON-serializable equivalents so they can be
+    stored on `Command` and `CommandLog` rows.
+
+    :param values: A dictionary of parameters or options
+    :return: A JSON-serializable copy of the dictionary
+    """
+
+    def convert(value):
+        if isinstance(value, Enum):
+            return value.value
+        elif isinstance(value, PurePath):
+            return str(value)
+        elif isinstance(value, (list, tuple, set)):
+            return [convert(v) for v in value]
+        return value
+
+    return {k: convert(v) for k, v in values.items()}
+
+
+def declares_arguments(func):
+
+    """
+    Checks whether a command's `add_arguments` or `run` function declares the command's arguments in its signature,
+    rather than adding them to a parser.
+
+    :param func: The function to inspect
+    :return: True if the function's signature should be compiled into a parser
+    """
+
+    names = [
+        param.name
+        for param in signature(func).parameters.values()
+        if param.kind not in [param.VAR_POSITIONAL, param.VAR_KEYWORD]
+    ]
+    return "parser" not in names and len([n for n in names if n not in ["self", "cls"]]) > 0
+
+
+def get_declared_arguments(command, func):
+
+    """
+    Collects the values of the arguments that a function declares in its signature from a command's parameters
+    and options.
+
+    :param command: A command instance
+    :param func: The function whose arguments should be collected
+    :return: A dictionary of keyword arguments
+    """
+
+    values = {}
+    for param in signature(func).parameters.values():
+        for source in [command.parameters, command.options]:
+            if param.name in source:
+                values[param.name] = source[param.name]
+                break
+    return values
@@ -1,19 +1,27 @@
 import datetime
 
+from django.http import HttpResponse
 from django.shortcuts import render
 from django.template import RequestContext
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
 
-from django_commander.models import Command, CommandLog
+from django_commander.exporter import render_metrics
+from django_commander.models import Command, CommandLog, CommandRunGroup, CommandStats
 
 
 # @login_required
 def home(request):
 
     commands = []
-    for c in Command.objects.all():
-        commands.append({"command": c, "latest_log": c.logs.order_by("-start_time")[0]})
+    for c in Command.objects.select_related("stats"):
+        commands.append(
+            {
+                "command": c,
+                "latest_log": c.logs.order_by("-start_time")[0],
+                "stats": getattr(c, "stats", None),
+            }
+        )
     commands = sorted(commands, key=lambda x: x["latest_log"].start_time, reverse=True)
 
     return render(request, "django_commander/index.html", {"commands": commands})
@@ -22,9 +30,37 @@ def home(request):
 # @login_required
 def view_command(request, command_id):
 
-    command = Command.objects.get(pk=command_id)
+    CommandStats.objects.refresh_durations(command_ids=[command_id])
+    command = Command.objects.select_related("stats").get(pk=command_id)
     logs = command.logs.order_by("-start_time")[:10]
 
     return render(
-        request, "django_commander/command.html", {"command": command, "logs": logs}
+        request,
+        "django_commander/command.html",
+        {"command": command, "logs": logs, "stats": getattr(command, "stats", None)},
+    )
+
+
+# @login_required
+def view_run_group(request, run_group_id):
+
+    run_group = CommandRunGroup.objects.select_related("command").get(pk=run_group_id)
+    run_group.update_status()
+
+    return render(
+        request,
+        "django_commander/run_group.html",
+        {
+            "run_group": run_group,
+            "shards": list(enumerate(run_group.shards)),
+            "progress": run_group.progress,
+        },
+    )
+
+
+# @login_required
+def metrics(request):
+
+    return HttpResponse(
+        render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8"
     )
@@ -0,0 +1,270 @@
+from __future__ import print_function
+
+import datetime
+import json
+import platform
+import sys
+import time
+
+from multiprocessing import Pool, Process, Queue, Value
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+PIPELINE_BENCHMARK_COMMANDS = [
+    "benchmarks_download_iterate",
+    "benchmarks_iterate_download",
+    "benchmarks_multiprocessed_download_iterate",
+    "benchmarks_multiprocessed_iterate_download",
+]
+
+
+def benchmark_command_construction(command_name="test_command", iterations=1000):
+
+    """
+    Measures how long it takes to initialize a command, which happens once per item in the multiprocessed command
+    classes and once per programmatic call.
+
+    :param command_name: The name of the command to initialize, using its `test_parameters` and `test_options`
+    :param iterations: The number of times to initialize the command
+    :return: A dictionary of results
+    """
+
+    from django_commander.commands import commands
+
+    command_class = commands[command_name]
+    params = {}
+    params.update(getattr(command_class, "test_options", {}))
+    params.update(getattr(command_class, "test_parameters", {}))
+    command_class(**params)
+
+    start = time.perf_counter()
+    for i in range(0, iterations):
+        command_class(**params)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "benchmark": "command_construction",
+        "command": command_name,
+        "iterations": iterations,
+        "seconds": elapsed,
+        "microseconds_per_call": elapsed / iterations * 1e6,
+    }
+
+
+def _get_payload_size(payload):
+
+    from django_commander.payloads import SpooledPayload
+
+    if isinstance(payload, SpooledPayload):
+        payload = payload.load()
+    return len(payload)
+
+
+def benchmark_payload_passing(size=64 * 1024 * 1024, iterations=10, num_cores=2):
+
+    """
+    Compares sending a large payload to a multiprocessing worker through the pool's pipe with spooling it to a file
+    that the worker maps into memory (see `django_commander.payloads.spool_payload`).
+
+    :param size: The size of the payload in bytes
+    :param iterations: The number of times to send the payload with each method
+    :param num_cores: The number of workers in the pool
+    :return: A dictionary of results
+    """
+
+    from django_commander.payloads import spool_payload
+
+    payload = bytearray(size)
+    timings = {}
+    with Pool(processes=num_cores) as pool:
+        for method in ["pipe", "spooled"]:
+            start = time.perf_counter()
+            for i in range(0, iterations):
+                if method == "spooled":
+                    spooled = spool_payload(payload, threshold=0)
+                    pool.apply(_get_payload_size, args=(spooled,))
+                    spooled.unlink()
+                else:
+                    pool.apply(_get_payload_size, args=(payload,))
+            timings[method] = (time.perf_counter() - start) / iterations
+
+    return {
+        "benchmark": "payload_passing",
+        "bytes": size,
+        "iterations": iterations,
+        "seconds_per_payload": timings,
+        "speedup": timings["pipe"] / timings["spooled"],
+    }
+
+
+def _get_peak_rss():
+
+    """
+    :return: The peak resident set size of the current process or any of its finished child processes, in bytes, or \
+    None if it can't be measured on this platform
+    """
+
+    if not resource:
+        return None
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _get_query_counter(counter):
+
+    def count_query(execute, sql, params, many, context):
+        with counter.get_lock():
+            counter.value += 1
+        return execute(sql, params, many, context)
+
+    return count_query
+
+
+def benchmark_pipeline(command_name, num_items, num_cores=1, cache=True):
+
+    """
+    Runs one of the synthetic pipeline commands in `testapp/commands/benchmarks` and measures its throughput. Queries
+    are counted across the parent process and any multiprocessing workers, which inherit the counter when they're
+    forked.
+
+    :param command_name: The name of the command
+    :param num_items: The number of items for the command to process
+    :param num_cores: The number of cores to use, for the multiprocessed commands
+    :param cache: If True, the command is run once beforehand so that `download` reads from a warm cache; otherwise, \
+    it's run with `refresh_cache`
+    :return: A dictionary of results
+    """
+
+    from django.db import connection
+    from django_commander.commands import commands
+    from testapp.models import Parent
+
+    command_class = commands[command_name]
+    params = {"num_items": num_items}
+    if "num_cores" in command_class.get_parser_actions():
+        params["num_cores"] = num_cores
+    if cache:
+        command_class(**params).run()
+    else:
+        params["refresh_cache"] = True
+    Parent.objects.filter(name__startswith="benchmark_").delete()
+
+    counter = Value("l", 0)
+    count_query = _get_query_counter(counter)
+    connection.execute_wrappers.append(count_query)
+    start = time.perf_counter()
+    try:
+        command_class(**params).run()
+    finally:
+        connection.execute_wrappers.remove(count_query)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "benchmark": "pipeline",
+        "command": command_name,
+        "command_class": command_class.__bases__[0].__name__,
+        "database": connection.vendor,
+        "num_items": num_items,
+        "num_cores": params.get("num_cores", 1),
+        "cache": cache,
+        "seconds": elapsed,
+        "items_per_second": num_items / elapsed,
+        "queries": counter.value,
+        "queries_per_item": counter.value / float(num_items),
+        "peak_rss_bytes": _get_peak_rss(),
+    }
+
+
+def _run_benchmark_in_process(queue, func, kwargs):
+
+    queue.put(func(**kwargs))
+
+
+def run_isolated(func, **kwargs):
+
+    """
+    Runs a benchmark in a new process, so that its peak memory usage isn't affected by earlier benchmarks.
+
+    :param func: The benchmark function
+    :param kwargs: Passed to the benchmark function
+    :return: The benchmark's results
+    """
+
+    from django.db import connections
+
+    # The new process has to open its own database connections rather than sharing this one
+    connections.close_all()
+    queue = Queue()
+    process = Process(target=_run_benchmark_in_process, args=(queue, func, kwargs))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    return result
+
+
+def run_pipeline_benchmarks(
+    sizes=(1000, 100000, 1000000),
+    num_cores=(1, 4),
+    cache=(True, False),
+    command_names=None,
+    output=None,
+):
+
+    """
+    Runs `benchmark_pipeline` for every combination of command, size, core count (for the multiprocessed commands)
+    and cache setting, each in its own process, and optionally saves the results to a JSON file so that they can be
+    compared across releases.
+
+    :param sizes: The numbers of items to process
+    :param num_cores: The core counts to run the multiprocessed commands with
+    :param cache: The cache settings to test (see `benchmark_pipeline`)
+    :param command_names: (Optional) the commands to benchmark; defaults to `PIPELINE_BENCHMARK_COMMANDS`
+    :param output: (Optional) a path to write the results to
+    :return: A dictionary with the results and details about the environment they were measured in
+    """
+
+    import django
+
+    from django.db import connection
+    from django_commander.commands import commands
+
+    results = []
+    for command_name in command_names or PIPELINE_BENCHMARK_COMMANDS:
+        if "num_cores" in commands[command_name].get_parser_actions():
+            core_counts = num_cores
+        else:
+            core_counts = [1]
+        for size in sizes:
+            for cores in core_counts:
+                for use_cache in cache:
+                    result = run_isolated(
+                        benchmark_pipeline,
+                        command_name=command_name,
+                        num_items=size,
+                        num_cores=cores,
+                        cache=use_cache,
+                    )
+                    print(json.dumps(result))
+                    results.append(result)
+
+    report = {
+        "created": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "database": connection.vendor,
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+
+    return report
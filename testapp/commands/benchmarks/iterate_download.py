@@ -0,0 +1,38 @@
+from __future__ import print_function, absolute_import
+
+from django_commander.commands import IterateDownloadCommand, cache_results
+from testapp.models import Parent
+
+
+class Command(IterateDownloadCommand):
+
+    """
+    A synthetic `IterateDownloadCommand` used by `testapp.benchmarks`
+    """
+
+    parameter_names = ["num_items"]
+    dependencies = []
+    test_parameters = {"num_items": 10}
+    test_options = {}
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument("num_items", type=int)
+        return parser
+
+    def __init__(self, **options):
+        super(Command, self).__init__(**options)
+
+    def iterate(self):
+        for value in range(0, self.parameters["num_items"]):
+            yield [value]
+
+    @cache_results
+    def download(self, value):
+        return ["benchmark_{}".format(value)]
+
+    def parse_and_save(self, name, value):
+        Parent.objects.create_or_update({"name": name}, command_log=self.log)
+
+    def cleanup(self):
+        pass
@@ -0,0 +1,45 @@
+from __future__ import print_function, absolute_import
+
+from django_commander.commands import (
+    MultiprocessedDownloadIterateCommand,
+    cache_results,
+)
+from django_commander.utils import log_command
+from testapp.models import Parent
+
+
+class Command(MultiprocessedDownloadIterateCommand):
+
+    """
+    A synthetic `MultiprocessedDownloadIterateCommand` used by `testapp.benchmarks`
+    """
+
+    parameter_names = ["num_items"]
+    dependencies = []
+    test_parameters = {"num_items": 10}
+    test_options = {}
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument("num_items", type=int)
+        return parser
+
+    def __init__(self, **options):
+        super(Command, self).__init__(**options)
+
+    @cache_results
+    def download(self):
+        return [list(range(0, self.parameters["num_items"]))]
+
+    def iterate(self, values):
+        for value in values:
+            yield [value]
+
+    @log_command
+    def parse_and_save(self, value):
+        Parent.objects.create_or_update(
+            {"name": "benchmark_{}".format(value)}, command_log=self.log
+        )
+
+    def cleanup(self, results):
+        pass
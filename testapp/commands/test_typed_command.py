@@ -0,0 +1,44 @@
+from __future__ import print_function, absolute_import
+
+from typing import List, Optional
+
+from django_commander.commands import BasicCommand, log_command
+from testapp.models import *
+
+
+class Command(BasicCommand):
+
+    """
+    """
+
+    parameter_names = ["parent_names"]
+    dependencies = []
+    test_parameters = {"parent_names": ["bob"]}
+    test_options = {"num_children": 1}
+
+    @staticmethod
+    def add_arguments(
+        parent_names: List[str], num_children: int = 1, prefix: Optional[str] = None
+    ):
+        pass
+
+    def __init__(self, **options):
+
+        super(Command, self).__init__(**options)
+
+    @log_command
+    def run(self, parent_names, num_children, prefix):
+
+        children = []
+        for parent_name in parent_names:
+            parent = Parent.objects.create_or_update(
+                {"name": parent_name}, command_log=self.log
+            )
+            for i in range(0, num_children):
+                children.append(
+                    Child.objects.create_or_update(
+                        {"name": "{}child{}".format(prefix or "", i), "parent": parent},
+                        command_log=self.log,
+                    )
+                )
+        return children
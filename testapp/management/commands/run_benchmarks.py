@@ -0,0 +1,61 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from testapp.benchmarks import (
+    benchmark_command_construction,
+    benchmark_payload_passing,
+    run_pipeline_benchmarks,
+)
+
+
+class Command(BaseCommand):
+
+    """
+    Runs the django_commander benchmarks against the commands in `testapp`.
+    """
+
+    help = "Runs the django_commander benchmarks"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+            "--benchmark",
+            type=str,
+            default="command_construction",
+            choices=["command_construction", "payload_passing", "pipeline"],
+        )
+        parser.add_argument("--command_name", type=str, default="test_command")
+        parser.add_argument("--iterations", type=int, default=1000)
+        parser.add_argument("--payload_size", type=int, default=64 * 1024 * 1024)
+        parser.add_argument("--num_cores", type=int, nargs="+", default=None)
+        parser.add_argument(
+            "--sizes", type=int, nargs="+", default=[1000, 100000, 1000000]
+        )
+        parser.add_argument(
+            "--cache", nargs="+", choices=["on", "off"], default=["on", "off"]
+        )
+        parser.add_argument("--commands", nargs="+", default=None)
+        parser.add_argument("--output", type=str, default=None)
+
+    def handle(self, *args, **options):
+
+        if options["benchmark"] == "pipeline":
+            result = run_pipeline_benchmarks(
+                sizes=options["sizes"],
+                num_cores=options["num_cores"] or [1, 4],
+                cache=[c == "on" for c in options["cache"]],
+                command_names=options["commands"],
+                output=options["output"],
+            )
+        elif options["benchmark"] == "payload_passing":
+            result = benchmark_payload_passing(
+                size=options["payload_size"],
+                iterations=options["iterations"],
+                num_cores=(options["num_cores"] or [2])[0],
+            )
+        else:
+            result = benchmark_command_construction(
+                command_name=options["command_name"], iterations=options["iterations"]
+            )
+        self.stdout.write(json.dumps(result, indent=2))
@@ -29,6 +29,16 @@ DATABASES = {
     }
 }
 
+# Set TESTAPP_DATABASE=sqlite to run the tests and benchmarks against SQLite instead of a local Postgres server
+if os.environ.get("TESTAPP_DATABASE") == "sqlite":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.path.join(BASE_DIR, "testapp.sqlite3"),
+            "OPTIONS": {"timeout": 60},
+        }
+    }
+
 SECRET_KEY = "testing"
 
 ROOT_URLCONF = __name__
@@ -1,5 +1,6 @@
 from __future__ import print_function
 
+import datetime
 import os
 import time
 
@@ -7,16 +8,39 @@ from django.test import TestCase as DjangoTestCase
 from django.test import TransactionTestCase as DjangoTransactionTestCase
 from django.core.management import call_command
 from django.conf import settings
+from django.utils import timezone
 
 from django_pewtils import CacheHandler
 
-from django_commander.commands import commands, MissingDependencyException
-from django_commander.models import Command, CommandLog
+from django_commander.commands import (
+    commands,
+    InvalidArgumentException,
+    MissingDependencyException,
+)
+from django_commander.models import Command, CommandLog, CommandRunGroup, CommandStats
 from django_commander.utils import clear_unfinished_command_logs, test_commands
 
 from testapp.models import Parent, Child
 
 
+def _run_shard(shard, run_group, barrier):
+
+    barrier.wait()
+    commands["test_iterate_download_command"](shard=shard, run_group=run_group).run()
+
+
+def _get_worker_connection_state():
+
+    from django.db import connection
+
+    Parent.objects.count()
+    return (
+        os.getpid(),
+        id(connection.connection),
+        connection.settings_dict["CONN_MAX_AGE"],
+    )
+
+
 class BaseTests(DjangoTransactionTestCase):
 
     """
@@ -156,6 +180,49 @@ class BaseTests(DjangoTransactionTestCase):
                 )
             )
 
+    def test_parallel_test_commands(self):
+        from django.core.management.base import CommandError
+        from django_pewtils import reset_django_connection
+
+        results = test_commands(
+            jobs=2, command_names=["test_command_with_dependency", "test_command"]
+        )
+        reset_django_connection()
+        self.assertEqual(
+            [r["command"] for r in results],
+            ["test_command", "test_command_with_dependency"],
+        )
+        self.assertTrue(all([r["error"] is None for r in results]))
+
+        Command.objects.all().delete()
+        with self.assertRaises(MissingDependencyException):
+            test_commands(command_names=["test_command_with_dependency"])
+        results = test_commands(
+            command_names=["test_command_with_dependency"], raise_errors=False
+        )
+        self.assertIn("MissingDependencyException", results[0]["error"])
+        with self.assertRaises(CommandError):
+            call_command(
+                "test_commands", "test_command_with_dependency", fail_fast=True
+            )
+
+        # Commands that start their own pools can run alongside each other
+        command_class = commands["test_multiprocessed_download_iterate_command"]
+        test_options = command_class.test_options
+        command_class.test_options = {"num_cores": 2}
+        try:
+            results = test_commands(
+                jobs=2,
+                command_names=[
+                    "test_multiprocessed_download_iterate_command",
+                    "test_command",
+                ],
+            )
+        finally:
+            command_class.test_options = test_options
+        reset_django_connection()
+        self.assertTrue(all([r["error"] is None for r in results]))
+
     def test_multiprocessed_download_iterate_command(self):
         from django_pewtils import reset_django_connection
 
@@ -292,6 +359,880 @@ class BaseTests(DjangoTransactionTestCase):
         self.assertEqual(Parent.objects.filter(name="bob").count(), 1)
         self.assertEqual(Child.objects.filter(name="suzy").count(), 1)
 
+    def test_command_stats(self):
+
+        for i in range(0, 3):
+            commands["test_command"](parent_name="bob").run()
+        cmd = Command.objects.get(name="test_command")
+        self.assertEqual(cmd.stats.run_count, 3)
+        self.assertEqual(cmd.stats.success_count, 3)
+        self.assertEqual(cmd.stats.failure_count, 0)
+        self.assertIsNotNone(cmd.stats.last_success_time)
+        self.assertIsNotNone(cmd.stats.last_duration)
+        self.assertTrue(cmd.stats.durations_stale)
+        self.assertEqual(CommandStats.objects.refresh_durations(), 1)
+        cmd.stats.refresh_from_db()
+        self.assertFalse(cmd.stats.durations_stale)
+        self.assertIsNotNone(cmd.stats.p50_duration)
+        self.assertGreaterEqual(cmd.stats.p95_duration, cmd.stats.p50_duration)
+
+        log = cmd.logs.all()[0]
+        log.error = "ERROR"
+        log.save()
+        CommandStats.objects.all().delete()
+        call_command("refresh_command_stats")
+        stats = CommandStats.objects.get(command=cmd)
+        self.assertEqual(stats.run_count, 3)
+        self.assertEqual(stats.success_count, 2)
+        self.assertEqual(stats.failure_count, 1)
+
+    def test_clear_unfinished_command_logs(self):
+
+        for name in ["bob", "shelly"]:
+            commands["test_command"](parent_name=name).run()
+        unfinished = CommandLog.objects.create(
+            command=Command.objects.get(parameters={"parent_name": "shelly"})
+        )
+        unfinished.parent_related.add(Parent.objects.get(name="shelly"))
+
+        self.assertEqual(
+            clear_unfinished_command_logs(older_than=1), {"logs": 0, "commands": 0}
+        )
+        self.assertEqual(
+            clear_unfinished_command_logs(dry_run=True), {"logs": 1, "commands": 0}
+        )
+        self.assertEqual(CommandLog.objects.filter(pk=unfinished.pk).count(), 1)
+
+        CommandLog.objects.filter(command__parameters={"parent_name": "bob"}).update(
+            end_time=None
+        )
+        self.assertEqual(
+            clear_unfinished_command_logs(chunk_size=1), {"logs": 2, "commands": 1}
+        )
+        self.assertEqual(CommandLog.objects.count(), 1)
+        self.assertEqual(Command.objects.count(), 1)
+        self.assertEqual(Parent.objects.get(name="shelly").command_logs.count(), 1)
+
+        # Rows without cascades or delete signals are deleted without being loaded
+        from django_commander.utils import chunked_delete
+
+        CommandStats.objects.refresh()
+        count = CommandStats.objects.count()
+        self.assertGreater(count, 0)
+        self.assertEqual(
+            chunked_delete(CommandStats.objects.all(), chunk_size=1), count
+        )
+        self.assertEqual(CommandStats.objects.count(), 0)
+
+    def test_log_retention(self):
+
+        from django.test import override_settings
+        from django_commander.retention import apply_log_retention, iter_archived_logs
+
+        for i in range(0, 4):
+            commands["test_command"](parent_name="bob").run()
+        failed = CommandLog.objects.order_by("start_time")[0]
+        failed.error = "ERROR"
+        failed.save()
+
+        archive_path = os.path.join(settings.DJANGO_COMMANDER_CACHE_PATH, "archive")
+        with override_settings(
+            DJANGO_COMMANDER_LOG_RETENTION={"test_command": {"keep_last": 2}},
+            DJANGO_COMMANDER_ARCHIVE_PATH=archive_path,
+        ):
+            self.assertEqual(apply_log_retention(dry_run=True), {"test_command": 1})
+            self.assertEqual(apply_log_retention(chunk_size=1), {"test_command": 1})
+            self.assertEqual(CommandLog.objects.count(), 3)
+            self.assertIn(failed, CommandLog.objects.all())
+
+            archived = list(iter_archived_logs("test_command"))
+            self.assertEqual(len(archived), 1)
+            self.assertEqual(archived[0]["command_parameters"], {"parent_name": "bob"})
+            self.assertEqual(len(archived[0]["related"]["testapp.Parent"]), 1)
+            self.assertEqual(
+                len(list(iter_archived_logs(parameters={"parent_name": "shelly"}))), 0
+            )
+
+    def test_consolidate_command_logs(self):
+
+        for name in ["bob", "shelly"]:
+            for i in range(0, 3):
+                commands["test_command"](parent_name=name).run()
+        first_log = CommandLog.objects.order_by("start_time")[0]
+        bob = Parent.objects.get(name="bob")
+        self.assertEqual(bob.command_logs.count(), 3)
+
+        call_command("consolidate_command_logs", "test_command")
+        self.assertEqual(CommandLog.objects.count(), 2)
+        for parent in Parent.objects.all():
+            self.assertEqual(parent.command_logs.count(), 1)
+            self.assertEqual(parent.commands.count(), 1)
+        for child in Child.objects.all():
+            self.assertEqual(child.command_logs.count(), 1)
+        self.assertEqual(
+            bob.command_logs.all()[0].start_time, first_log.start_time
+        )
+        self.assertEqual(Command.objects.get(parameters={"parent_name": "bob"}).stats.run_count, 1)
+
+    def test_command_log_errors(self):
+
+        commands["test_command"](parent_name="bob").run()
+        log = CommandLog.objects.all()[0]
+        try:
+            raise ValueError("bad value")
+        except ValueError as e:
+            import traceback
+
+            log.set_error(e, tb=traceback.format_exc())
+        log.save()
+
+        log = CommandLog.objects.get(pk=log.pk)
+        self.assertEqual(log.error_class, "ValueError")
+        self.assertEqual(log.error_message, "bad value")
+        self.assertIn("bad value", log.traceback)
+        self.assertEqual(log.error["exception"], "ValueError")
+        self.assertEqual(
+            CommandLog.objects.filter(
+                error_class="ValueError", error_digest=log.error_digest
+            ).count(),
+            1,
+        )
+
+        log.error = None
+        log.save()
+        self.assertIsNone(CommandLog.objects.get(pk=log.pk).error)
+
+    def test_command_arguments(self):
+
+        command = commands["test_command"](parent_name="bob")
+        self.assertEqual(command.parameters, {"parent_name": "bob"})
+        self.assertIsNone(command.options["child_name"])
+        self.assertFalse(command.options["ignore_dependencies"])
+        with self.assertRaises(InvalidArgumentException):
+            commands["test_command"](child_name="suzy")
+
+        from testapp.benchmarks import benchmark_command_construction
+
+        result = benchmark_command_construction("test_command", iterations=10)
+        self.assertEqual(result["iterations"], 10)
+
+    def test_typed_command_arguments(self):
+
+        command = commands["test_typed_command"](
+            parent_names=["bob", "shelly"], num_children="2"
+        )
+        self.assertEqual(command.options["num_children"], 2)
+        self.assertIsNone(command.options["prefix"])
+        children = command.run()
+        self.assertEqual(len(children), 4)
+        self.assertEqual(Parent.objects.count(), 2)
+        self.assertEqual(
+            Command.objects.get(name="test_typed_command").parameters,
+            {"parent_names": ["bob", "shelly"]},
+        )
+        with self.assertRaises(InvalidArgumentException):
+            commands["test_typed_command"](parent_names=["bob"], num_children="two")
+
+    def test_sharded_command(self):
+
+        from django.urls import reverse
+
+        commands["test_iterate_download_command"](shard="0/2", run_group="test").run()
+        group = CommandRunGroup.objects.get(key="test")
+        self.assertEqual(group.num_shards, 2)
+        self.assertIsNone(group.end_time)
+        self.assertEqual(group.progress["finished"], 1)
+
+        commands["test_iterate_download_command"](shard="1/2", run_group="test").run()
+        group = CommandRunGroup.objects.get(key="test")
+        self.assertIsNotNone(group.end_time)
+        self.assertEqual(group.progress["items"], 2)
+        self.assertEqual([log.shard for log in group.shards], [0, 1])
+        self.assertEqual(Parent.objects.filter(name__in=["BOB", "SHELLY"]).count(), 2)
+
+        response = self.client.get(
+            reverse("django_commander:view_run_group", args=[group.pk])
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["progress"]["finished"], 2)
+
+        with self.assertRaises(InvalidArgumentException):
+            commands["test_iterate_download_command"](shard="2/2")
+
+        # Shards that start at the same time join the same group
+        from multiprocessing import Barrier, Process
+        from django_pewtils import reset_django_connection
+
+        reset_django_connection()
+        barrier = Barrier(2)
+        processes = [
+            Process(target=_run_shard, args=(shard, "concurrent", barrier))
+            for shard in ["0/2", "1/2"]
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        group = CommandRunGroup.objects.get(key="concurrent")
+        self.assertEqual(sorted([log.shard for log in group.logs.all()]), [0, 1])
+
+        # Open groups that haven't been joined in a while are abandoned rather than reused
+        commands["test_iterate_download_command"](shard="0/2", run_group="stale").run()
+        stale = CommandRunGroup.objects.get(key="stale")
+        old_time = stale.start_time - datetime.timedelta(days=2)
+        CommandRunGroup.objects.filter(pk=stale.pk).update(start_time=old_time)
+        stale.logs.update(start_time=old_time)
+        commands["test_iterate_download_command"](shard="1/2", run_group="stale").run()
+        stale.refresh_from_db()
+        self.assertTrue(stale.abandoned)
+        self.assertIsNone(stale.end_time)
+        group = CommandRunGroup.objects.get(key="stale", abandoned=False)
+        self.assertEqual([log.shard for log in group.logs.all()], [1])
+        self.assertEqual(str(stale).split(": ")[-1], "ABANDONED")
+
+    def test_batched_commands(self):
+        from django_pewtils import reset_django_connection
+
+        commands["test_download_iterate_command"](batch_size=2).run()
+        self.assertEqual(Parent.objects.filter(name__in=["bob", "shelly"]).count(), 2)
+        log = CommandLog.objects.get(command__name="test_download_iterate_command")
+        self.assertEqual(log.metrics["items"], 2)
+
+        commands["test_iterate_download_command"](batch_size=2).run()
+        self.assertEqual(Parent.objects.filter(name__in=["BOB", "SHELLY"]).count(), 2)
+
+        # Cached rows that no longer fit `parse_and_save` are downloaded again
+        Parent.objects.all().delete()
+        command = commands["test_iterate_download_command"](batch_size=2)
+        command.cache.write(
+            command.get_cache_key("download", "bob"),
+            ["BOB", "outdated"],
+            fingerprint=command.get_cache_fingerprint("bob"),
+        )
+        command.run()
+        self.assertEqual(Parent.objects.filter(name__in=["BOB", "SHELLY"]).count(), 2)
+
+        Parent.objects.all().delete()
+        commands["test_multiprocessed_iterate_download_command"](
+            num_cores=2, batch_size=2
+        ).run()
+        reset_django_connection()
+        self.assertEqual(Parent.objects.filter(name__in=["BOB", "SHELLY"]).count(), 2)
+
+    def test_spooled_payloads(self):
+        from django.test import override_settings
+        from django_pewtils import reset_django_connection
+        from django_commander.payloads import (
+            PickledPayload,
+            SpooledPayload,
+            spool_payload,
+        )
+
+        payload = [b"x" * 2048, {"key": "value"}]
+        with override_settings(DJANGO_COMMANDER_SPOOL_THRESHOLD=None):
+            self.assertEqual(spool_payload(payload), payload)
+        pickled = spool_payload(payload, threshold=1024 * 1024)
+        self.assertIsInstance(pickled, PickledPayload)
+        self.assertEqual(pickled.load(), payload)
+        spooled = spool_payload(payload, threshold=1024)
+        self.assertIsInstance(spooled, SpooledPayload)
+        self.assertEqual(spooled.load(), payload)
+        spooled.unlink()
+        self.assertFalse(os.path.exists(spooled.path))
+
+        with override_settings(DJANGO_COMMANDER_SPOOL_THRESHOLD=0):
+            commands["test_multiprocessed_iterate_download_command"](
+                num_cores=2
+            ).run()
+        reset_django_connection()
+        self.assertEqual(Parent.objects.filter(name__in=["BOB", "SHELLY"]).count(), 2)
+        # The workers' `parse_and_save` calls are logged too, so the command's own log is the first one
+        log = CommandLog.objects.filter(
+            command__name="test_multiprocessed_iterate_download_command"
+        ).earliest("start_time")
+        self.assertGreater(log.metrics["spooled_bytes"], 0)
+
+    def test_download_in_workers(self):
+        from django_pewtils import reset_django_connection
+
+        commands["test_multiprocessed_iterate_download_command"](
+            num_cores=2, download_in_workers=True
+        ).run()
+        reset_django_connection()
+        self.assertEqual(Parent.objects.filter(name__in=["BOB", "SHELLY"]).count(), 2)
+
+        Parent.objects.all().delete()
+        commands["test_multiprocessed_iterate_download_command"](
+            num_cores=2, download_in_workers=True, batch_size=2
+        ).run()
+        reset_django_connection()
+        self.assertEqual(Parent.objects.filter(name__in=["BOB", "SHELLY"]).count(), 2)
+
+    def test_worker_connections(self):
+        from django.db import connection
+        from django_commander.utils import create_worker_pool
+
+        Parent.objects.count()
+        pool = create_worker_pool(1)
+        self.assertIsNone(connection.connection)
+        first = pool.apply(_get_worker_connection_state)
+        second = pool.apply(_get_worker_connection_state)
+        pool.close()
+        pool.join()
+        # The worker opens one connection and reuses it across tasks
+        self.assertEqual(first, second)
+        self.assertIsNone(first[2])
+        self.assertNotEqual(first[0], os.getpid())
+
+    def test_num_cores(self):
+        from django.test import override_settings
+        from django_pewtils import reset_django_connection
+        from django_commander.utils import PoolThrottle
+
+        with override_settings(DJANGO_COMMANDER_MAX_DB_CONNECTIONS=3):
+            command = commands["test_multiprocessed_iterate_download_command"](
+                num_cores="auto"
+            )
+        self.assertEqual(command.options["num_cores"], min(2, os.cpu_count()))
+        with self.assertRaises(InvalidArgumentException):
+            commands["test_multiprocessed_iterate_download_command"](num_cores="0")
+
+        commands["test_multiprocessed_iterate_download_command"](num_cores=1).run()
+        self.assertEqual(Parent.objects.filter(name__in=["BOB", "SHELLY"]).count(), 2)
+        log = CommandLog.objects.filter(
+            command__name="test_multiprocessed_iterate_download_command"
+        ).earliest("start_time")
+        self.assertNotIn("queue_depth", log.metrics)
+
+        Parent.objects.all().delete()
+        CommandLog.objects.all().delete()
+        commands["test_multiprocessed_iterate_download_command"](
+            num_cores=2, autoscale=True
+        ).run()
+        reset_django_connection()
+        self.assertEqual(Parent.objects.filter(name__in=["BOB", "SHELLY"]).count(), 2)
+        log = CommandLog.objects.filter(
+            command__name="test_multiprocessed_iterate_download_command"
+        ).earliest("start_time")
+        self.assertEqual(log.metrics["queue_depth"], 1)
+
+        throttle = PoolThrottle(4, autoscale=True, window=1)
+        self.assertEqual(throttle.limit, 2)
+        throttle.wait()
+        throttle.task_done(time.time())
+        self.assertEqual(throttle.limit, 3)
+
+    def test_download_retries(self):
+        from django_commander.retries import CircuitBreaker, RetryPolicy
+
+        attempts = []
+
+        def flaky_download(name):
+            attempts.append(name)
+            if name == "shelly":
+                raise ValueError("unavailable")
+            if len(attempts) < 3:
+                raise IOError("timeout")
+            return [name.upper()]
+
+        command = commands["test_iterate_download_command"]()
+        command.download = flaky_download
+        command.download_retry_policy = RetryPolicy(
+            max_attempts=3, delay=0, retry_on=(IOError,)
+        )
+        command.skip_failed_items = True
+        command.run()
+        self.assertEqual(Parent.objects.filter(name="BOB").count(), 1)
+        self.assertEqual(Parent.objects.filter(name="SHELLY").count(), 0)
+        log = CommandLog.objects.get(command__name="test_iterate_download_command")
+        self.assertIsNone(log.error_class)
+        self.assertEqual(log.metrics["download_retries"], 2)
+        self.assertEqual(log.metrics["failed_items"], 1)
+        self.assertEqual(log.metrics["item_errors"][0]["error_class"], "ValueError")
+
+        # Each worker gets a new command instance for every task, so the outcomes have to be sent back to the parent
+        from django_pewtils import reset_django_connection
+
+        worker_attempts = []
+
+        def flaky_worker_download(self, name):
+            worker_attempts.append(name)
+            if name == "shelly":
+                raise ValueError("unavailable")
+            if worker_attempts.count(name) < 3:
+                raise IOError("timeout")
+            return [name.upper()]
+
+        command_class = commands["test_multiprocessed_iterate_download_command"]
+        overrides = {
+            "download": flaky_worker_download,
+            "download_retry_policy": RetryPolicy(
+                max_attempts=3, delay=0, retry_on=(IOError,)
+            ),
+            "skip_failed_items": True,
+            "circuit_breaker_threshold": 1,
+            "circuit_breaker_cooldown": 0,
+        }
+        originals = dict([(k, command_class.__dict__.get(k)) for k in overrides])
+        for k, v in overrides.items():
+            setattr(command_class, k, v)
+        Parent.objects.all().delete()
+        try:
+            command_class(num_cores=2, download_in_workers=True).run()
+        finally:
+            for k, v in originals.items():
+                if v is None:
+                    delattr(command_class, k)
+                else:
+                    setattr(command_class, k, v)
+        reset_django_connection()
+        self.assertEqual(Parent.objects.filter(name="BOB").count(), 1)
+        log = CommandLog.objects.filter(
+            command__name="test_multiprocessed_iterate_download_command"
+        ).earliest("start_time")
+        self.assertIsNone(log.error_class)
+        self.assertEqual(log.metrics["download_retries"], 2)
+        self.assertEqual(log.metrics["failed_items"], 1)
+        self.assertEqual(log.metrics["item_errors"][0]["error_class"], "ValueError")
+        self.assertEqual(log.metrics["circuit_breaker_trips"], 1)
+        self.assertNotIn("download_failure_streak", log.metrics)
+
+        breaker = CircuitBreaker(failure_threshold=2, cooldown=0.1)
+        breaker.record_failure()
+        self.assertFalse(breaker.is_open)
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        breaker.wait()
+        self.assertFalse(breaker.is_open)
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        self.assertEqual(breaker.trips, 2)
+
+    def test_rate_limiter(self):
+        import tempfile
+        from django.test import override_settings
+        from django_commander.ratelimit import RateLimiter
+
+        path = os.path.join(tempfile.mkdtemp(), "rate_limits.sqlite3")
+        limiter = RateLimiter(50, capacity=1, path=path)
+        start = time.time()
+        for i in range(0, 11):
+            limiter.acquire(key="test")
+        self.assertGreaterEqual(time.time() - start, 0.19)
+        self.assertEqual(RateLimiter(50, capacity=1, path=path).try_acquire("other"), 0)
+        self.assertGreater(RateLimiter(50, capacity=1, path=path).try_acquire("test"), 0)
+
+        command_class = commands["test_iterate_download_command"]
+        command_class.download_rate_limit = 5
+        command_class.download_rate_limit_burst = 1
+        try:
+            with override_settings(
+                DJANGO_COMMANDER_RATE_LIMIT_PATH=os.path.join(
+                    os.path.dirname(path), "command_rate_limits.sqlite3"
+                )
+            ):
+                command_class(refresh_cache=True).run()
+        finally:
+            command_class.download_rate_limit = None
+            command_class.download_rate_limit_burst = None
+        self.assertEqual(Parent.objects.filter(name__in=["BOB", "SHELLY"]).count(), 2)
+        log = CommandLog.objects.get(command__name="test_iterate_download_command")
+        self.assertGreater(log.metrics["rate_limit_wait_seconds"], 0)
+
+    def test_pipeline_benchmarks(self):
+        from django_pewtils import reset_django_connection
+        from testapp.benchmarks import PIPELINE_BENCHMARK_COMMANDS, benchmark_pipeline
+
+        for command_name in PIPELINE_BENCHMARK_COMMANDS:
+            result = benchmark_pipeline(command_name, 5, num_cores=2, cache=False)
+            reset_django_connection()
+            self.assertEqual(result["num_items"], 5)
+            self.assertGreater(result["items_per_second"], 0)
+            self.assertGreater(result["queries_per_item"], 1)
+            self.assertEqual(
+                Parent.objects.filter(name__startswith="benchmark_").count(), 5
+            )
+
+    def test_cache_index(self):
+        from django.test import override_settings
+        from django.core.management import CommandError
+        from django_commander.cache import (
+            collect_garbage,
+            get_cache_index,
+            index_existing_files,
+        )
+
+        commands["test_iterate_download_command"]().run()
+        commands["test_iterate_download_command"]().run()
+        totals = get_cache_index().get_totals("test_iterate_download_command")
+        stats = totals["test_iterate_download_command"]
+        self.assertEqual(stats["entries"], 2)
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 2)
+        self.assertGreater(stats["bytes"], 0)
+        log = CommandLog.objects.filter(
+            command__name="test_iterate_download_command"
+        ).latest("start_time")
+        self.assertEqual(log.metrics["cache_hits"], 2)
+
+        path = os.path.join(
+            settings.DJANGO_COMMANDER_CACHE_PATH, "test_iterate_download_command"
+        )
+        # Reads are buffered until the command flushes its cache
+        index = get_cache_index()
+        index.record_read("test_iterate_download_command", path, "missing", False)
+        totals = index.get_totals("test_iterate_download_command")
+        self.assertEqual(totals["test_iterate_download_command"]["misses"], 2)
+        self.assertTrue(index.flush_reads())
+        totals = index.get_totals("test_iterate_download_command")
+        self.assertEqual(totals["test_iterate_download_command"]["misses"], 3)
+        keys = [e["key"] for e in index.find_entries("test_iterate_download_command")]
+        self.assertEqual(
+            index.find_keys(path, keys + ["missing"], chunk_size=1), set(keys)
+        )
+
+        with override_settings(
+            DJANGO_COMMANDER_CACHE_POLICIES={
+                "test_iterate_download_command": {"max_bytes": stats["bytes"] - 1}
+            }
+        ):
+            deleted = collect_garbage()
+        self.assertEqual(deleted["test_iterate_download_command"]["entries"], 1)
+        self.assertEqual(len([f for f in os.listdir(path) if f.endswith(".pkl")]), 1)
+
+        # Folders that don't exist locally (e.g. S3 prefixes) are never marked complete
+        missing_path = os.path.join(settings.DJANGO_COMMANDER_CACHE_PATH, "missing")
+        self.assertEqual(index_existing_files("missing", missing_path), 0)
+        self.assertFalse(index.is_complete(missing_path))
+        with override_settings(DJANGO_COMMANDER_USE_S3=True):
+            with self.assertRaises(CommandError):
+                call_command("commander_cache", "index")
+
+        call_command("commander_cache", "purge", "test_iterate_download_command")
+        self.assertEqual(len([f for f in os.listdir(path) if f.endswith(".pkl")]), 0)
+        call_command("commander_cache", "stats")
+
+    def test_cache_invalidation(self):
+        from django_commander.cache import CommandCache, invalidate, list_entries
+
+        path = os.path.join(settings.DJANGO_COMMANDER_CACHE_PATH, "test_cache")
+        cache = CommandCache("test_cache", path)
+        self.assertFalse(cache.contains("missing"))
+        cache.write("a1", {"value": 1}, fingerprint="v1", parameters={"year": 2020})
+        cache.write("a2", {"value": 2}, fingerprint="v1", parameters={"year": 2021})
+        cache.write("b1", {"value": 3}, parameters={"year": 2021})
+        self.assertTrue(cache.contains("a1"))
+        self.assertEqual(cache.read("a1", fingerprint="v1"), {"value": 1})
+        self.assertIsNone(cache.read("a1", fingerprint="v2"))
+        self.assertIsNone(cache.read("missing"))
+
+        self.assertEqual(
+            [e["key"] for e in list_entries("test_cache", prefix="a")], ["a1", "a2"]
+        )
+        self.assertEqual(invalidate("test_cache", parameters={"year": 2021}), 2)
+        self.assertFalse(cache.contains("a2"))
+        self.assertFalse(os.path.exists(os.path.join(path, "b1.pkl")))
+        self.assertEqual(invalidate("test_cache", older_than_days=1), 0)
+        call_command("commander_cache", "invalidate", "test_cache", "--prefix", "a")
+        self.assertEqual(list_entries("test_cache"), [])
+
+        # Files cached before the index existed are picked up the first time the folder is used
+        other_path = os.path.join(settings.DJANGO_COMMANDER_CACHE_PATH, "test_other")
+        CacheHandler(other_path, hash=False).write("old", {"value": 4})
+        other_cache = CommandCache("test_other", other_path)
+        self.assertTrue(other_cache.contains("old"))
+        self.assertFalse(other_cache.contains("new"))
+
+    def test_s3_cache(self):
+        try:
+            import boto3
+            import moto
+        except ImportError:
+            self.skipTest("moto isn't installed")
+        from django.test import override_settings
+
+        mock = getattr(moto, "mock_aws", None) or getattr(moto, "mock_s3")
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        with mock(), override_settings(
+            DJANGO_COMMANDER_USE_S3=True,
+            S3_BUCKET="django-commander-test",
+            DJANGO_COMMANDER_S3_MULTIPART_THRESHOLD=5 * 1024 * 1024,
+            DJANGO_COMMANDER_S3_WRITE_BEHIND=True,
+        ):
+            client = boto3.client("s3")
+            client.create_bucket(Bucket="django-commander-test")
+
+            command = commands["test_iterate_download_command"]()
+            command.run()
+            self.assertEqual(command.metrics["s3_uploads"], 2)
+            command = commands["test_iterate_download_command"]()
+            command.run()
+            self.assertEqual(command.metrics["cache_hits"], 2)
+            self.assertEqual(command.metrics["s3_prefetch_hits"], 2)
+            keys = client.list_objects(Bucket="django-commander-test")["Contents"]
+            self.assertEqual(len(keys), 2)
+
+            # Large objects are transferred in parts
+            command.cache.write("large", b"x" * 6 * 1024 * 1024)
+            command.cache.flush()
+            self.assertEqual(len(command.cache.read("large")), 6 * 1024 * 1024)
+
+    def test_s3_local_tier(self):
+        try:
+            import boto3
+            import moto
+        except ImportError:
+            self.skipTest("moto isn't installed")
+        import pickle
+        from django.test import override_settings
+        from django_commander.cache import CommandCache
+
+        mock = getattr(moto, "mock_aws", None) or getattr(moto, "mock_s3")
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        with mock(), override_settings(
+            DJANGO_COMMANDER_USE_S3=True,
+            S3_BUCKET="django-commander-test",
+            DJANGO_COMMANDER_S3_LOCAL_TIER_MAX_BYTES=1024 * 1024,
+        ):
+            client = boto3.client("s3")
+            client.create_bucket(Bucket="django-commander-test")
+
+            commands["test_iterate_download_command"]().run()
+            command = commands["test_iterate_download_command"]()
+            command.run()
+            self.assertEqual(command.metrics["cache_hits"], 2)
+            self.assertEqual(command.metrics["cache_local_hits"], 2)
+            self.assertNotIn("cache_s3_hits", command.metrics)
+
+            # Local copies that no longer match S3 are replaced
+            path = os.path.join(settings.DJANGO_COMMANDER_CACHE_PATH, "test_s3_tier")
+            cache = CommandCache(
+                "test_s3_tier", path, use_s3=True, bucket="django-commander-test"
+            )
+            cache.write("key", {"value": 1})
+            client.put_object(
+                Bucket="django-commander-test",
+                Key=cache.get_s3_key("key"),
+                Body=pickle.dumps({"value": 2}),
+            )
+            self.assertEqual(cache.read("key"), {"value": 2})
+            self.assertEqual(cache.read("key"), {"value": 2})
+            self.assertEqual(cache.stats["local_stale"], 1)
+            self.assertEqual(cache.stats["local_hits"], 1)
+
+            # The local tier is capped, but S3 keeps everything
+            cache.write("large", b"x" * 600 * 1024)
+            cache.write("larger", b"x" * 700 * 1024)
+            self.assertFalse(os.path.exists(os.path.join(cache.local_path, "key.pkl")))
+            self.assertTrue(
+                os.path.exists(os.path.join(cache.local_path, "larger.pkl"))
+            )
+            self.assertEqual(cache.read("key"), {"value": 2})
+            # Objects bigger than the whole tier are only kept in S3
+            cache.write("huge", b"x" * 2 * 1024 * 1024)
+            self.assertFalse(os.path.exists(os.path.join(cache.local_path, "huge.pkl")))
+            self.assertTrue(
+                os.path.exists(os.path.join(cache.local_path, "larger.pkl"))
+            )
+            self.assertEqual(len(cache.read("huge")), 2 * 1024 * 1024)
+            self.assertEqual(
+                cache.index.get_local_copy_total(),
+                sum([size for _, _, size in cache.index.find_local_copies()]),
+            )
+
+    def test_query_counting(self):
+        from django.test import override_settings
+        from django_commander.queries import QueryLimitExceeded, get_sql_shape
+
+        self.assertEqual(
+            get_sql_shape("SELECT * FROM t WHERE id IN (1, 2, 3) AND name = 'bob'"),
+            "SELECT * FROM t WHERE id IN (...) AND name = ?",
+        )
+
+        with override_settings(DJANGO_COMMANDER_COUNT_QUERIES=True):
+            commands["test_iterate_download_command"]().run()
+        log = CommandLog.objects.filter(
+            command__name="test_iterate_download_command"
+        ).latest("start_time")
+        queries = log.metrics["queries"]
+        self.assertGreater(queries["parse_and_save"]["count"], 0)
+        self.assertGreater(queries["log"]["count"], 0)
+        self.assertGreater(len(queries["parse_and_save"]["top"]), 0)
+        self.assertEqual(
+            log.metrics["query_count"], sum([q["count"] for q in queries.values()])
+        )
+
+        command = commands["test_iterate_download_command"]()
+        command.max_queries = 1
+        with self.assertRaises(QueryLimitExceeded):
+            command.run()
+        # The run is recorded once, as a failure
+        log = CommandLog.objects.get(pk=command.log_id)
+        self.assertEqual(log.error_class.split(".")[-1], "QueryLimitExceeded")
+        self.assertIsNone(log.end_time)
+        stats = CommandStats.objects.get(command=log.command)
+        self.assertEqual(stats.run_count, 2)
+        self.assertEqual(stats.failure_count, 1)
+
+    def test_metrics_export(self):
+        from django.urls import reverse
+        from django_commander.exporter import write_metrics_textfile
+        from django_commander.utils import LogHeartbeat
+
+        commands["test_iterate_download_command"]().run()
+        commands["test_iterate_download_command"]().run()
+        command = Command.objects.get(name="test_iterate_download_command")
+        running = CommandLog.objects.create(command=command, metrics={"items": 3})
+        # Worker logs, logs that recorded an error and logs that stopped saving their metrics aren't running
+        dead = [
+            CommandLog.objects.create(
+                command=command, metrics={"items": 1}, worker=True
+            ),
+            CommandLog.objects.create(
+                command=command, metrics={"items": 1}, error_class="Exception"
+            ),
+            CommandLog.objects.create(
+                command=command,
+                metrics={"items": 1},
+                metrics_updated_at=timezone.now() - datetime.timedelta(days=1),
+            ),
+        ]
+
+        response = self.client.get(reverse("django_commander:metrics"))
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode("utf8")
+        labels = '{{command="test_iterate_download_command",command_id="{}"}}'.format(
+            command.pk
+        )
+        self.assertIn("django_commander_runs_total{} 2.0".format(labels), content)
+        self.assertIn("django_commander_running{} 1.0".format(labels), content)
+        self.assertIn("django_commander_running_items{} 3.0".format(labels), content)
+        self.assertIn("django_commander_last_run_items{} 2.0".format(labels), content)
+        self.assertIn(
+            "django_commander_last_run_cache_hit_ratio{} 1.0".format(labels), content
+        )
+        self.assertIn("django_commander_last_success_timestamp_seconds", content)
+        # Runs that are busy with something other than flushing their metrics are kept alive by their heartbeat
+        heartbeat = LogHeartbeat(running.pk, 0.01)
+        heartbeat.start()
+        time.sleep(0.1)
+        heartbeat.stop()
+        running.refresh_from_db()
+        self.assertIsNotNone(running.metrics_updated_at)
+        running.delete()
+        for log in dead:
+            log.delete()
+
+        path = os.path.join(settings.DJANGO_COMMANDER_CACHE_PATH, "commands.prom")
+        write_metrics_textfile(path)
+        with open(path, "r") as infile:
+            self.assertIn("# TYPE django_commander_runs_total counter", infile.read())
+
+    def test_tracing(self):
+        import json
+        import tempfile
+        from django.test import override_settings
+        from django_commander.tracing import (
+            NOOP_SPAN,
+            get_traceparent,
+            set_traceparent,
+            start_span,
+        )
+
+        self.assertIs(start_span("disabled"), NOOP_SPAN)
+
+        path = os.path.join(tempfile.mkdtemp(), "traces.jsonl")
+        with override_settings(
+            DJANGO_COMMANDER_TRACING="jsonl", DJANGO_COMMANDER_TRACE_PATH=path
+        ):
+            commands["test_iterate_download_command"]().run()
+            set_traceparent("00-{}-{}-01".format("a" * 32, "b" * 16))
+            with start_span("remote"):
+                self.assertTrue(get_traceparent().startswith("00-" + "a" * 32))
+            set_traceparent(None)
+        with open(path, "r") as infile:
+            spans = [json.loads(line) for line in infile]
+
+        remote = spans.pop()
+        self.assertEqual(remote["trace_id"], "a" * 32)
+        self.assertEqual(remote["parent_span_id"], "b" * 16)
+        names = set([span["name"] for span in spans])
+        for name in [
+            "command",
+            "log",
+            "iterate",
+            "download",
+            "cache.read",
+            "parse_and_save",
+            "cleanup",
+        ]:
+            self.assertIn(name, names)
+        root = [span for span in spans if span["name"] == "command"][0]
+        self.assertIsNone(root["parent_span_id"])
+        self.assertEqual(root["attributes"]["command"], "test_iterate_download_command")
+        span_ids = set([span["span_id"] for span in spans])
+        for span in spans:
+            self.assertEqual(span["trace_id"], root["trace_id"])
+            if span is not root:
+                self.assertIn(span["parent_span_id"], span_ids)
+            self.assertGreaterEqual(
+                span["end_time_unix_nano"], span["start_time_unix_nano"]
+            )
+
+    def test_memory_governor(self):
+        from django.test import override_settings
+        from django_pewtils import reset_django_connection
+        from django_commander.memory import (
+            MemoryGovernor,
+            get_max_tasks_per_child,
+            get_pss,
+            get_rss,
+        )
+
+        self.assertGreater(get_rss(), 0)
+        self.assertGreater(get_pss(), 0)
+        governor = MemoryGovernor(ceiling=1)
+        self.assertTrue(governor.check())
+        self.assertFalse(governor.check())
+        self.assertEqual(governor.pauses, 1)
+        self.assertGreater(governor.get_metrics()["memory_max_rss"], 0)
+
+        last_metrics = {
+            "memory_worker_growth": 1000,
+            "memory_worker_baseline_rss": 100000,
+            "task_seconds": 2.0,
+        }
+        self.assertEqual(get_max_tasks_per_child(3, last_metrics, ceiling=800000), 50)
+        self.assertEqual(
+            get_max_tasks_per_child(3, last_metrics, worker_memory=300000), 100
+        )
+        self.assertIsNone(get_max_tasks_per_child(3, last_metrics))
+        self.assertIsNone(get_max_tasks_per_child(3, {}, ceiling=800000))
+
+        with override_settings(DJANGO_COMMANDER_WORKER_MAX_TASKS=1):
+            commands["test_multiprocessed_iterate_download_command"](
+                num_cores=2
+            ).run()
+        reset_django_connection()
+        self.assertEqual(Parent.objects.filter(name__in=["BOB", "SHELLY"]).count(), 2)
+        log = CommandLog.objects.filter(
+            command__name="test_multiprocessed_iterate_download_command"
+        ).earliest("start_time")
+        self.assertEqual(log.metrics["max_tasks_per_child"], 1)
+        self.assertGreater(log.metrics["memory_max_rss"], 0)
+        self.assertGreater(log.metrics["memory_max_total_pss"], 0)
+        self.assertFalse(log.worker)
+        # Only the parent measures memory; the workers' logs don't
+        for worker_log in CommandLog.objects.filter(
+            command__name="test_multiprocessed_iterate_download_command"
+        ).exclude(pk=log.pk):
+            self.assertNotIn("memory_max_rss", worker_log.metrics)
+            self.assertTrue(worker_log.worker)
+        # Only the parent's run counts towards the command's statistics
+        self.assertEqual(log.command.stats.run_count, 1)
+        CommandStats.objects.refresh()
+        self.assertEqual(CommandStats.objects.get(command=log.command).run_count, 1)
+
     def tearDown(self):
         from django.conf import settings
         import shutil, os